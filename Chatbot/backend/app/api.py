@@ -3,36 +3,53 @@ import os
 from pathlib import Path
 from dotenv import load_dotenv
 
-# === Moved Logging Configuration START ===
-# Basic logging configuration - Place this EARLY
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-logger = logging.getLogger(__name__)
-# === Moved Logging Configuration END ===
-
-# Load environment variables from the project root .env file - Place this AFTER logging setup
+# Load environment variables from the project root .env file - Place this EARLY, they configure logging too
 load_dotenv(Path(__file__).parents[2] / '.env')
 
-from fastapi import FastAPI, HTTPException, Depends, Query
+# === Logging Configuration START ===
+# Queued, structured logging (LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATIO) - Place this before the app imports
+from app.logging_config import RequestIdMiddleware, setup_logging
+setup_logging()
+logger = logging.getLogger(__name__)
+# === Logging Configuration END ===
+
+import asyncio
+import fcntl
+import secrets
+import threading
+import time
+from dataclasses import asdict
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from opentelemetry import trace
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 import chromadb
-from chromadb.utils import embedding_functions
 import requests
 import json
 import re # Import regex module
 
 # Import our new ModelManager - Keep this AFTER logging setup
-from app.models import model_manager
+from app.models import SharedContext, model_manager
+from app.embeddings import EMBEDDING_BACKEND, create_embedding_function, open_collection
+from app.embedding_server import EMBEDDING_SERVER_SOCKET, EmbeddingClient, EmbeddingServerError
+from app.collection_versions import resolve_collection_name
+from app.sharding import merge_query_results, read_shard_map, route_shards
+from app.tracing import setup_tracing, tracer
+from app.cancellation import QUERY_TIMEOUT_SECONDS, ClientDisconnected, Deadline, DeadlineExceeded, run_with_deadline
+from app.sessions import SESSION_ID_PATTERN, Session, session_store
+from app.jobs import TERMINAL_STATUSES, JobQueueFull, job_manager
+from app.profiling import QueryCompletionMiddleware, end_session, install_signal_handler, start_session
+from app.metrics import (CANDIDATE_ARTICLES, CONTEXT_TOKENS, CONTEXT_TRUNCATIONS, PROMPT_CACHED_TOKENS, QUERIES_CANCELLED,
+                         QUERY_SECONDS, RETRIEVED_CHUNKS, StageTimings, observe_stages, register_cache)
 
 # No longer needed here:
 # Basic logging configuration
 # logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 # logger = logging.getLogger(__name__)
 
-# Added import for datetime which was potentially removed above? Ensure it's present.
-from datetime import datetime
-
 app = FastAPI(title="IWAC RAG API", description="API for the Islam West Africa Collection RAG system")
 
 # Add CORS middleware
@@ -42,34 +59,70 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
+# Counts completed /query requests for "profile the next N queries" sessions
+app.add_middleware(QueryCompletionMiddleware)
+# Correlation ID for the logs of each request (outermost, so CORS responses carry it too)
+app.add_middleware(RequestIdMiddleware)
+
+# Optional OpenTelemetry tracing (TRACING_EXPORTER=console|otlp)
+setup_tracing(app)
 
 # Environment variables
 CHROMADB_HOST = os.getenv("CHROMADB_HOST", "localhost")
 CHROMADB_PORT = int(os.getenv("CHROMADB_PORT", "8000"))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "iwac_articles")
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
+# Run the startup check/indexing inside the API (entrypoint.sh then skips it) so serving starts immediately
+INDEX_IN_BACKGROUND = os.getenv("INDEX_IN_BACKGROUND", "false").lower() == "true"
+# Seconds between checks of the COLLECTION_NAME alias, so a newly switched-in version is used without a restart
+ALIAS_REFRESH_SECONDS = float(os.getenv("ALIAS_REFRESH_SECONDS", "10"))
+# Seconds /filters results are reused for the same collection version
+FILTERS_CACHE_SECONDS = float(os.getenv("FILTERS_CACHE_SECONDS", "300"))
+# Seconds between keep-alive comments on idle /jobs/{id}/events streams
+JOB_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("JOB_EVENTS_KEEPALIVE_SECONDS", "15"))
+# Concurrent /query/compare generations per provider, across requests
+COMPARE_PROVIDER_CONCURRENCY = int(os.getenv("COMPARE_PROVIDER_CONCURRENCY", "4"))
+# Token for the /admin endpoints (unset = disabled)
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 
-logger.info(f"Using ChromaDB Host: {CHROMADB_HOST}:{CHROMADB_PORT}")
-logger.info(f"Using Collection: {COLLECTION_NAME}")
-logger.info(f"Using Embedding Model: {EMBEDDING_MODEL_NAME}")
+logger.info("Using ChromaDB Host: %s:%s", CHROMADB_HOST, CHROMADB_PORT)
+logger.info("Using Collection: %s", COLLECTION_NAME)
+logger.info("Using Embedding Model: %s", EMBEDDING_MODEL_NAME)
 
 # Initialize embedding function once at startup
 try:
-    logger.info(f"Initializing embedding function: {EMBEDDING_MODEL_NAME}...")
-    _embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name=EMBEDDING_MODEL_NAME
-    )
+    if EMBEDDING_SERVER_SOCKET:
+        # One process embeds for all the workers (python -m app.embedding_server); nothing to load here
+        logger.info("Using the embedding server at %s for %s", EMBEDDING_SERVER_SOCKET, EMBEDDING_MODEL_NAME)
+        _embedding_function = EmbeddingClient(EMBEDDING_SERVER_SOCKET)
+    else:
+        logger.info("Initializing embedding function: %s (backend: %s)...", EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND)
+        _embedding_function = create_embedding_function(EMBEDDING_MODEL_NAME)
     logger.info("Embedding function initialized successfully.")
 except Exception as e:
-    logger.error(f"Failed to initialize embedding function: {e}")
+    logger.error("Failed to initialize embedding function: %s", e)
     # Depending on criticality, you might want to raise an exception or exit
     _embedding_function = None 
 
+# Let the ModelManager reuse the loaded model for context compression
+model_manager.set_embedding_function(_embedding_function)
+
 # Connect to ChromaDB
 # Use a singleton pattern or dependency injection for production
 _chroma_client = None
 _collection = None
+_collection_checked_at = 0.0
+_collection_lock = threading.Lock()
+# Sharded layout of the live collection: (scheme, {shard key: collection}), or None
+_shards: Optional[tuple] = None
+_shard_map = None
+# /filters responses by collection name: (monotonic time computed, response)
+_filters_cache: Dict[str, Any] = {}
+_filters_cache_lookups = {"hits": 0, "misses": 0}
+register_cache("filters", lambda: (_filters_cache_lookups["hits"], _filters_cache_lookups["misses"]))
+register_cache("sessions", lambda: (session_store.lookups["hits"], session_store.lookups["misses"]))
 
 def get_chroma_client():
     global _chroma_client
@@ -81,7 +134,7 @@ def get_chroma_client():
             _chroma_client.heartbeat()
             logger.info("ChromaDB client initialized successfully.")
         except Exception as e:
-            logger.error(f"Failed to connect to ChromaDB at {CHROMADB_HOST}:{CHROMADB_PORT}: {e}")
+            logger.error("Failed to connect to ChromaDB at %s:%s: %s", CHROMADB_HOST, CHROMADB_PORT, e)
             raise HTTPException(status_code=503, detail="Could not connect to ChromaDB service")
     return _chroma_client
 
@@ -92,25 +145,60 @@ def get_embedding_function():
         raise HTTPException(status_code=500, detail="Embedding function could not be initialized.")
     return _embedding_function
 
+def _collection_is_fresh() -> bool:
+    return _collection is not None and time.monotonic() - _collection_checked_at < ALIAS_REFRESH_SECONDS
+
+def _on_collection_switched(old_name: str, new_name: str):
+    """Drop everything derived from the previous collection version"""
+    logger.info("Collection switched from '%s' to '%s', invalidating caches", old_name, new_name)
+    _filters_cache.clear()
+    # The new version may index a newer corpus; reload full articles without blocking this request
+    threading.Thread(target=model_manager.reload_articles, name="article-reload", daemon=True).start()
+
 def get_collection():
-    global _collection
-    if _collection is None:
+    """
+    The live collection. COLLECTION_NAME may be an alias of a versioned collection
+    (see app/collection_versions.py); the alias is re-read every ALIAS_REFRESH_SECONDS
+    and a switch is picked up by the next request, with no restart.
+    """
+    global _collection, _collection_checked_at, _shards, _shard_map
+    if _collection_is_fresh():
+        return _collection
+    with _collection_lock:
+        if _collection_is_fresh():
+            return _collection
         client = get_chroma_client()
         embedding_func = get_embedding_function()
         try:
-            logger.info(f"Getting collection '{COLLECTION_NAME}'")
-            _collection = client.get_collection(name=COLLECTION_NAME, embedding_function=embedding_func)
-            logger.info(f"Successfully retrieved collection '{COLLECTION_NAME}'")
+            target = resolve_collection_name(client, COLLECTION_NAME)
+            switched = _collection is not None and _collection.name != target
+            if _collection is None or switched:
+                logger.info("Getting or creating collection '%s' (alias '%s')", target, COLLECTION_NAME)
+            # Re-opened on every refresh to pick up shard map changes from the indexer
+            collection = open_collection(client, target, embedding_func)
+            shard_map = read_shard_map(collection)
+            if shard_map != _shard_map:
+                _shards = None
+                if shard_map is not None:
+                    scheme, names = shard_map
+                    _shards = (scheme, {key: open_collection(client, name, embedding_func, create=False) for key, name in names.items()})
+                    logger.info("Collection '%s' is sharded by %s into %d collections", target, scheme, len(names))
+                _shard_map = shard_map
+            if _collection is None or switched:
+                logger.info("Successfully retrieved collection '%s'", target)
+            if switched:
+                _on_collection_switched(_collection.name, target)
+            _collection = collection
+            _collection_checked_at = time.monotonic()
         except Exception as e:
-            # This might error if collection doesn't exist, which is okay for get_or_create
-            logger.warning(f"Failed to get collection '{COLLECTION_NAME}', attempting to create: {e}")
-            try:
-                _collection = client.create_collection(name=COLLECTION_NAME, embedding_function=embedding_func)
-                logger.info(f"Successfully created collection '{COLLECTION_NAME}'")
-            except Exception as create_e:
-                 logger.error(f"Failed to get or create collection '{COLLECTION_NAME}': {create_e}")
-                 # If it truly fails, raise HTTPException
-                 raise HTTPException(status_code=500, detail=f"Could not get or create ChromaDB collection '{COLLECTION_NAME}'")
+            if _collection is not None:
+                # Keep serving the current version rather than failing queries
+                logger.warning("Could not refresh collection alias '%s', keeping '%s': %s", COLLECTION_NAME, _collection.name, e)
+                _collection_checked_at = time.monotonic()
+                return _collection
+            logger.error("Failed to get or create collection '%s': %s", COLLECTION_NAME, e)
+            # If it truly fails, raise HTTPException
+            raise HTTPException(status_code=500, detail=f"Could not get or create ChromaDB collection '{COLLECTION_NAME}'")
     return _collection
 
 # Data models
@@ -119,6 +207,8 @@ class QueryRequest(BaseModel):
     filters: Optional[Dict[str, Any]] = None
     top_k: int = Field(default=5, ge=1, le=200) # Allow requesting more docs for large contexts
     model_name: Optional[str] = None # Add optional model name
+    timeout: Optional[float] = Field(default=None, gt=0) # Seconds the client will wait (capped by QUERY_TIMEOUT_SECONDS)
+    session_id: Optional[str] = Field(default=None, pattern=SESSION_ID_PATTERN) # Conversation to continue (created on first use)
 
 class Source(BaseModel):
     id: str
@@ -127,6 +217,7 @@ class Source(BaseModel):
     date: Optional[str] = None # Make optional if data might be missing
     url: Optional[str] = None
     text_snippet: str
+    duplicate_of: Optional[str] = None # Set for near-duplicates (reprints) of a source used in the context
     # Add score or other relevance info if needed
     # score: Optional[float] = None 
 
@@ -136,6 +227,29 @@ class QueryResponse(BaseModel):
     query_time: float
     prompt_token_count: Optional[int] = None # Add field for token count
     answer_token_count: Optional[int] = None # Add field for answer token count
+    cached_token_count: Optional[int] = None # Prompt tokens served from the provider's prompt cache
+    timings: Optional[Dict[str, float]] = None # Stage durations in seconds (see /metrics)
+    session_id: Optional[str] = None # Echoed for conversation queries
+    session_turn: Optional[int] = None # Turns answered in the conversation, this one included
+
+class CompareRequest(BaseModel):
+    query: str
+    model_names: List[str] = Field(min_length=1, max_length=8) # Models answering the same retrieval
+    filters: Optional[Dict[str, Any]] = None
+    top_k: int = Field(default=5, ge=1, le=200)
+    timeout: Optional[float] = Field(default=None, gt=0) # Seconds the client will wait (capped by QUERY_TIMEOUT_SECONDS)
+
+class JobResponse(BaseModel):
+    id: str
+    status: str # queued, running, done, failed or cancelled
+    stage: Optional[str] = None # Pipeline stage reached (embed, search, ..., generation)
+    error: Optional[str] = None
+    attempts: int = 0 # Runs started (a job interrupted by a restart is run again)
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    expires_at: Optional[float] = None # The job and its result are deleted after this time
+    result: Optional[QueryResponse] = None
 
 class FilterInfo(BaseModel):
     min: Optional[str] = None
@@ -154,6 +268,119 @@ class ModelInfo(BaseModel):
 class ModelsResponse(BaseModel):
     models: List[ModelInfo]
 
+# Background indexing state, reported by /ready
+_indexing_status: Dict[str, Any] = {"state": "running" if INDEX_IN_BACKGROUND else "disabled", "progress": None, "error": None}
+_indexing_task: Optional[asyncio.Task] = None
+_stop_indexing = threading.Event()
+
+class IndexingCancelled(Exception):
+    pass
+
+def _on_indexing_progress(stats):
+    # Runs on the indexing thread after every batch; raising here aborts the run (progress is kept in the manifest)
+    _indexing_status["progress"] = asdict(stats)
+    if _stop_indexing.is_set():
+        raise IndexingCancelled("API shutting down")
+
+def _lock_indexing(lock_path: str) -> Tuple[Any, bool]:
+    """
+    Take the exclusive indexing lock shared by all API workers, waiting while another worker holds it.
+
+    Returns:
+        The open lock file (closing it releases the lock), or None if there is no input directory
+        to lock (check_and_index then skips indexing), and whether another worker held it
+    """
+    if not os.path.isdir(os.path.dirname(lock_path)):
+        return None, False
+    lock_file = open(lock_path, "a")
+    waited = False
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file, waited
+        except BlockingIOError:
+            if not waited:
+                logger.info("Background indexing runs in another worker, waiting for it (%s)", lock_path)
+                waited = True
+            # Poll rather than block, so that shutdown can interrupt the wait
+            if _stop_indexing.wait(1.0):
+                lock_file.close()
+                raise IndexingCancelled("API shutting down")
+
+async def _run_background_indexing():
+    from scripts.check_and_index import check_and_index, indexing_lock_path
+    try:
+        # With API_WORKERS > 1 every worker gets here; only the lock holder indexes
+        lock_file, waited = await asyncio.to_thread(_lock_indexing, indexing_lock_path())
+        try:
+            if waited:
+                stats = None
+            else:
+                stats = await asyncio.to_thread(check_and_index, _embedding_function,
+                                                progress_callback=_on_indexing_progress, show_progress=False)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        _indexing_status["state"] = "done" if stats is not None else "skipped"
+        logger.info("Background indexing %s", _indexing_status["state"])
+    except Exception as e:
+        _indexing_status["state"] = "failed"
+        _indexing_status["error"] = str(e)
+        logger.error("Background indexing failed: %s", e)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    global _indexing_task
+    # SIGUSR1 profiles the live process (see app/profiling.py)
+    install_signal_handler(_describe_memory)
+    if isinstance(_embedding_function, EmbeddingClient):
+        try:
+            info = await asyncio.to_thread(_embedding_function.info)
+            if info["model"] != EMBEDDING_MODEL_NAME:
+                logger.warning("The embedding server runs %s, not EMBEDDING_MODEL_NAME=%s", info["model"], EMBEDDING_MODEL_NAME)
+        except EmbeddingServerError as e:
+            # Queries get 503 until it is up; /ready reports it
+            logger.error("Embedding server not reachable at startup: %s", e)
+    # Preload local models so the first queries do not pay Ollama's model load time
+    await model_manager.start_background_tasks()
+    # Background /jobs workers (re-queues jobs interrupted by the last shutdown)
+    job_manager.runner = _run_query_job
+    await job_manager.start()
+    if INDEX_IN_BACKGROUND and _embedding_function is not None:
+        logger.info("Starting background indexing")
+        _indexing_task = asyncio.create_task(_run_background_indexing())
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await job_manager.stop()
+    await model_manager.stop_background_tasks()
+    if _indexing_task is not None and not _indexing_task.done():
+        # The indexing thread stops at the next batch; an interrupted run resumes incrementally
+        _stop_indexing.set()
+        await _indexing_task
+
+async def search_shards(shards, query_embedding, n_results: int, where_filter: Optional[Dict[str, Any]],
+                        filters: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Query the shards that can match the filters concurrently and merge their top
+    n_results by distance (each shard returns its own top n_results).
+    """
+    scheme, shard_collections = shards
+    keys = route_shards(scheme, shard_collections, filters)
+    trace.get_current_span().set_attribute("rag.shards", keys)
+    logger.debug("Searching %d/%d %s shards: %s", len(keys), len(shard_collections), scheme, keys)
+    results = await asyncio.gather(*(
+        asyncio.to_thread(
+            shard_collections[key].query,
+            query_embeddings=[query_embedding],
+            n_results=n_results,
+            where=where_filter,
+            include=["metadatas", "documents", "distances"]
+        )
+        for key in keys
+    ))
+    return merge_query_results(list(results), n_results)
+
 # Helper function to parse metadata lists safely
 def parse_json_metadata(metadata_str: Optional[str]) -> List[str]:
     if not metadata_str:
@@ -163,7 +390,7 @@ def parse_json_metadata(metadata_str: Optional[str]) -> List[str]:
         if isinstance(data, list):
             return [str(item) for item in data] # Ensure items are strings
     except json.JSONDecodeError:
-        logger.warning(f"Failed to decode JSON metadata: {metadata_str}")
+        logger.warning("Failed to decode JSON metadata: %s", metadata_str)
     return []
 
 # API endpoints
@@ -171,6 +398,24 @@ def parse_json_metadata(metadata_str: Optional[str]) -> List[str]:
 def read_root():
     return {"status": "ok", "message": "IWAC RAG API is running"}
 
+@app.get("/ready")
+def readiness():
+    """
+    Readiness check: 200 once startup indexing is finished (or disabled), 503 while it is
+    running or if it failed, or while the embedding server (if used) is unreachable. The
+    body reports indexing progress either way.
+    """
+    ready = _indexing_status["state"] in ("disabled", "skipped", "done")
+    collection_name = _collection.name if _collection is not None else None
+    content = {"ready": ready, "indexing": _indexing_status, "collection": collection_name}
+    if isinstance(_embedding_function, EmbeddingClient):
+        try:
+            content["embedding_server"] = _embedding_function.info()
+        except EmbeddingServerError as e:
+            content["embedding_server"] = {"error": str(e)}
+            content["ready"] = ready = False
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
 @app.get("/models", response_model=ModelsResponse)
 def get_available_models():
     """
@@ -180,121 +425,514 @@ def get_available_models():
         models = model_manager.get_available_models()
         return ModelsResponse(models=models)
     except Exception as e:
-        logger.error(f"Error retrieving available models: {e}")
+        logger.error("Error retrieving available models: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to retrieve available models: {str(e)}")
 
+def require_admin(authorization: Optional[str] = Header(None), x_admin_token: Optional[str] = Header(None)):
+    """Admin endpoints take ADMIN_TOKEN as a bearer token or in X-Admin-Token"""
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set)")
+    token = x_admin_token or (authorization[7:] if authorization and authorization.lower().startswith("bearer ") else "")
+    if not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def _describe_memory() -> Dict[str, Any]:
+    usage = model_manager.memory_usage()
+    usage["filters_cache_entries"] = len(_filters_cache)
+    usage["sessions"] = len(session_store)
+    usage["shards"] = len(_shards[1]) if _shards is not None else 0
+    return usage
+
+@app.post("/admin/profile", dependencies=[Depends(require_admin)])
+async def profile(seconds: Optional[float] = Query(None, gt=0, le=600, description="Profile for this many seconds"),
+                  queries: Optional[int] = Query(None, ge=1, le=1000, description="Profile until this many /query requests complete"),
+                  timeout: float = Query(300, gt=0, le=3600, description="Give up waiting for the queries after this many seconds"),
+                  interval_ms: float = Query(5, ge=1, le=1000, description="Sampling interval"),
+                  include_idle: bool = Query(False, description="Keep stacks of threads waiting for work"),
+                  memory: bool = Query(True, description="Trace allocations during the session (tracemalloc)"),
+                  top: int = Query(25, ge=1, le=200, description="Allocation sites reported"),
+                  format: str = Query("json", pattern="^(json|folded)$", description="json, or folded stacks as text/plain")):
+    """
+    Sample the stacks of the live process, for a number of seconds or for the next N /query
+    requests, and report them as folded stacks (flame graph input) with a memory snapshot
+    """
+    if (seconds is None) == (queries is None):
+        raise HTTPException(status_code=400, detail="Pass exactly one of 'seconds' or 'queries'")
+    try:
+        session = start_session(seconds=seconds, queries=queries, interval=interval_ms / 1000.0,
+                                include_idle=include_idle, trace_memory=memory)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if queries:
+        logger.info("Profiling %d queries (interval %sms)", queries, interval_ms)
+    else:
+        logger.info("Profiling %.0fs (interval %sms)", seconds, interval_ms)
+    try:
+        if queries:
+            await asyncio.to_thread(session.done.wait, timeout)
+        else:
+            await asyncio.sleep(seconds)
+    finally:
+        # Snapshotting tracemalloc can take a while; keep it off the event loop
+        result = await asyncio.to_thread(end_session, session, _describe_memory, top)
+    if format == "folded":
+        return PlainTextResponse(result["folded"] + "\n")
+    return result
+
+@app.get("/metrics")
+def metrics():
+    """
+    Prometheus metrics: per-stage /query latency histograms, retrieval/context counters
+    and provider errors (labelled by model and provider), and cache lookups
+    """
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def _record_query_metrics(model: str, provider: str, timings: StageTimings, query_time: float, retrieved_chunks: int,
+                          response_result=None):
+    observe_stages(timings.stages, model, provider)
+    QUERY_SECONDS.labels(model, provider).observe(query_time)
+    RETRIEVED_CHUNKS.labels(model, provider).inc(retrieved_chunks)
+    if response_result is not None:
+        CANDIDATE_ARTICLES.labels(model, provider).inc(response_result.candidate_count)
+        CONTEXT_TOKENS.labels(model, provider).inc(response_result.context_tokens)
+        if response_result.skipped_article_ids:
+            CONTEXT_TRUNCATIONS.labels(model, provider).inc()
+        if response_result.generation.cached_tokens:
+            PROMPT_CACHED_TOKENS.labels(model, provider).inc(response_result.generation.cached_tokens)
+
 @app.post("/query", response_model=QueryResponse)
-async def query(request: QueryRequest, collection: chromadb.Collection = Depends(get_collection)):
-    start_time = datetime.now()
-    logger.info(f"Received query: '{request.query}' with filters: {request.filters} and model: {request.model_name}")
-    
+async def query(request: QueryRequest, http_request: Request, collection: chromadb.Collection = Depends(get_collection)):
+    """
+    Answer a question from the retrieved articles. The work is abandoned, and the provider
+    call cancelled, as soon as the client disconnects or the request's deadline passes.
+    """
+    timeouts = [t for t in (QUERY_TIMEOUT_SECONDS, request.timeout) if t]
+    deadline = Deadline(min(timeouts) if timeouts else None)
     try:
-        # Prepare filters for ChromaDB query
-        # ChromaDB `where` clause expects specific format
-        where_filter = None
-        if request.filters:
-            # Basic validation/transformation can be added here
-            # Example: ensure date format, handle specific operators
-            # For simplicity, assuming filters match metadata structure directly for now
-            # except for special keys like date_range, locations, subjects
-            chroma_filters = {}
-            for key, value in request.filters.items():
-                 if key == "date_range" and isinstance(value, dict):
-                     date_conditions = {}
-                     if value.get("from"): date_conditions["$gte"] = value["from"]
-                     if value.get("to"): date_conditions["$lte"] = value["to"]
-                     if date_conditions: chroma_filters["date"] = date_conditions
-                 elif key in ["locations", "subjects"] and isinstance(value, list) and value:
-                     # Basic implementation: Check if metadata contains ANY of the provided values
-                     # ChromaDB's $contains operator works on top-level string fields, not nested JSON strings directly.
-                     # We store lists as JSON strings. For filtering, you might need:
-                     # 1. Store tags differently (e.g., multiple entries per chunk with a single tag)
-                     # 2. Perform filtering *after* retrieval (less efficient)
-                     # 3. Use a DB that better supports array contains on stringified JSON (or store natively)
-                     # For now, we'll skip filtering by locations/subjects in the DB query due to json.dumps
-                     logger.warning(f"Filtering by '{key}' is currently not directly supported in DB query due to metadata format.")
-                     pass
-                 elif value: # Add other direct equality filters
-                     chroma_filters[key] = value
-            
-            if chroma_filters:
-                 where_filter = chroma_filters # Use directly if using simple equality/range
-                 # If complex logic ($and, $or) is needed, construct it here
-                 # where_filter = {"$and": [...]}
+        return await run_with_deadline(_answer_query(request, collection, deadline), deadline, http_request.receive)
+    except (ClientDisconnected, DeadlineExceeded) as e:
+        disconnected = isinstance(e, ClientDisconnected)
+        _record_cancelled(request.model_name, "disconnect" if disconnected else "deadline", deadline.stage, e)
+        if disconnected:
+            # Nobody reads this; 499 is the conventional "client closed request" status
+            return Response(status_code=499)
+        raise HTTPException(status_code=504, detail=f"The query did not complete in time ({e})")
+
+_compare_slots: Dict[str, asyncio.Semaphore] = {}
+
+@app.post("/query/compare")
+async def compare_models(request: CompareRequest, collection: chromadb.Collection = Depends(get_collection)):
+    """
+    Answer one question with several models over a single retrieval. The query is embedded
+    and searched once (for the largest retrieval any of the models needs); ranked articles
+    and token counts are shared between the models, and each model's context is packed for
+    its own window. Generations run concurrently, at most COMPARE_PROVIDER_CONCURRENCY per
+    provider, and the answers are streamed as NDJSON lines in the order they finish.
+    """
+    model_ids = list(dict.fromkeys(request.model_names))
+    unknown = [model_id for model_id in model_ids if model_manager.get_model_config(model_id) is None]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown models: {', '.join(unknown)}")
+    start_time = time.perf_counter()
+    timeouts = [t for t in (QUERY_TIMEOUT_SECONDS, request.timeout) if t]
+    deadline_seconds = min(timeouts) if timeouts else None
+    deadline = Deadline(deadline_seconds)
+    # One deadline per model as well, so each reports the stage it was in
+    deadlines = {model_id: Deadline(deadline_seconds) for model_id in model_ids}
+    timings = StageTimings()
+    logger.info("Received comparison (%d chars) of %s with filters: %s", len(request.query), model_ids, request.filters)
+    trace.get_current_span().set_attribute("rag.models", model_ids)
+
+    where_filter = _build_where_filter(request.filters)
+    sizes = {model_id: _retrieval_size(request.top_k, model_id, model_manager.get_model_config(model_id)) for model_id in model_ids}
+    try:
+        query_embedding, results = await run_with_deadline(
+            _retrieve(request.query, collection, max(sizes.values()), where_filter, request.filters, timings, deadline), deadline)
+    except DeadlineExceeded as e:
+        raise HTTPException(status_code=504, detail=f"The query did not complete in time ({e})")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Retrieval failed during comparison: %s", e)
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
+    sources, retrieved_metadata = _collect_sources(results)
+    documents = results["documents"][0] if sources else []
+    shared = SharedContext()
+
+    async def answer(model_id: str, model_deadline: Deadline) -> QueryResponse:
+        provider_name = model_manager.get_model_config(model_id).get("provider", "unknown")
+        # Chunks are ranked by distance, so a model needing fewer takes the top of the shared list
+        n_results = sizes[model_id]
+        model_timings = StageTimings()
+        for stage, seconds in timings.stages.items():
+            model_timings.add(stage, seconds)
+        if not sources:
+            query_time = time.perf_counter() - start_time
+            _record_query_metrics(model_id, provider_name, model_timings, query_time, 0)
+            return QueryResponse(answer="I could not find relevant information for your query.", sources=[],
+                                 query_time=query_time, timings=model_timings.stages)
+        slots = _compare_slots.setdefault(provider_name, asyncio.Semaphore(COMPARE_PROVIDER_CONCURRENCY))
+        with model_timings.stage("provider_queue"):
+            await slots.acquire()
+        try:
+            response_result = await model_manager.generate_response(
+                user_query=request.query,
+                retrieved_metadata=retrieved_metadata[:n_results],
+                model_id=model_id,
+                retrieved_documents=documents[:n_results],
+                query_embedding=query_embedding,
+                deadline=model_deadline,
+                shared=shared
+            )
+        finally:
+            slots.release()
+        query_time = time.perf_counter() - start_time
+        for stage, seconds in response_result.timings.items():
+            model_timings.add(stage, seconds)
+        _record_query_metrics(model_id, provider_name, model_timings, query_time, len(retrieved_metadata[:n_results]), response_result)
+        logger.info("Comparison answer from %s in %.2f seconds.", model_id, query_time,
+                    extra={"model": model_id, "provider": provider_name, "query_time": query_time, "timings": model_timings.stages,
+                           "retrieved_chunks": len(retrieved_metadata[:n_results]), "used_articles": len(response_result.used_article_ids),
+                           "prompt_tokens": response_result.prompt_token_count, "answer_tokens": response_result.answer_token_count})
+        return QueryResponse(
+            answer=response_result.generation.text or "No answer generated.",
+            sources=_used_sources(sources, response_result),
+            query_time=query_time,
+            prompt_token_count=response_result.prompt_token_count,
+            answer_token_count=response_result.answer_token_count,
+            cached_token_count=response_result.generation.cached_tokens,
+            timings=model_timings.stages
+        )
+
+    async def stream():
+        yield json.dumps({"event": "retrieval", "models": model_ids, "retrieved_chunks": len(retrieved_metadata),
+                          "timings": timings.stages}) + "\n"
+        tasks = {asyncio.ensure_future(run_with_deadline(answer(model_id, deadlines[model_id]), deadlines[model_id])): model_id
+                 for model_id in model_ids}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    model_id = tasks[task]
+                    try:
+                        line = {"event": "answer", "model": model_id, "result": task.result().model_dump()}
+                    except DeadlineExceeded as e:
+                        _record_cancelled(model_id, "deadline", deadlines[model_id].stage, e)
+                        line = {"event": "error", "model": model_id, "status": 504, "error": str(e)}
+                    except EmbeddingServerError as e:
+                        logger.error("Comparison answer from %s failed: %s", model_id, e)
+                        line = {"event": "error", "model": model_id, "status": 503, "error": "Embedding server unavailable"}
+                    except Exception as e:
+                        logger.error("Comparison answer from %s failed: %s", model_id, e)
+                        line = {"event": "error", "model": model_id, "status": 500, "error": f"Error generating response: {e}"}
+                    yield json.dumps(line) + "\n"
+            yield json.dumps({"event": "done", "query_time": time.perf_counter() - start_time}) + "\n"
+        finally:
+            # Client gone: stop the generations still running (closing their provider connections)
+            for task in pending:
+                task.cancel()
+                _record_cancelled(tasks[task], "disconnect", deadlines[tasks[task]].stage, ClientDisconnected("Client disconnected"))
 
-        logger.info(f"Constructed ChromaDB where_filter: {where_filter}")
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def _record_cancelled(model_id: Optional[str], reason: str, stage: str, error: BaseException):
+    model_id = model_id or model_manager.default_model_id
+    provider_name = (model_manager.get_model_config(model_id) or {}).get("provider", "unknown")
+    QUERIES_CANCELLED.labels(reason, stage, model_id, provider_name).inc()
+    logger.info("Query abandoned (%s): %s", reason, error, extra={"model": model_id, "provider": provider_name, "stage": stage})
+
+async def _run_query_job(request_data: Dict[str, Any], deadline: Deadline) -> Dict[str, Any]:
+    """Job runner (see app/jobs.py): the /query pipeline, without a client connection to watch"""
+    request = QueryRequest(**request_data)
+    try:
+        collection = await asyncio.to_thread(get_collection)
+        response = await run_with_deadline(_answer_query(request, collection, deadline), deadline)
+    except DeadlineExceeded as e:
+        _record_cancelled(request.model_name, "deadline", deadline.stage, e)
+        raise
+    except asyncio.CancelledError as e:
+        # Cancelled through DELETE /jobs/{id}, or interrupted by a shutdown
+        _record_cancelled(request.model_name, "cancelled", deadline.stage, e)
+        raise
+    return response.model_dump()
+
+@app.delete("/sessions/{session_id}", status_code=204)
+def delete_session(session_id: str):
+    """Forget a conversation (its article set and turns); the next query with this ID starts afresh"""
+    if not session_store.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"Session {session_id} not found (unknown or expired)")
+    return Response(status_code=204)
+
+@app.post("/jobs", response_model=JobResponse, status_code=202)
+async def submit_job(request: QueryRequest):
+    """
+    Queue a query and return its job at once. Poll GET /jobs/{id}, or follow
+    GET /jobs/{id}/events, for its progress and result.
+    """
+    try:
+        return await job_manager.submit(request.model_dump())
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=f"Too many queued jobs ({e}); retry later", headers={"Retry-After": "30"})
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found (unknown or expired)")
+    return job
+
+@app.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str):
+    """
+    Cancel a queued or running job; the provider call of a running job is cancelled too.
+    Answers 202 with the job still running when it runs on another API worker that has not
+    recorded the cancellation yet (it will at its next heartbeat).
+    """
+    job = await job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found (unknown or expired)")
+    if job["status"] not in TERMINAL_STATUSES:
+        return JSONResponse(status_code=202, content=JobResponse(**job).model_dump())
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """
+    Server-sent events for a job: one event (named after the status) with the job each time
+    its status or stage changes, ending with the final one, which carries the result. The
+    stream is closed by Starlette when the client disconnects; the job keeps running.
+    """
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found (unknown or expired)")
+
+    async def events():
+        current, last = job, None
+        while current is not None:
+            if (current["status"], current["stage"]) != last:
+                last = (current["status"], current["stage"])
+                payload = JobResponse(**current).model_dump_json()
+                yield f"event: {current['status']}\ndata: {payload}\n\n"
+            if current["status"] in TERMINAL_STATUSES:
+                return
+            if not await job_manager.wait_for_change(job_id, JOB_EVENTS_KEEPALIVE_SECONDS):
+                # Comment line; keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            current = await job_manager.get(job_id)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def _build_where_filter(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """ChromaDB `where` clause for the request filters"""
+    # Prepare filters for ChromaDB query
+    # ChromaDB `where` clause expects specific format
+    where_filter = None
+    if filters:
+        # Basic validation/transformation can be added here
+        # Example: ensure date format, handle specific operators
+        # For simplicity, assuming filters match metadata structure directly for now
+        # except for special keys like date_range, locations, subjects
+        chroma_filters = {}
+        for key, value in filters.items():
+             if key == "date_range" and isinstance(value, dict):
+                 date_conditions = {}
+                 if value.get("from"): date_conditions["$gte"] = value["from"]
+                 if value.get("to"): date_conditions["$lte"] = value["to"]
+                 if date_conditions: chroma_filters["date"] = date_conditions
+             elif key in ["locations", "subjects"] and isinstance(value, list) and value:
+                 # Basic implementation: Check if metadata contains ANY of the provided values
+                 # ChromaDB's $contains operator works on top-level string fields, not nested JSON strings directly.
+                 # We store lists as JSON strings. For filtering, you might need:
+                 # 1. Store tags differently (e.g., multiple entries per chunk with a single tag)
+                 # 2. Perform filtering *after* retrieval (less efficient)
+                 # 3. Use a DB that better supports array contains on stringified JSON (or store natively)
+                 # For now, we'll skip filtering by locations/subjects in the DB query due to json.dumps
+                 logger.warning("Filtering by '%s' is currently not directly supported in DB query due to metadata format.", key)
+                 pass
+             elif value: # Add other direct equality filters
+                 chroma_filters[key] = value
         
-        # Determine the number of results to fetch dynamically based on model context window
-        n_results = request.top_k
-        selected_model_id = request.model_name or model_manager.default_model_id
-        model_config = model_manager.get_model_config(selected_model_id)
+        if chroma_filters:
+             where_filter = chroma_filters # Use directly if using simple equality/range
+             # If complex logic ($and, $or) is needed, construct it here
+             # where_filter = {"$and": [...]}
+
+    logger.debug("Constructed ChromaDB where_filter: %s", where_filter)
+    return where_filter
 
-        if model_config:
-            context_window = model_config.get("context_window", 0)
-            LARGE_CONTEXT_THRESHOLD = 100000  # 100k tokens threshold for large context
-            # Increase n_results significantly for large context models
-            ADJUSTED_K_FOR_LARGE_CONTEXT = 200 
-
-            if context_window >= LARGE_CONTEXT_THRESHOLD:
-                # Check if user requested a low k, if so, use the adjusted high k
-                if request.top_k <= 10: # Or some other threshold indicating user didn't specifically ask for many
-                    n_results = ADJUSTED_K_FOR_LARGE_CONTEXT
-                    logger.info(f"Model {selected_model_id} has large context ({context_window}). Adjusting retrieval to {n_results} documents as requested k ({request.top_k}) was low.")
-                else:
-                    # If user asked for more than 10, respect their request (up to a reasonable limit if needed)
-                    n_results = request.top_k 
-                    logger.info(f"Using user-requested top_k={request.top_k} for large context model {selected_model_id}.")
+def _retrieval_size(top_k: int, model_id: str, model_config: Optional[Dict[str, Any]]) -> int:
+    """Number of chunks to retrieve for a model"""
+    # Determine the number of results to fetch dynamically based on model context window
+    n_results = top_k
+    if model_config:
+        context_window = model_config.get("context_window", 0)
+        LARGE_CONTEXT_THRESHOLD = 100000  # 100k tokens threshold for large context
+        # Increase n_results significantly for large context models
+        ADJUSTED_K_FOR_LARGE_CONTEXT = 200 
+
+        if context_window >= LARGE_CONTEXT_THRESHOLD:
+            # Check if user requested a low k, if so, use the adjusted high k
+            if top_k <= 10: # Or some other threshold indicating user didn't specifically ask for many
+                n_results = ADJUSTED_K_FOR_LARGE_CONTEXT
+                logger.debug("Model %s has large context (%d). Adjusting retrieval to %d documents as requested k (%d) was low.", model_id, context_window, n_results, top_k)
             else:
-                # Use user's requested k or default if context isn't large
-                n_results = request.top_k
-                logger.info(f"Using requested/default top_k={request.top_k} for model {selected_model_id} (context: {context_window}).")
+                # If user asked for more than 10, respect their request (up to a reasonable limit if needed)
+                n_results = top_k 
+                logger.debug("Using user-requested top_k=%d for large context model %s.", top_k, model_id)
         else:
-            logger.warning(f"Could not find config for model {selected_model_id}. Using requested top_k={request.top_k}.")
+            # Use user's requested k or default if context isn't large
+            n_results = top_k
+            logger.debug("Using requested/default top_k=%d for model %s (context: %d).", top_k, model_id, context_window)
+    else:
+        logger.warning("Could not find config for model %s. Using requested top_k=%d.", model_id, top_k)
+    return n_results
+
+async def _retrieve(query_text: str, collection: chromadb.Collection, n_results: int, where_filter: Optional[Dict[str, Any]],
+                    filters: Optional[Dict[str, Any]], timings: StageTimings, deadline: Deadline):
+    """Embed the query and run the vector search; returns the query embedding and the ChromaDB results"""
+    # Embed the query once; the vector is reused for retrieval and context compression
+    deadline.enter("embed")
+    with timings.stage("embed"), tracer.start_as_current_span("embed_query") as span:
+        span.set_attribute("rag.embedding_model", EMBEDDING_MODEL_NAME)
+        try:
+            # Off the event loop: with the embedding server, this waits for a batch shared with other workers
+            query_embedding = (await asyncio.to_thread(get_embedding_function(), [query_text]))[0]
+        except EmbeddingServerError as e:
+            logger.error("Query embedding failed: %s", e)
+            raise HTTPException(status_code=503, detail="Embedding server unavailable")
+
+    logger.debug("Starting ChromaDB query with n_results: %d...", n_results)
+    shards = _shards
+    deadline.enter("search")
+    with timings.stage("search"), tracer.start_as_current_span("collection.query") as span:
+        span.set_attribute("rag.collection", collection.name)
+        span.set_attribute("rag.n_results", n_results)
+        span.set_attribute("rag.where", json.dumps(where_filter) if where_filter else "")
+        if shards is None:
+            # Off the event loop, so other requests (and disconnect detection) proceed meanwhile
+            results = await asyncio.to_thread(
+                collection.query,
+                query_embeddings=[query_embedding],
+                n_results=n_results, # Use the determined n_results
+                where=where_filter,
+                # include=["metadatas", "documents", "distances"] # Include distances for relevance score
+                include=["metadatas", "documents"] 
+            )
+        else:
+            results = await search_shards(shards, query_embedding, n_results, where_filter, filters)
+        span.set_attribute("rag.retrieved_chunks", len(results["ids"][0]) if results and results["ids"] else 0)
+    logger.debug("ChromaDB query completed. Retrieved %d chunks.", len(results['ids'][0]) if results and results['ids'] else 0)
+    return query_embedding, results
+
+def _collect_sources(results: Dict[str, Any]) -> Tuple[List[Source], List[Dict[str, Any]]]:
+    """Source snippets and metadata of the retrieved chunks, in rank order"""
+    # Process results - NOW focusing on getting unique relevant article IDs
+    # contexts = [] # No longer collecting chunk text here
+    sources = [] # Still collect source snippets for display
+    retrieved_metadata = [] # Collect metadata from retrieved chunks
+
+    if results and results["ids"] and results["ids"][0]:
+        # logger.info(f"Retrieved {len(results['ids'][0])} chunks from ChromaDB.") # Already logged above
+        for doc_text, metadata, doc_id in zip(
+            results["documents"][0],
+            results["metadatas"][0],
+            results["ids"][0]
+        ):
+            # Store metadata for context building later
+            retrieved_metadata.append(metadata)
+
+            # Use the chunk document text for the source snippet
+            sources.append(Source(
+                id=metadata.get("article_id", doc_id), # Fallback to chunk id if article_id missing
+                title=metadata.get("title", "No Title"),
+                newspaper=metadata.get("newspaper"),
+                date=metadata.get("date"),
+                # url=metadata.get("url"), # Reverted: No need for external URL
+                text_snippet=doc_text[:500] + "..." if len(doc_text) > 500 else doc_text # Snippet from chunk
+            ))
+    return sources, retrieved_metadata
+
+def _used_sources(sources: List[Source], response_result) -> List[Source]:
+    """Sources of the articles packed into the context (a ModelManager ResponseResult)"""
+    # Filter sources to include only those whose articles were actually used,
+    # each followed by the near-duplicates it stood in for
+    final_sources = []
+    added_source_ids = set()
+    if response_result.used_article_ids:
+        first_source_by_article = {}
+        for source in sources: # Iterate through original sources (derived from chunks)
+            first_source_by_article.setdefault(source.id, source) # source.id holds the article_id
+        for source in sources:
+            article_id = source.id
+            if article_id in response_result.used_article_ids and article_id not in added_source_ids:
+                final_sources.append(source)
+                added_source_ids.add(article_id)
+                for duplicate_id in response_result.duplicate_article_ids.get(article_id, []):
+                    duplicate_source = first_source_by_article.get(duplicate_id)
+                    if duplicate_source and duplicate_id not in added_source_ids:
+                        final_sources.append(duplicate_source.model_copy(update={"duplicate_of": article_id}))
+                        added_source_ids.add(duplicate_id)
+    else:
+        logger.warning("No specific article IDs were reported as used for context.")
+        # Optionally decide what to show if no articles were used - maybe none?
+        # Or show the original top sources as a fallback?
+        # For now, let's return an empty list if used_article_ids is empty
+        final_sources = []
+
+    return final_sources
+
+async def _answer_query(request: QueryRequest, collection: chromadb.Collection, deadline: Deadline) -> QueryResponse:
+    if not request.session_id:
+        return await _answer_turn(request, collection, deadline, None)
+    session = session_store.get_or_create(request.session_id, request.filters)
+    async with session.lock:
+        session.use_filters(request.filters)
+        return await _answer_turn(request, collection, deadline, session)
+
+async def _answer_turn(request: QueryRequest, collection: chromadb.Collection, deadline: Deadline, session: Optional[Session]) -> QueryResponse:
+    start_time = time.perf_counter()
+    timings = StageTimings()
+    logger.info("Received query (%d chars) with filters: %s and model: %s", len(request.query), request.filters, request.model_name)
+    logger.debug("Query text: %r", request.query)
+    
+    try:
+        where_filter = _build_where_filter(request.filters)
         
-        logger.info(f"Starting ChromaDB query with n_results: {n_results}...")
-        results = collection.query(
-            query_texts=[request.query],
-            n_results=n_results, # Use the determined n_results
-            where=where_filter,
-            # include=["metadatas", "documents", "distances"] # Include distances for relevance score
-            include=["metadatas", "documents"] 
-        )
-        logger.info(f"ChromaDB query completed. Retrieved {len(results['ids'][0]) if results and results['ids'] else 0} chunks.")
+        selected_model_id = request.model_name or model_manager.default_model_id
+        model_config = model_manager.get_model_config(selected_model_id)
+        n_results = _retrieval_size(request.top_k, selected_model_id, model_config)
+        if session is not None and session.is_follow_up:
+            # Follow-ups draw on the conversation's article set, extended with the top_k best new chunks
+            n_results = request.top_k
+        provider_name = (model_config or {}).get("provider", "unknown")
+        request_span = trace.get_current_span()
+        request_span.set_attribute("rag.model", selected_model_id)
+        request_span.set_attribute("rag.provider", provider_name)
         
-        # Process results - NOW focusing on getting unique relevant article IDs
-        # contexts = [] # No longer collecting chunk text here
-        sources = [] # Still collect source snippets for display
-        retrieved_metadata = [] # Collect metadata from retrieved chunks
-
-        if results and results["ids"] and results["ids"][0]:
-            # logger.info(f"Retrieved {len(results['ids'][0])} chunks from ChromaDB.") # Already logged above
-            for doc_text, metadata, doc_id in zip(
-                results["documents"][0],
-                results["metadatas"][0],
-                results["ids"][0]
-            ):
-                # Store metadata for context building later
-                retrieved_metadata.append(metadata)
-
-                # Use the chunk document text for the source snippet
-                sources.append(Source(
-                    id=metadata.get("article_id", doc_id), # Fallback to chunk id if article_id missing
-                    title=metadata.get("title", "No Title"),
-                    newspaper=metadata.get("newspaper"),
-                    date=metadata.get("date"),
-                    # url=metadata.get("url"), # Reverted: No need for external URL
-                    text_snippet=doc_text[:500] + "..." if len(doc_text) > 500 else doc_text # Snippet from chunk
-                ))
-        else:
+        query_embedding, results = await _retrieve(request.query, collection, n_results, where_filter, request.filters, timings, deadline)
+        if session is not None:
+            new_chunks = session.extend(results)
+            logger.debug("Session %s turn %d: %d new chunks, %d in the article set", session.id, session.turn_count + 1, new_chunks, len(session.chunk_ids))
+            results = session.as_results()
+        sources, retrieved_metadata = _collect_sources(results)
+
+        if not sources:
             logger.warning("No results found in ChromaDB for the query.")
             # Handle case with no results - return empty answer or specific message?
-            query_time = (datetime.now() - start_time).total_seconds()
+            query_time = time.perf_counter() - start_time
+            _record_query_metrics(selected_model_id, provider_name, timings, query_time, 0)
             return QueryResponse(
                 answer="I could not find relevant information for your query.",
                 sources=[],
                 query_time=query_time,
                 prompt_token_count=None,
-                answer_token_count=None
+                answer_token_count=None,
+                timings=timings.stages,
+                session_id=session.id if session is not None else None,
+                session_turn=session.turn_count if session is not None else None
             )
 
         # context_text = "\n\n---\n\n".join(contexts) # Removed - context built differently now
@@ -303,63 +941,73 @@ async def query(request: QueryRequest, collection: chromadb.Collection = Depends
         # logger.info(f"Sending {len(contexts)} context chunks to LLM for query: '{request.query}'")
         # for i, ctx in enumerate(contexts):
         #     logger.info(f"Context chunk {i+1}: {ctx[:300]}{'...' if len(ctx) > 300 else ''}")
-        logger.info(f"Preparing LLM request. Passing metadata for {len(retrieved_metadata)} retrieved chunks to ModelManager for query: '{request.query}'")
+        logger.debug("Preparing LLM request. Passing metadata for %d retrieved chunks to ModelManager.", len(retrieved_metadata))
 
         # === LLM Call Logic using our new ModelManager ===
         try:
             # Note: Prompt construction is now handled inside ModelManager
             # Pass the raw query and RETRIEVED METADATA instead of chunk text
             
-            logger.info(f"Calling ModelManager.generate_response with model '{request.model_name or model_manager.default_model_id}'...")
-            # Generate response using ModelManager - unpack token counts
-            answer, used_article_ids, prompt_tokens, answer_tokens = await model_manager.generate_response(
+            logger.debug("Calling ModelManager.generate_response with model '%s'...", selected_model_id)
+            # Generate response using ModelManager
+            response_result = await model_manager.generate_response(
                 user_query=request.query,
                 retrieved_metadata=retrieved_metadata,
-                model_id=request.model_name
+                model_id=request.model_name,
+                retrieved_documents=results["documents"][0],
+                query_embedding=query_embedding,
+                deadline=deadline,
+                # Conversations reuse token counts across turns, see earlier answers, and keep their context prefix
+                shared=SharedContext(session.token_counts) if session is not None else None,
+                history=list(session.turns) if session is not None else None,
+                pinned_article_ids=session.packed_article_ids if session is not None else None
             )
-            logger.info(f"LLM response generated successfully by ModelManager.")
-            logger.info(f"Actual articles used for context: {used_article_ids}")
-            logger.info(f"Prompt token count: {prompt_tokens}") # Log the token count
-            logger.info(f"Answer token count: {answer_tokens}") # Log the token count
-
-            # Filter sources to include only those whose articles were actually used
-            final_sources = []
-            added_source_ids = set()
-            if used_article_ids:
-                for source in sources: # Iterate through original sources (derived from chunks)
-                    # Use the article_id from the source object
-                    article_id = source.id # Assuming source.id holds the article_id
-                    if article_id in used_article_ids and article_id not in added_source_ids:
-                        final_sources.append(source)
-                        added_source_ids.add(article_id)
-            else:
-                logger.warning("No specific article IDs were reported as used for context.")
-                # Optionally decide what to show if no articles were used - maybe none?
-                # Or show the original top sources as a fallback?
-                # For now, let's return an empty list if used_article_ids is empty
-                final_sources = []
+            generation = response_result.generation
+            used_article_ids = response_result.used_article_ids
+            prompt_tokens = response_result.prompt_token_count
+            answer_tokens = response_result.answer_token_count
+            logger.debug("Articles used for context: %s", used_article_ids)
+
+            final_sources = _used_sources(sources, response_result)
+            if session is not None:
+                session.record_turn(request.query, generation.text, used_article_ids)
 
+        except DeadlineExceeded:
+            raise
+        except EmbeddingServerError as e:
+            logger.error("Full articles unavailable: %s", e)
+            raise HTTPException(status_code=503, detail="Embedding server unavailable")
         except Exception as e:
-            logger.error(f"Error during LLM response generation via ModelManager: {e}")
+            logger.error("Error during LLM response generation via ModelManager: %s", e)
             raise HTTPException(status_code=500, detail=f"Error generating response: {e}")
 
         # Calculate query time
-        query_time = (datetime.now() - start_time).total_seconds()
-        logger.info(f"Query processed successfully in {query_time:.2f} seconds.")
+        query_time = time.perf_counter() - start_time
+        for stage, seconds in response_result.timings.items():
+            timings.add(stage, seconds)
+        _record_query_metrics(selected_model_id, provider_name, timings, query_time, len(retrieved_metadata), response_result)
+        logger.info("Query processed successfully in %.2f seconds.", query_time,
+                    extra={"model": selected_model_id, "provider": provider_name, "query_time": query_time, "timings": timings.stages,
+                           "retrieved_chunks": len(retrieved_metadata), "used_articles": len(used_article_ids),
+                           "prompt_tokens": prompt_tokens, "answer_tokens": answer_tokens})
         
         return QueryResponse(
-            answer=answer or "No answer generated.", # Fallback answer
+            answer=generation.text or "No answer generated.", # Fallback answer
             sources=final_sources,
             query_time=query_time,
             prompt_token_count=prompt_tokens, # Include token count in response
-            answer_token_count=answer_tokens # Include answer token count in response
+            answer_token_count=answer_tokens, # Include answer token count in response
+            cached_token_count=generation.cached_tokens,
+            timings=timings.stages,
+            session_id=session.id if session is not None else None,
+            session_turn=session.turn_count if session is not None else None
         )
     
-    except HTTPException as http_exc:
-        # Re-raise HTTPExceptions directly
-        raise http_exc
+    except (HTTPException, DeadlineExceeded):
+        # Re-raise HTTPExceptions (and deadlines, answered by the endpoint) directly
+        raise
     except Exception as e:
-        logger.exception(f"Unexpected error during query processing: {e}") # Log full traceback
+        logger.exception("Unexpected error during query processing: %s", e) # Log full traceback
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {e}")
 
 @app.get("/filters", response_model=AvailableFilters)
@@ -367,17 +1015,26 @@ def get_available_filters(collection: chromadb.Collection = Depends(get_collecti
     """
     Get available filter options from the metadata in the ChromaDB collection
     """
+    cached = _filters_cache.get(collection.name)
+    if cached is not None and time.monotonic() - cached[0] < FILTERS_CACHE_SECONDS:
+        _filters_cache_lookups["hits"] += 1
+        return cached[1]
+    _filters_cache_lookups["misses"] += 1
     try:
+        # A sharded collection holds no chunks itself: read its shards instead
+        sources = list(_shards[1].values()) if _shards is not None else [collection]
         # Log the current number of documents in the collection
-        count = collection.count()
-        logger.info(f"Fetching filters. Collection '{collection.name}' currently contains {count} documents.")
+        count = sum(source.count() for source in sources)
+        logger.info("Fetching filters. Collection '%s' currently contains %d documents.", collection.name, count)
 
         # Retrieve a sample of metadata to determine available filters
         # Note: collection.get() without IDs/where might be inefficient for large collections
         # Consider optimizing if performance becomes an issue (e.g., dedicated metadata store or sampling)
         # Fetching *all* metadata might be too slow/memory intensive
         # Let's fetch a reasonable number of documents to get a representative sample
-        metadata_sample = collection.get(limit=20000, include=["metadatas"]) # Increase limit to cover all documents
+        metadata_sample = {"metadatas": []}
+        for source in sources:
+            metadata_sample["metadatas"].extend(source.get(limit=20000, include=["metadatas"])["metadatas"]) # Increase limit to cover all documents
 
         if not metadata_sample or not metadata_sample.get("metadatas"):
             logger.warning("No metadata found in collection to generate filters.")
@@ -438,20 +1095,22 @@ def get_available_filters(collection: chromadb.Collection = Depends(get_collecti
 
         # Log if any invalid date formats were skipped
         if invalid_date_formats_found:
-            logger.warning(f"Skipped the following non 'YYYY-MM-DD' date formats found in metadata: {list(invalid_date_formats_found)}")
+            logger.warning("Skipped the following non 'YYYY-MM-DD' date formats found in metadata: %s", list(invalid_date_formats_found))
 
-        logger.info(f"Returning {len(sorted_newspapers)} newspapers, {len(sorted_locations)} locations, {len(sorted_subjects)} subjects.")
-        logger.info(f"Date range derived from valid dates: {min_date} to {max_date}")
+        logger.info("Returning %d newspapers, %d locations, %d subjects.", len(sorted_newspapers), len(sorted_locations), len(sorted_subjects))
+        logger.info("Date range derived from valid dates: %s to %s", min_date, max_date)
 
-        return AvailableFilters(
+        filters = AvailableFilters(
             newspapers=sorted_newspapers,
             locations=sorted_locations,
             subjects=sorted_subjects,
             date_range=FilterInfo(min=min_date, max=max_date)
         )
+        _filters_cache[collection.name] = (time.monotonic(), filters)
+        return filters
 
     except Exception as e:
-        logger.error(f"Error retrieving filters: {e}", exc_info=True) # Log traceback
+        logger.error("Error retrieving filters: %s", e, exc_info=True) # Log traceback
         raise HTTPException(status_code=500, detail=f"Failed to retrieve filters: {str(e)}")
 
 # === Check and Index on Startup (Optional) ===
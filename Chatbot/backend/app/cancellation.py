@@ -0,0 +1,135 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Seconds a /query may run before it is abandoned (0 = no deadline); requests can ask for less
+QUERY_TIMEOUT_SECONDS = float(os.getenv("QUERY_TIMEOUT_SECONDS", "180"))
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time"""
+
+
+class ClientDisconnected(Exception):
+    """The client went away before the response was ready"""
+
+
+class Deadline:
+    """
+    Point in time by which a request must be answered, and the pipeline stage it has
+    reached (so abandoned requests can be reported by stage).
+    """
+    def __init__(self, seconds: Optional[float], on_enter: Optional[Callable[[str], None]] = None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.stage = "start"
+        # Called with each stage name as it starts (progress of background jobs)
+        self.on_enter = on_enter
+        # Set when the request is abandoned, so work running in a thread stops early
+        self.cancelled = False
+
+    def remaining(self) -> Optional[float]:
+        """Seconds left, or None without a deadline"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def enter(self, stage: str):
+        """
+        Mark the start of a stage.
+
+        Raises:
+            DeadlineExceeded: If no time is left, so the stage is not started at all
+        """
+        self.stage = stage
+        if self.on_enter is not None:
+            self.on_enter(stage)
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g}s exceeded before {stage}")
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        """
+        Stop synchronous work running in a thread (which asyncio cannot cancel) once the
+        request is abandoned or out of time. Called between items of long loops.
+
+        Raises:
+            asyncio.CancelledError: If the request was cancelled
+            DeadlineExceeded: If no time is left
+        """
+        if self.cancelled:
+            raise asyncio.CancelledError(f"Cancelled during {self.stage}")
+        if self.expires_at is not None and time.monotonic() >= self.expires_at:
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g}s exceeded during {self.stage}")
+
+
+async def run_in_thread(deadline: Deadline, func: Callable[..., Any], *args) -> Any:
+    """
+    asyncio.to_thread for work that calls deadline.check(): if the awaiting request is
+    cancelled, the deadline is marked cancelled so the thread stops at its next check.
+    """
+    try:
+        return await asyncio.to_thread(func, *args)
+    except asyncio.CancelledError:
+        deadline.cancel()
+        raise
+
+
+async def _wait_for_disconnect(receive):
+    # Once the body has been read, the server's receive() only returns when the client
+    # disconnects (or the response has been sent)
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def run_with_deadline(work: Awaitable[Any], deadline: Deadline, receive=None) -> Any:
+    """
+    Await `work` unless the deadline passes or the client disconnects first. In both cases
+    the work is cancelled and awaited, so provider HTTP streams are closed before returning.
+
+    Args:
+        work: Coroutine producing the response
+        deadline: Request deadline
+        receive: ASGI receive callable of the request (its body must already be read), to
+            watch for a disconnect; None for work without a client connection (jobs)
+
+    Returns:
+        The result of `work`
+
+    Raises:
+        ClientDisconnected: If the client went away first
+        DeadlineExceeded: If the deadline passed first
+    """
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(_wait_for_disconnect(receive)) if receive is not None else None
+    try:
+        done, _ = await asyncio.wait({task, watcher} - {None}, timeout=deadline.remaining(), return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        await asyncio.wait({task})
+        raise
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+    if task in done:
+        return task.result()
+
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        # Failures while unwinding are moot: nobody is waiting for the answer
+        logger.debug("Cancelled query raised while unwinding: %s", e)
+    if watcher is not None and watcher in done:
+        raise ClientDisconnected(f"Client disconnected during {deadline.stage}")
+    raise DeadlineExceeded(f"Deadline of {deadline.seconds:g}s exceeded during {deadline.stage}")
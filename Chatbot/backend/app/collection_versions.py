@@ -0,0 +1,88 @@
+import os
+import re
+import time
+import logging
+from typing import Dict, List, Optional
+
+from chromadb.errors import NotFoundError
+
+logger = logging.getLogger(__name__)
+
+# Collection whose metadata maps each alias (e.g. COLLECTION_NAME) to the live versioned collection
+ALIAS_COLLECTION = os.getenv("COLLECTION_ALIAS_STORE", "collection_aliases")
+# ChromaDB collection names only allow [a-zA-Z0-9._-], so "name@v2025-10-16" is spelled "name__v2025-10-16"
+VERSION_SEPARATOR = "__v"
+PREVIOUS_SUFFIX = ".previous"
+
+
+def version_name(alias: str, version: str) -> str:
+    return f"{alias}{VERSION_SEPARATOR}{version}"
+
+
+def new_version_name(client, alias: str) -> str:
+    """Name for a new version of alias: today's date, plus the time if a version already exists today"""
+    existing = set(list_versions(client, alias))
+    name = version_name(alias, time.strftime("%Y-%m-%d"))
+    if name in existing:
+        name = version_name(alias, time.strftime("%Y-%m-%d-%H%M%S"))
+    return name
+
+
+def list_versions(client, alias: str) -> List[str]:
+    """Versioned collections of alias, oldest first"""
+    pattern = re.compile(re.escape(alias + VERSION_SEPARATOR) + r"[0-9-]+$")
+    names = [getattr(c, "name", c) for c in client.list_collections()]
+    return sorted(name for name in names if pattern.match(name))
+
+
+def _exists(client, name: str) -> bool:
+    try:
+        client.get_collection(name, embedding_function=None)
+        return True
+    except NotFoundError:
+        return False
+
+
+def _read_aliases(client) -> Dict[str, str]:
+    try:
+        store = client.get_collection(ALIAS_COLLECTION, embedding_function=None)
+    except NotFoundError:
+        return {}
+    return dict(store.metadata or {})
+
+
+def get_alias(client, alias: str) -> Optional[str]:
+    """Collection alias points to, or None if it is not an alias"""
+    return _read_aliases(client).get(alias)
+
+
+def get_previous(client, alias: str) -> Optional[str]:
+    """Collection alias pointed to before the last switch (rollback target)"""
+    return _read_aliases(client).get(alias + PREVIOUS_SUFFIX)
+
+
+def resolve_collection_name(client, name: str) -> str:
+    """The live collection for name: its alias target, or name itself (unversioned layout)"""
+    return get_alias(client, name) or name
+
+
+def set_alias(client, alias: str, target: str) -> Optional[str]:
+    """
+    Point alias at target. The whole mapping is written in a single metadata update,
+    so readers see either the old or the new target, never a mix.
+
+    Returns:
+        The previous target, kept as the rollback target
+    """
+    client.get_collection(target, embedding_function=None) # Refuse to point at a missing collection
+    store = client.get_or_create_collection(ALIAS_COLLECTION, embedding_function=None)
+    aliases = dict(store.metadata or {})
+    previous = aliases.get(alias)
+    if previous is None and alias != target and _exists(client, alias):
+        previous = alias # Switching away from the unversioned collection: keep it as the rollback target
+    aliases[alias] = target
+    if previous and previous != target:
+        aliases[alias + PREVIOUS_SUFFIX] = previous
+    store.modify(metadata=aliases)
+    logger.info("Alias '%s' now points to '%s' (was '%s')", alias, target, previous)
+    return previous
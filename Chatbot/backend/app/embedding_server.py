@@ -0,0 +1,454 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import struct
+import asyncio
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ARTICLES_PATH = os.path.join(BACKEND_ROOT, "data", "processed", "input_articles.json")
+
+# Socket of the shared embedding server; unset = each worker loads the model and articles itself
+EMBEDDING_SERVER_SOCKET = os.getenv("EMBEDDING_SERVER_SOCKET", "")
+# Texts embedded together at most, and how long a batch waits for more requests to join it
+EMBEDDING_SERVER_BATCH_SIZE = int(os.getenv("EMBEDDING_SERVER_BATCH_SIZE", "64"))
+EMBEDDING_SERVER_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_SERVER_BATCH_WAIT_MS", "2"))
+# Seconds an API worker waits for a reply
+EMBEDDING_SERVER_TIMEOUT = float(os.getenv("EMBEDDING_SERVER_TIMEOUT", "30"))
+# Full articles cached by each API worker
+EMBEDDING_SERVER_ARTICLE_CACHE = int(os.getenv("EMBEDDING_SERVER_ARTICLE_CACHE", "2048"))
+
+# Messages are frames: header and payload lengths (big-endian uint32), a JSON header, then the
+# payload. Embeddings are sent as raw float32 rows, everything else as JSON in the header.
+_FRAME = struct.Struct("!II")
+
+
+class EmbeddingServerError(RuntimeError):
+    """The embedding server could not be reached or failed the request"""
+
+
+def read_articles(path: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Full articles of the corpus keyed by ID, from the indexer's input JSON file.
+
+    Raises:
+        OSError, ValueError: If the file cannot be read or parsed
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        articles_data = json.load(f)
+    articles = {}
+    for article in articles_data:
+        article_id = article.get('id')
+        if article_id:
+            articles[article_id] = article # Store the whole article dict
+        else:
+            logger.warning("Skipping article without an 'id' field.")
+    return articles
+
+
+def _encode(header: Dict[str, Any], payload: bytes = b"") -> bytes:
+    data = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    return _FRAME.pack(len(data), len(payload)) + data + payload
+
+
+def _decode_header(data: bytes) -> Dict[str, Any]:
+    return json.loads(data.decode("utf-8"))
+
+
+class _Batcher:
+    """
+    Coalesces concurrent embedding requests into batches of up to `max_texts` texts, run
+    one at a time off the event loop. Requests arriving while a batch runs form the next.
+    """
+    def __init__(self, embed, max_texts: int, wait_seconds: float):
+        self._embed = embed
+        self.max_texts = max(1, max_texts)
+        self.wait_seconds = wait_seconds
+        self._pending: List[Tuple[List[str], asyncio.Future]] = []
+        self._wakeup = asyncio.Event()
+        self.stats = {"requests": 0, "batches": 0, "texts": 0}
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((texts, future))
+        self.stats["requests"] += 1
+        self._wakeup.set()
+        return await future
+
+    async def run(self):
+        while True:
+            await self._wakeup.wait()
+            if self.wait_seconds and self._pending_texts() < self.max_texts:
+                # Give requests from other workers a moment to join this batch
+                await asyncio.sleep(self.wait_seconds)
+            self._wakeup.clear()
+            batch = self._take()
+            if self._pending:
+                self._wakeup.set()
+            texts = [text for request_texts, _ in batch for text in request_texts]
+            try:
+                vectors = await asyncio.to_thread(self._embed, texts)
+            except Exception as e:
+                logger.exception("Embedding batch of %d texts failed: %s", len(texts), e)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["texts"] += len(texts)
+            logger.debug("Embedded %d texts for %d requests", len(texts), len(batch))
+            offset = 0
+            for request_texts, future in batch:
+                if not future.done():
+                    future.set_result(vectors[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+    def _pending_texts(self) -> int:
+        return sum(len(texts) for texts, _ in self._pending)
+
+    def _take(self) -> List[Tuple[List[str], asyncio.Future]]:
+        # Whole requests only; a single request larger than max_texts is a batch of its own
+        batch, count = [], 0
+        while self._pending and (not batch or count + len(self._pending[0][0]) <= self.max_texts):
+            texts, future = self._pending.pop(0)
+            batch.append((texts, future))
+            count += len(texts)
+        return batch
+
+
+class EmbeddingServer:
+    """
+    Serves embeddings and full articles to the API workers of this host over a Unix socket
+    (`python -m app.embedding_server`), so the model and the articles are loaded once rather
+    than by every uvicorn worker. Concurrent requests from all workers share batches.
+    """
+    def __init__(self, embedding_function, model_name: str, model_id: str, articles_path: str = ARTICLES_PATH,
+                 socket_path: str = EMBEDDING_SERVER_SOCKET, batch_size: int = EMBEDDING_SERVER_BATCH_SIZE,
+                 batch_wait_ms: float = EMBEDDING_SERVER_BATCH_WAIT_MS):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.model_id = model_id
+        self.articles_path = articles_path
+        self.socket_path = socket_path
+        self.batch_size = batch_size
+        self.batch_wait_ms = batch_wait_ms
+        self.articles: Dict[str, Dict[str, Any]] = {}
+        self._articles_mtime: Optional[float] = None
+        self.dimension = 0
+        self._batcher: Optional[_Batcher] = None
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.embedding_function(texts), dtype=np.float32)
+
+    def load_articles(self) -> bool:
+        """(Re)load the full articles if the file changed since the last load; True if it did"""
+        try:
+            mtime = os.path.getmtime(self.articles_path)
+        except OSError:
+            logger.error("Articles file not found at %s. Full article context will not be available.", self.articles_path)
+            self.articles, self._articles_mtime = {}, None
+            return False
+        if mtime == self._articles_mtime:
+            return False
+        try:
+            # Built aside and swapped in, so concurrent lookups never see a partial reload
+            self.articles = read_articles(self.articles_path)
+            self._articles_mtime = mtime
+            logger.info("Loaded %d full articles from %s", len(self.articles), self.articles_path)
+        except Exception as e:
+            logger.error("Error loading full articles from %s: %s", self.articles_path, e)
+            self.articles, self._articles_mtime = {}, None
+        return True
+
+    async def serve(self):
+        """Load the articles, warm the model up and serve until cancelled"""
+        await asyncio.to_thread(self.load_articles)
+        # Warm-up: the first inference pays for lazy initialisation, and gives the dimension
+        self.dimension = int(self._embed(["warm-up"]).shape[1])
+        self._batcher = _Batcher(self._embed, self.batch_size, self.batch_wait_ms / 1000)
+        batcher_task = asyncio.create_task(self._batcher.run())
+        if os.path.exists(self.socket_path):
+            # Left behind by a previous server that did not shut down cleanly
+            os.unlink(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path) or ".", exist_ok=True)
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        # Stop cleanly (removing the socket) when the container stops
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        logger.info("Embedding server for %s (dimension %s) listening on %s: batches of up to %s texts, %g ms wait",
+                    self.model_id, self.dimension, self.socket_path, self.batch_size, self.batch_wait_ms)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # One connection per API worker thread; its requests are answered in order
+        try:
+            while True:
+                try:
+                    header_length, payload_length = _FRAME.unpack(await reader.readexactly(_FRAME.size))
+                    request = _decode_header(await reader.readexactly(header_length))
+                    if payload_length:
+                        await reader.readexactly(payload_length)
+                except asyncio.IncompleteReadError:
+                    return
+                try:
+                    response = await self._dispatch(request)
+                except Exception as e:
+                    logger.exception("Embedding server request '%s' failed: %s", request.get("op"), e)
+                    response = _encode({"error": str(e)})
+                writer.write(response)
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: Dict[str, Any]) -> bytes:
+        op = request.get("op")
+        if op == "embed":
+            vectors = await self._batcher.embed(list(request["texts"]))
+            vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+            return _encode({"shape": list(vectors.shape)}, vectors.tobytes())
+        if op == "articles":
+            articles = self.articles
+            found = {article_id: articles[article_id] for article_id in request["ids"] if article_id in articles}
+            # Large articles make for a large header; encode off the loop, so batches keep flowing
+            return await asyncio.to_thread(_encode, {"articles": found, "count": len(articles)})
+        if op == "reload":
+            reloaded = await asyncio.to_thread(self.load_articles)
+            return _encode({"reloaded": reloaded, "articles": len(self.articles)})
+        if op == "info":
+            return _encode({
+                "model": self.model_name,
+                "model_id": self.model_id,
+                "dimension": self.dimension,
+                "articles": len(self.articles),
+                "batching": self._batcher.stats
+            })
+        raise ValueError(f"Unknown operation '{op}'")
+
+
+class _Connection(threading.local):
+    sock: Optional[socket.socket] = None
+
+
+class EmbeddingClient(EmbeddingFunction[Documents]):
+    """
+    Embedding function of the API workers when the embedding server is used. Blocking
+    calls, one connection per thread; a broken connection (server restart) is reopened
+    and the request retried once.
+    """
+    def __init__(self, socket_path: str = EMBEDDING_SERVER_SOCKET, timeout: float = EMBEDDING_SERVER_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._connection = _Connection()
+
+    def request(self, op: str, **fields) -> Tuple[Dict[str, Any], bytes]:
+        """
+        Send one request and wait for the reply.
+
+        Returns:
+            The reply's header and payload
+
+        Raises:
+            EmbeddingServerError: If the server cannot be reached or reports an error
+        """
+        frame = _encode({"op": op, **fields})
+        for attempt in range(2):
+            try:
+                header, payload = self._exchange(frame)
+                break
+            except OSError as e:
+                self._close()
+                if attempt:
+                    raise EmbeddingServerError(f"Embedding server at {self.socket_path} is unavailable: {e}") from e
+        if "error" in header:
+            raise EmbeddingServerError(f"Embedding server failed '{op}': {header['error']}")
+        return header, payload
+
+    def _exchange(self, frame: bytes) -> Tuple[Dict[str, Any], bytes]:
+        sock = self._connection.sock
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self._connection.sock = sock
+        sock.sendall(frame)
+        header_length, payload_length = _FRAME.unpack(self._read(sock, _FRAME.size))
+        header = _decode_header(self._read(sock, header_length))
+        return header, self._read(sock, payload_length)
+
+    @staticmethod
+    def _read(sock: socket.socket, size: int) -> bytes:
+        buffer = bytearray()
+        while len(buffer) < size:
+            chunk = sock.recv(min(size - len(buffer), 1 << 20))
+            if not chunk:
+                raise ConnectionResetError("Embedding server closed the connection")
+            buffer.extend(chunk)
+        return bytes(buffer)
+
+    def _close(self):
+        if self._connection.sock is not None:
+            self._connection.sock.close()
+            self._connection.sock = None
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into a float32 array (one row per text)"""
+        header, payload = self.request("embed", texts=list(texts))
+        return np.frombuffer(payload, dtype=np.float32).reshape(header["shape"])
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return list(self.embed(list(input)))
+
+    def info(self) -> Dict[str, Any]:
+        """Model, dimension, article count and batching counters of the server"""
+        return self.request("info")[0]
+
+    def wait_until_ready(self, timeout: float) -> Dict[str, Any]:
+        """
+        Wait for the server to accept requests (it loads the model before listening).
+
+        Raises:
+            EmbeddingServerError: If it is not ready within `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.info()
+            except EmbeddingServerError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.5)
+
+
+class RemoteArticles:
+    """
+    Read-only view of the embedding server's full articles, with the dict methods the
+    context packer uses. Recently used articles (and misses) are cached by the worker.
+
+    Only prefetch(), refresh() and reload() talk to the server, and they block: call them
+    in a thread. get(), `in` and len() answer from what those fetched, so they are safe on
+    the event loop; an article not prefetched reads as missing.
+    """
+    def __init__(self, client: EmbeddingClient, cache_size: int = EMBEDDING_SERVER_ARTICLE_CACHE):
+        self.client = client
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Optional[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Number of articles on the server, as of the last reply carrying it
+        self._count = 0
+
+    def prefetch(self, article_ids: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+        """
+        Fetch the articles not cached yet in one request.
+
+        Returns:
+            The articles found among `article_ids`, so callers need not rely on the cache
+            keeping them (concurrent requests may evict them)
+        """
+        article_ids = list(dict.fromkeys(a for a in article_ids if a))
+        found = {}
+        with self._lock:
+            missing = []
+            for article_id in article_ids:
+                if article_id in self._cache:
+                    self._cache.move_to_end(article_id)
+                    if self._cache[article_id] is not None:
+                        found[article_id] = self._cache[article_id]
+                else:
+                    missing.append(article_id)
+        if not missing:
+            return found
+        reply = self.client.request("articles", ids=missing)[0]
+        articles = reply["articles"]
+        with self._lock:
+            self._count = reply.get("count", self._count)
+            for article_id in missing:
+                self._cache[article_id] = articles.get(article_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        found.update(articles)
+        return found
+
+    def get(self, article_id: str, default=None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            article = self._cache.get(article_id)
+            if article_id in self._cache:
+                self._cache.move_to_end(article_id)
+        return article if article is not None else default
+
+    def __contains__(self, article_id: str) -> bool:
+        return self.get(article_id) is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def refresh(self):
+        """Fetch the article count from the server"""
+        self._count = self.client.info()["articles"]
+
+    def cached(self) -> int:
+        return len(self._cache)
+
+    def reload(self):
+        """Have the server re-read the articles file (once for all workers) and drop the cached articles"""
+        self._count = self.client.request("reload")[0]["articles"]
+        with self._lock:
+            self._cache.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared embedding server for the API workers of this host")
+    parser.add_argument("--socket", default=EMBEDDING_SERVER_SOCKET, help="Unix socket to listen on (default: EMBEDDING_SERVER_SOCKET)")
+    parser.add_argument("--articles", default=ARTICLES_PATH, help="Full articles JSON file (default: data/processed/input_articles.json)")
+    parser.add_argument("--wait", type=float, metavar="SECONDS",
+                        help="Instead of serving, wait until the server on --socket is ready (exit status 1 on timeout)")
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error("Set EMBEDDING_SERVER_SOCKET or pass --socket")
+
+    from app.logging_config import setup_logging
+    setup_logging()
+    if args.wait is not None:
+        try:
+            info = EmbeddingClient(args.socket).wait_until_ready(args.wait)
+        except EmbeddingServerError as e:
+            logger.error("Embedding server not ready after %gs: %s", args.wait, e)
+            sys.exit(1)
+        logger.info("Embedding server ready: %s, %d articles", info["model_id"], info["articles"])
+        return
+
+    from app.embeddings import EMBEDDING_BACKEND, create_embedding_function, embedding_model_id
+    model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
+    logger.info("Initializing embedding function: %s (backend: %s)...", model_name, EMBEDDING_BACKEND)
+    server = EmbeddingServer(create_embedding_function(model_name), model_name, embedding_model_id(model_name),
+                             articles_path=args.articles, socket_path=args.socket)
+    try:
+        asyncio.run(server.serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Embedding server stopped")
+
+
+if __name__ == "__main__":
+    main()
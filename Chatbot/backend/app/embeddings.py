@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from chromadb.errors import NotFoundError
+from chromadb.utils import embedding_functions
+
+logger = logging.getLogger(__name__)
+
+# "torch" (sentence-transformers) or "onnx" (model exported by scripts/export_onnx.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+ONNX_MODEL_ROOT = os.getenv("ONNX_MODEL_DIR", "/app/models/onnx")
+# Use the int8 dynamically quantised export when available
+ONNX_QUANTIZED = os.getenv("ONNX_QUANTIZED", "true").lower() == "true"
+# Intra-op threads per ONNX session (0 = onnxruntime default, one per core)
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
+
+EXPORT_INFO_FILE = "export_info.json"
+FP32_MODEL_FILE = "model.onnx"
+INT8_MODEL_FILE = "model_int8.onnx"
+# Name under which ChromaDB records the sentence-transformers embedding function
+SENTENCE_TRANSFORMER_EF = "sentence_transformer"
+
+
+def model_slug(model_name: str) -> str:
+    """Filesystem-safe name of a model"""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", model_name).strip("_")
+
+
+def onnx_model_dir(model_name: str) -> str:
+    return os.path.join(ONNX_MODEL_ROOT, model_slug(model_name))
+
+
+class ONNXEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Sentence embeddings from an ONNX export of a sentence-transformers model.
+
+    Runs the transformer with onnxruntime and applies the model's pooling in numpy,
+    so neither torch nor sentence-transformers is imported. Inputs are truncated to
+    the model's max_seq_length, as sentence-transformers does.
+    """
+    def __init__(self, model_dir: str, quantized: bool = True, batch_size: int = 32, threads: int = 0):
+        """
+        Args:
+            model_dir: Directory written by scripts/export_onnx.py
+            quantized: Use the int8 model if it was exported
+            batch_size: Texts per inference call
+            threads: Intra-op threads (0 = onnxruntime default)
+        """
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, EXPORT_INFO_FILE), "r", encoding="utf-8") as f:
+            self.info: Dict[str, Any] = json.load(f)
+        if self.info.get("parity_ok") is False:
+            raise ValueError(f"The ONNX export in {model_dir} failed its parity check against torch; re-export it")
+        model_file = INT8_MODEL_FILE if quantized and self.info.get("quantized") else FP32_MODEL_FILE
+        self.quantized = model_file == INT8_MODEL_FILE
+        self.batch_size = batch_size
+        self.pooling = self.info.get("pooling", "mean")
+        self.normalize = self.info.get("normalize", False)
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(max_length=self.info["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.info.get("pad_token_id", 0))
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(os.path.join(model_dir, model_file), options, providers=["CPUExecutionProvider"])
+        self._input_names = {i.name for i in self.session.get_inputs()}
+        logger.info("Loaded ONNX embedding model %s (%s, pooling=%s)", self.info.get("model_name"), model_file, self.pooling)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embed texts into a float32 array (one row per text)"""
+        if not texts:
+            return np.zeros((0, self.info["dimension"]), dtype=np.float32)
+        # Length-sorted batches waste less compute on padding
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        output = np.empty((len(texts), self.info["dimension"]), dtype=np.float32)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            encodings = self.tokenizer.encode_batch([texts[i] for i in batch])
+            input_ids = np.array([e.ids for e in encodings], dtype=np.int64)
+            attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+            feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+            if "token_type_ids" in self._input_names:
+                feeds["token_type_ids"] = np.zeros_like(input_ids)
+            token_embeddings = self.session.run(None, feeds)[0]
+            output[batch] = self._pool(token_embeddings, attention_mask)
+        return output
+
+    def _pool(self, token_embeddings: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        if self.pooling == "cls":
+            pooled = token_embeddings[:, 0]
+        else:
+            mask = attention_mask[..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self.normalize:
+            pooled = pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled.astype(np.float32)
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return list(self.embed(list(input)))
+
+
+def embedding_model_id(model_name: str, backend: Optional[str] = None) -> str:
+    """
+    Identifier of the vectors a backend produces for a model: the int8 ONNX model gives
+    slightly different vectors, so caches and index manifests must tell them apart.
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "onnx" and ONNX_QUANTIZED:
+        return f"{model_name}#onnx-int8"
+    return model_name
+
+
+def create_embedding_function(model_name: str, backend: Optional[str] = None, threads: Optional[int] = None):
+    """
+    Build the embedding function for the configured backend.
+
+    Args:
+        model_name: Sentence-transformers model name
+        backend: "torch" or "onnx" (default: EMBEDDING_BACKEND)
+        threads: Intra-op threads for the ONNX session (default: ONNX_THREADS); torch
+            threads are set process-wide with torch.set_num_threads by the caller
+    """
+    backend = backend or EMBEDDING_BACKEND
+    if backend == "onnx":
+        return ONNXEmbeddingFunction(onnx_model_dir(model_name), quantized=ONNX_QUANTIZED,
+                                     threads=ONNX_THREADS if threads is None else threads)
+    if backend != "torch":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND '{backend}' (expected 'torch' or 'onnx')")
+    return embedding_functions.SentenceTransformerEmbeddingFunction(model_name=model_name)
+
+
+def stored_embedding_function(client, name: str) -> Optional[str]:
+    """
+    Name of the embedding function recorded in a collection's configuration (e.g.
+    "sentence_transformer"). None if the collection does not exist or records none (legacy
+    configuration).
+
+    Opening the collection makes ChromaDB build the recorded function. Where
+    sentence-transformers is not installed (ONNX images), building it fails, which
+    identifies it as well.
+    """
+    try:
+        collection = client.get_collection(name=name, embedding_function=None)
+    except NotFoundError:
+        return None
+    except ValueError as e:
+        if "sentence_transformers" not in str(e):
+            raise
+        return SENTENCE_TRANSFORMER_EF
+    config = (collection.configuration_json or {}).get("embedding_function") or {}
+    return config.get("name") if config.get("type") != "legacy" else None
+
+
+def open_collection(client, name: str, embedding_function, create: bool = True):
+    """
+    Get (or create) a collection with the given embedding function.
+
+    Collections created by chromadb>=1.0 with the sentence-transformers embedding function
+    record it in their configuration, and ChromaDB builds it (loading the torch model) when
+    the collection is opened. With the torch backend, such a collection is opened with its
+    own configured function. With the ONNX backend, such a collection is refused instead of
+    being searched with the torch model.
+
+    Raises:
+        ValueError: The collection records the sentence-transformers function and the
+            backend is ONNX
+    """
+    if EMBEDDING_BACKEND == "onnx" or isinstance(embedding_function, ONNXEmbeddingFunction):
+        if stored_embedding_function(client, name) == SENTENCE_TRANSFORMER_EF:
+            raise ValueError(f"Collection '{name}' records the sentence-transformers embedding function, which ChromaDB "
+                             f"would load (with torch) to open it. Re-index it with EMBEDDING_BACKEND=onnx, or set "
+                             f"EMBEDDING_BACKEND=torch")
+    try:
+        if create:
+            return client.get_or_create_collection(name=name, embedding_function=embedding_function)
+        return client.get_collection(name=name, embedding_function=embedding_function)
+    except ValueError as e:
+        if "Embedding function name mismatch" not in str(e):
+            raise
+        logger.warning("Collection '%s' was created with another embedding function (%s); opening it with its configured one", name, e)
+        return client.get_collection(name=name)
@@ -0,0 +1,400 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import logging
+import socket
+import sqlite3
+import threading
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from app.cancellation import Deadline
+from app.logging_config import request_id_var
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Queries run concurrently by the job workers, and jobs allowed to wait for one
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+# Deadline of a job once started (0 = none); longer than QUERY_TIMEOUT_SECONDS, slow generations are what jobs are for
+JOB_TIMEOUT_SECONDS = float(os.getenv("JOB_TIMEOUT_SECONDS", "900"))
+# Seconds finished jobs and their results are kept
+JOB_TTL_SECONDS = float(os.getenv("JOB_TTL_SECONDS", "86400"))
+# SQLite file holding the jobs; on the data volume, so queued jobs survive a restart
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(BACKEND_ROOT, "data", "jobs.sqlite3"))
+# Seconds between lease renewals of the jobs an API worker holds (and checks for cancellations
+# requested through another worker); a job whose lease is not renewed for _LEASE_HEARTBEATS
+# intervals belongs to a dead worker and is taken over by another
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "5"))
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+TERMINAL_STATUSES = (DONE, FAILED, CANCELLED)
+# A job interrupted by this many restarts is given up on, in case it is what brings the process down
+_MAX_ATTEMPTS = 3
+_PURGE_INTERVAL_SECONDS = 60.0
+_LEASE_HEARTBEATS = 6
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    stage TEXT,
+    request TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL,
+    owner TEXT,
+    heartbeat_at REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+# Columns added after the first release, added to existing stores on open
+_ADDED_COLUMNS = {"owner": "TEXT", "heartbeat_at": "REAL", "cancel_requested": "INTEGER NOT NULL DEFAULT 0"}
+
+
+class JobQueueFull(Exception):
+    """JOB_QUEUE_SIZE jobs are already waiting"""
+
+
+class JobStore:
+    """
+    Job records in a local SQLite file. Calls are short and serialised by a lock, so one
+    connection is shared by the worker threads that asyncio.to_thread runs them on.
+    """
+    def __init__(self, path: str):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            # WAL: readers (polling clients) never wait for the writers
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+            for name, definition in _ADDED_COLUMNS.items():
+                if name not in columns:
+                    self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    def _execute(self, sql: str, params=()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def create(self, job_id: str, request: Dict[str, Any], owner: str):
+        now = time.time()
+        self._execute("INSERT INTO jobs (id, status, request, created_at, owner, heartbeat_at) VALUES (?, ?, ?, ?, ?, ?)",
+                      (job_id, QUEUED, json.dumps(request), now, owner, now))
+
+    def update(self, job_id: str, **fields):
+        self.transition(job_id, None, **fields)
+
+    def transition(self, job_id: str, from_status: Optional[str], owner: Optional[str] = None, **fields) -> bool:
+        """
+        Update a job if it is (still) in `from_status` and, if given, held by `owner`. Each
+        update is a single statement, so concurrent API workers cannot both make it.
+
+        Returns:
+            True if the job was updated
+        """
+        if "result" in fields and fields["result"] is not None:
+            fields["result"] = json.dumps(fields["result"])
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        conditions, params = ["id = ?"], [job_id]
+        if from_status is not None:
+            conditions.append("status = ?")
+            params.append(from_status)
+        if owner is not None:
+            conditions.append("owner = ?")
+            params.append(owner)
+        with self._lock:
+            return self._conn.execute(f"UPDATE jobs SET {assignments} WHERE {' AND '.join(conditions)}",
+                                      (*fields.values(), *params)).rowcount == 1
+
+    def claim(self, job_id: str, owner: str, attempts: int) -> bool:
+        """
+        Mark a queued job held by `owner` running. False if it is no longer queued (cancelled)
+        or was taken over by another API worker after `owner` missed its heartbeats.
+        """
+        now = time.time()
+        return self.transition(job_id, QUEUED, owner=owner, status=RUNNING, started_at=now, heartbeat_at=now, attempts=attempts)
+
+    def heartbeat(self, owner: str, now: float) -> List[str]:
+        """
+        Renew the lease of the jobs `owner` holds.
+
+        Returns:
+            IDs of its running jobs whose cancellation was requested through another worker
+        """
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status IN (?, ?)", (now, owner, QUEUED, RUNNING))
+            rows = self._conn.execute("SELECT id FROM jobs WHERE owner = ? AND status = ? AND cancel_requested = 1",
+                                      (owner, RUNNING)).fetchall()
+        return [row["id"] for row in rows]
+
+    def release(self, owner: str):
+        """Expire the leases of `owner` at once (shutdown), so another worker takes its jobs over"""
+        self._execute("UPDATE jobs SET heartbeat_at = 0 WHERE owner = ? AND status IN (?, ?)", (owner, QUEUED, RUNNING))
+
+    def take_over_stale(self, owner: str, now: float, stale_before: float) -> List[Dict[str, Any]]:
+        """
+        Queue for `owner` the unfinished jobs whose holder stopped renewing their lease
+        before `stale_before` (it died, or was stopped), oldest first.
+
+        Returns:
+            The jobs taken over, with the status they were in (a 'running' one was interrupted)
+        """
+        stale = "(heartbeat_at IS NULL OR heartbeat_at < ?)"
+        taken = []
+        with self._lock:
+            rows = self._conn.execute(f"SELECT id, status, attempts FROM jobs WHERE status IN (?, ?) AND {stale} ORDER BY created_at",
+                                      (QUEUED, RUNNING, stale_before)).fetchall()
+            for row in rows:
+                # Conditional on the lease still being stale: another worker may have just taken it
+                updated = self._conn.execute(f"UPDATE jobs SET status = ?, stage = NULL, owner = ?, heartbeat_at = ?, cancel_requested = 0 "
+                                             f"WHERE id = ? AND status = ? AND {stale}",
+                                             (QUEUED, owner, now, row["id"], row["status"], stale_before)).rowcount
+                if updated:
+                    taken.append(dict(row))
+        return taken
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._execute("SELECT * FROM jobs WHERE id = ? AND (expires_at IS NULL OR expires_at >= ?)", (job_id, time.time()))
+        if not rows:
+            return None
+        job = dict(rows[0])
+        job["request"] = json.loads(job["request"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def purge_expired(self, now: float) -> int:
+        with self._lock:
+            return self._conn.execute("DELETE FROM jobs WHERE expires_at IS NOT NULL AND expires_at < ?", (now,)).rowcount
+
+
+class JobManager:
+    """
+    Runs queries submitted as jobs on a fixed number of asyncio workers. Job state is kept
+    in a JobStore shared by the API worker processes. Each job is held by one process (its
+    owner) under a lease renewed every JOB_HEARTBEAT_SECONDS; jobs of a process that stops
+    or dies are taken over by another (or the next start) once the lease lapses. Progress
+    (the pipeline stage) is tracked in memory by the owner and pushed to subscribers.
+    """
+    def __init__(self, db_path: str = JOB_DB_PATH, workers: int = JOB_WORKERS, queue_size: int = JOB_QUEUE_SIZE,
+                 timeout: float = JOB_TIMEOUT_SECONDS, ttl: float = JOB_TTL_SECONDS, heartbeat: float = JOB_HEARTBEAT_SECONDS):
+        self.db_path = db_path
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        # Identifies this API worker process in the jobs it holds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        # Coroutine function answering a request (QueryRequest fields) with a JSON-serialisable result
+        self.runner: Optional[Callable[[Dict[str, Any], Deadline], Awaitable[Dict[str, Any]]]] = None
+        self.store: Optional[JobStore] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._running: Dict[str, asyncio.Task] = {}
+        self._recorded: Dict[str, asyncio.Event] = {}
+        self._stages: Dict[str, str] = {}
+        self._cancel_requested: Set[str] = set()
+        self._changed: Dict[str, asyncio.Event] = {}
+
+    async def start(self):
+        """Open the store, take over the jobs of stopped workers and start the workers"""
+        if self._tasks:
+            return
+        self.store = await asyncio.to_thread(JobStore, self.db_path)
+        self._queue = asyncio.Queue()
+        await self._take_over_stale()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._maintenance_loop()))
+        logger.info("Job workers started: %d workers, queue size %d, store %s, owner %s", self.workers, self.queue_size, self.db_path, self.owner)
+
+    async def stop(self):
+        """
+        Stop the workers. Running jobs are interrupted, not failed: they stay 'running' in
+        the store with their lease expired, and are re-queued by another API worker or the
+        next start().
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.store is not None:
+            await asyncio.to_thread(self.store.release, self.owner)
+
+    async def _take_over_stale(self):
+        """Queue the jobs whose owner stopped renewing their lease; interrupted ones count as an attempt"""
+        now = time.time()
+        taken = await asyncio.to_thread(self.store.take_over_stale, self.owner, now, now - self.heartbeat * _LEASE_HEARTBEATS)
+        requeued = 0
+        for job in taken:
+            if job["status"] == RUNNING and job["attempts"] >= _MAX_ATTEMPTS:
+                await asyncio.to_thread(self._finish, job["id"], QUEUED, status=FAILED, error=f"Interrupted {job['attempts']} times")
+                continue
+            self._queue.put_nowait(job["id"])
+            requeued += 1
+        if requeued:
+            logger.info("Took over %d unfinished jobs of stopped workers from %s", requeued, self.db_path)
+
+    async def submit(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Queue a query.
+
+        Raises:
+            JobQueueFull: If JOB_QUEUE_SIZE jobs are already waiting
+        """
+        if self._queue is None:
+            raise RuntimeError("Job workers are not running")
+        if self._queue.qsize() >= self.queue_size:
+            raise JobQueueFull(f"{self._queue.qsize()} jobs are already queued")
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(self.store.create, job_id, request, self.owner)
+        self._queue.put_nowait(job_id)
+        logger.debug("Queued job %s", job_id)
+        return await self.get(job_id)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The job's record, with the live stage of a running job; None if unknown or expired"""
+        if self.store is None:
+            return None
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is not None and job["status"] == RUNNING:
+            job["stage"] = self._stages.get(job_id, job["stage"])
+        return job
+
+    async def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancel a queued or running job (closing its provider connection); finished jobs are
+        left as they are. A job running on another API worker is cancelled by that worker at
+        its next heartbeat; if it has not been by JOB_HEARTBEAT_SECONDS * 2, the job is
+        returned still 'running' (with cancel_requested set).
+        """
+        job = await self.get(job_id)
+        if job is None or job["status"] in TERMINAL_STATUSES:
+            return job
+        if job_id not in self._running and await asyncio.to_thread(self._finish, job_id, QUEUED, status=CANCELLED):
+            self._notify(job_id)
+            return await self.get(job_id)
+        task = self._running.get(job_id)
+        if task is not None:
+            recorded = self._recorded[job_id]
+            self._cancel_requested.add(job_id)
+            task.cancel()
+            # The worker records the cancellation once the task has unwound
+            await recorded.wait()
+            return await self.get(job_id)
+        # Running on another API worker: ask its owner, and wait for it to record the cancellation
+        await asyncio.to_thread(self.store.transition, job_id, RUNNING, cancel_requested=1)
+        deadline = time.monotonic() + self.heartbeat * 2
+        while True:
+            job = await self.get(job_id)
+            if job is None or job["status"] in TERMINAL_STATUSES or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(min(0.2, self.heartbeat))
+
+    async def wait_for_change(self, job_id: str, timeout: float) -> bool:
+        """Wait until the job's status or stage changes; False on timeout"""
+        event = self._changed.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _notify(self, job_id: str):
+        event = self._changed.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+    def _set_stage(self, job_id: str, stage: str):
+        self._stages[job_id] = stage
+        self._notify(job_id)
+
+    def _finish(self, job_id: str, from_status: str, owner: Optional[str] = None, **fields) -> bool:
+        now = time.time()
+        return self.store.transition(job_id, from_status, owner=owner, finished_at=now, expires_at=now + self.ttl, **fields)
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception("Job worker failed on job %s: %s", job_id, e)
+
+    async def _run(self, job_id: str):
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None or job["status"] != QUEUED:
+            # Cancelled or expired while waiting
+            return
+        if not await asyncio.to_thread(self.store.claim, job_id, self.owner, job["attempts"] + 1):
+            # Cancelled meanwhile, or taken over by another worker
+            return
+        self._notify(job_id)
+        timeouts = [t for t in (self.timeout, job["request"].get("timeout")) if t]
+        deadline = Deadline(min(timeouts) if timeouts else None, on_enter=lambda stage: self._set_stage(job_id, stage))
+        # The job ID tags the pipeline's log records, as the request ID does for /query
+        request_id_var.set(job_id)
+        task = asyncio.ensure_future(self.runner(job["request"], deadline))
+        self._running[job_id] = task
+        self._recorded[job_id] = asyncio.Event()
+        try:
+            result = await task
+            fields = {"status": DONE, "result": result}
+        except asyncio.CancelledError:
+            if job_id not in self._cancel_requested:
+                # Shutdown: leave the job 'running' so the next start re-queues it
+                raise
+            fields = {"status": CANCELLED, "error": f"Cancelled during {deadline.stage}"}
+        except Exception as e:
+            # HTTPExceptions raised by the query pipeline carry their message in .detail
+            fields = {"status": FAILED, "error": str(getattr(e, "detail", "") or e)}
+        finally:
+            self._running.pop(job_id, None)
+            self._cancel_requested.discard(job_id)
+            self._stages.pop(job_id, None)
+        fields["stage"] = deadline.stage
+        # Only while still ours: a worker that lost its lease (e.g. stalled) must not overwrite the new owner's run
+        if not await asyncio.to_thread(self._finish, job_id, RUNNING, self.owner, **fields):
+            logger.warning("Job %s was taken over by another worker; dropping this run's result", job_id)
+        self._recorded.pop(job_id).set()
+        self._notify(job_id)
+        logger.info("Job %s %s", job_id, fields["status"], extra={"job_id": job_id, "stage": deadline.stage})
+
+    async def _maintenance_loop(self):
+        # Renew leases, pick up cancellations and stale jobs every heartbeat; purge expired jobs now and then
+        last_purge = time.monotonic()
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            try:
+                for job_id in await asyncio.to_thread(self.store.heartbeat, self.owner, time.time()):
+                    task = self._running.get(job_id)
+                    if task is not None and job_id not in self._cancel_requested:
+                        logger.info("Cancelling job %s as requested through another worker", job_id)
+                        self._cancel_requested.add(job_id)
+                        task.cancel()
+                await self._take_over_stale()
+                if time.monotonic() - last_purge >= _PURGE_INTERVAL_SECONDS:
+                    last_purge = time.monotonic()
+                    purged = await asyncio.to_thread(self.store.purge_expired, time.time())
+                    if purged:
+                        logger.debug("Purged %d expired jobs", purged)
+            except Exception as e:
+                logger.warning("Job maintenance failed: %s", e)
+
+
+# Create a singleton instance
+job_manager = JobManager()
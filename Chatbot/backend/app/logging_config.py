@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import json
+import uuid
+import queue
+import atexit
+import logging
+import hashlib
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+# Root level, and optional per-logger overrides ("chromadb=WARNING,httpx=WARNING")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# "json" (one object per line) or "text"
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Fraction of requests whose DEBUG/INFO records are kept; warnings and errors are always kept
+LOG_SAMPLE_RATIO = float(os.getenv("LOG_SAMPLE_RATIO", "1.0"))
+
+# Correlation ID of the request being served (set by the API middleware, inherited by to_thread calls)
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed with extra= and becomes a JSON field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "request_id"}
+
+_listener: Optional[QueueListener] = None
+_VALID_REQUEST_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+class _RequestContextFilter(logging.Filter):
+    """
+    Tags records with the current request ID and drops DEBUG/INFO records of requests
+    outside the sample. Runs in the calling thread, where the request's context is visible.
+    """
+    def filter(self, record: logging.LogRecord) -> bool:
+        request_id = request_id_var.get()
+        record.request_id = request_id
+        if LOG_SAMPLE_RATIO >= 1.0 or record.levelno >= logging.WARNING or request_id is None:
+            return True
+        # Sample whole requests, so a kept request has all of its lines
+        bucket = int.from_bytes(hashlib.blake2b(request_id.encode(), digest_size=2).digest(), "big") / 0xFFFF
+        return bucket < LOG_SAMPLE_RATIO
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """
+    Enqueues records as they are. The standard QueueHandler formats the message in the
+    calling thread so records can be pickled; the queue here stays in-process, so
+    %-formatting and tracebacks are left to the background writer.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, request_id, extra= fields and exception"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        record.request_id_tag = f" [{record.request_id}]" if getattr(record, "request_id", None) else ""
+        return super().format(record)
+
+
+def setup_logging():
+    """
+    Route all logging through an in-process queue to a background writer thread, so
+    request handlers never format records or block on stdout. Idempotent.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "text":
+        stream.setFormatter(_TextFormatter('%(asctime)s - %(levelname)s - %(name)s%(request_id_tag)s - %(message)s'))
+    else:
+        stream.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    handler.addFilter(_RequestContextFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    # uvicorn installs its own synchronous handlers before it imports the app
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+    for item in filter(None, (part.strip() for part in LOG_LEVELS.split(","))):
+        name, _, level = item.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    # Flush what is still queued when the process exits
+    atexit.register(_listener.stop)
+
+
+class RequestIdMiddleware:
+    """
+    ASGI middleware giving each HTTP request a correlation ID: the caller's X-Request-ID
+    header if it is a sane token, otherwise a new one. The ID tags every log record
+    written while serving the request and is echoed in the X-Request-ID response header.
+    """
+    def __init__(self, app, header: str = "x-request-id"):
+        self.app = app
+        self.header = header.encode("latin-1")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = next((value.decode("latin-1") for key, value in scope["headers"] if key == self.header), "")
+        if not _VALID_REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex[:16]
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", []), (self.header, request_id.encode("latin-1"))]}
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
@@ -0,0 +1,88 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Tuple
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import REGISTRY, CounterMetricFamily
+
+# Seconds, from sub-millisecond cache hits to multi-minute local generations
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_SECONDS = Histogram("iwac_rag_stage_seconds", "Duration of /query pipeline stages",
+                          ["stage", "model", "provider"], buckets=LATENCY_BUCKETS)
+QUERY_SECONDS = Histogram("iwac_rag_query_seconds", "Duration of /query requests",
+                          ["model", "provider"], buckets=LATENCY_BUCKETS)
+RETRIEVED_CHUNKS = Counter("iwac_rag_retrieved_chunks", "Chunks returned by the vector search", ["model", "provider"])
+CANDIDATE_ARTICLES = Counter("iwac_rag_candidate_articles", "Unique articles among the retrieved chunks", ["model", "provider"])
+CONTEXT_TOKENS = Counter("iwac_rag_context_tokens", "Tokens packed into prompt contexts", ["model", "provider"])
+CONTEXT_TRUNCATIONS = Counter("iwac_rag_context_truncations", "Queries whose context left out articles that did not fit", ["model", "provider"])
+PROMPT_CACHED_TOKENS = Counter("iwac_rag_prompt_cached_tokens", "Prompt tokens served from the provider's prompt cache", ["model", "provider"])
+PROVIDER_ERRORS = Counter("iwac_rag_provider_errors", "Failed provider generations", ["model", "provider"])
+QUERIES_CANCELLED = Counter("iwac_rag_queries_cancelled", "/query requests abandoned on client disconnect or deadline",
+                            ["reason", "stage", "model", "provider"])
+
+
+class StageTimings:
+    """
+    Durations of the stages of one request, in seconds. Stages timed more than once
+    (e.g. token counting) are summed.
+    """
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+
+def observe_stages(stages: Dict[str, float], model: str, provider: str):
+    """Record the stage durations of a request in the stage histogram"""
+    for stage, seconds in stages.items():
+        STAGE_SECONDS.labels(stage, model, provider).observe(seconds)
+
+
+class _CacheCollector:
+    """
+    Exposes hit/miss counts of in-process caches as iwac_rag_cache_lookups_total. Counts
+    are read at scrape time, so the caches themselves pay nothing.
+    """
+    def __init__(self):
+        self.caches: Dict[str, Callable[[], Tuple[int, int]]] = {}
+
+    def collect(self):
+        family = CounterMetricFamily("iwac_rag_cache_lookups", "In-process cache lookups", labels=["cache", "result"])
+        for name, stats in self.caches.items():
+            hits, misses = stats()
+            family.add_metric([name, "hit"], hits)
+            family.add_metric([name, "miss"], misses)
+        yield family
+
+
+_cache_collector = _CacheCollector()
+REGISTRY.register(_cache_collector)
+
+
+def register_cache(name: str, stats: Callable[[], Tuple[int, int]]):
+    """
+    Report a cache's lookups on /metrics.
+
+    Args:
+        name: Cache label
+        stats: Returns the (hits, misses) counts so far
+    """
+    _cache_collector.caches[name] = stats
+
+
+def register_lru_cache(name: str, cached_function):
+    """Report the lookups of a functools.lru_cache-wrapped function on /metrics"""
+    def stats() -> Tuple[int, int]:
+        info = cached_function.cache_info()
+        return info.hits, info.misses
+    register_cache(name, stats)
@@ -1,6 +1,12 @@
 import os
+import sys
 import json
+import time
+import asyncio
+import hashlib
 import logging
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
 from typing import Dict, List, Any, Optional, Tuple
 from pathlib import Path
 
@@ -11,15 +17,60 @@ except ImportError:
     logging.warning("tiktoken library not found. Token counting will be approximate.")
     tiktoken = None
 
+try:
+    # Same sentence splitting as the indexer, so chunk sentence ranges map onto full articles
+    from app.text_utils import split_sentences, compute_simhash
+except ImportError:
+    logging.warning("NLTK not importable. Long articles cannot be excerpted during context packing.")
+    split_sentences = None
+    compute_simhash = None
+
 # Import provider classes
-from .base import LLMProvider
+from .base import LLMProvider, GenerationResult
 from .ollama_provider import OllamaProvider
 from .gemini_provider import GeminiProvider
 from .openai_provider import OpenAIProvider
 from .anthropic_provider import AnthropicProvider
+from .context_packer import ContextPacker, rank_article_candidates
+from .context_compression import ContextCompressor
+from .dedup import cluster_near_duplicates, parse_simhash
+from app.cancellation import Deadline, run_in_thread
+from app.embedding_server import EMBEDDING_SERVER_SOCKET, EmbeddingClient, EmbeddingServerError, RemoteArticles, read_articles
+from app.metrics import PROVIDER_ERRORS, StageTimings, register_lru_cache
+from app.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
+# Phases of a provider call that providers may report in GenerationResult.timings (Ollama does),
+# recorded as provider_<phase> stages
+_PROVIDER_PHASES = ("load", "prompt_eval", "eval")
+
+@dataclass
+class ResponseResult:
+    """
+    Outcome of ModelManager.generate_response
+    """
+    generation: GenerationResult # Provider result (text, usage, timings)
+    used_article_ids: List[str] # Articles included in the context, in prompt order
+    prompt_token_count: int # Provider-reported prompt tokens, or our estimate
+    answer_token_count: int # Provider-reported answer tokens, or our estimate
+    duplicate_article_ids: Dict[str, List[str]] = field(default_factory=dict) # Used article -> near-duplicates left out
+    timings: Dict[str, float] = field(default_factory=dict) # Stage durations in seconds (see app/metrics.py)
+    candidate_count: int = 0 # Unique articles among the retrieved chunks
+    context_tokens: int = 0 # Tokens packed into the context section
+    skipped_article_ids: List[str] = field(default_factory=list) # Articles that did not fit in the context
+
+class SharedContext:
+    """
+    Work shared by the generate_response calls that answer one query with several models
+    over the same retrieval: the ranking of candidates (a future, by number of retrieved chunks used) and
+    token counts (by tokenizer and digest of the text). Conversation sessions pass their own token counts,
+    which outlive a single query.
+    """
+    def __init__(self, token_counts: Optional[Dict[Tuple[str, bytes], int]] = None):
+        self.ranked: Dict[int, "asyncio.Future[Tuple[List[Any], Dict[str, List[str]], int]]"] = {}
+        self.token_counts: Dict[Tuple[str, bytes], int] = token_counts if token_counts is not None else {}
+
 class ModelManager:
     """
     Manages LLM model configurations and providers
@@ -49,6 +100,14 @@ class ModelManager:
         self.models = {}
         self.providers = {}
         self.full_articles = {} # Dictionary to hold full article content by id
+        # Sentence splits of recently packed articles, keyed by article id
+        self._article_sentences = lru_cache(maxsize=4096)(self._split_article_sentences)
+        self._compressor = None # Set once the API hands us its embedding function
+        self._article_simhashes = lru_cache(maxsize=8192)(self._compute_article_simhash)
+        register_lru_cache("article_sentences", self._article_sentences)
+        register_lru_cache("article_simhashes", self._article_simhashes)
+        # Maximum SimHash Hamming distance for two articles to count as the same story (-1 disables)
+        self.near_duplicate_max_distance = int(os.getenv("NEAR_DUPLICATE_MAX_DISTANCE", "8"))
 
         self._initialize_providers()
         self.load_configs()
@@ -56,7 +115,7 @@ class ModelManager:
         
         # Set default model from config or env
         self.default_model_id = os.getenv("MODEL_NAME", "gemma3:4b")
-        logger.info(f"ModelManager initialized with default model: {self.default_model_id}")
+        logger.info("ModelManager initialized with default model: %s", self.default_model_id)
     
     def _initialize_providers(self):
         """Initialize the provider instances"""
@@ -66,12 +125,12 @@ class ModelManager:
             "openai": OpenAIProvider(),
             "anthropic": AnthropicProvider()
         }
-        logger.info(f"Initialized providers: {', '.join(self.providers.keys())}")
+        logger.info("Initialized providers: %s", ", ".join(self.providers.keys()))
     
     def load_configs(self):
         """Load model configurations from JSON file"""
         try:
-            logger.info(f"Loading model configs from {self.config_path}")
+            logger.info("Loading model configs from %s", self.config_path)
             with open(self.config_path, 'r') as f:
                 config_data = json.load(f)
                 
@@ -79,13 +138,13 @@ class ModelManager:
                 model_id = model_config.get('id')
                 if model_id:
                     self.models[model_id] = model_config
-                    logger.info(f"Loaded config for model: {model_id}")
+                    logger.info("Loaded config for model: %s", model_id)
                 else:
-                    logger.warning(f"Skipping model config without id: {model_config}")
+                    logger.warning("Skipping model config without id: %s", model_config)
                     
-            logger.info(f"Loaded {len(self.models)} model configurations")
+            logger.info("Loaded %d model configurations", len(self.models))
         except Exception as e:
-            logger.error(f"Error loading model configs: {e}")
+            logger.error("Error loading model configs: %s", e)
             # Initialize with empty models dictionary if loading fails
             self.models = {}
     
@@ -94,29 +153,182 @@ class ModelManager:
         Load full article content from the JSON file.
         Stores articles in a dictionary keyed by article ID.
         """
+        with tracer.start_as_current_span("load_full_articles") as span:
+            span.set_attribute("rag.articles_path", self.articles_path)
+            self._read_full_articles()
+            if isinstance(self.full_articles, dict):
+                span.set_attribute("rag.articles", len(self.full_articles))
+
+    def _read_full_articles(self):
+        if EMBEDDING_SERVER_SOCKET:
+            # The shared embedding server holds the articles for all API workers
+            if isinstance(self.full_articles, RemoteArticles):
+                try:
+                    self.full_articles.reload()
+                except EmbeddingServerError as e:
+                    logger.error("Could not reload full articles on the embedding server: %s", e)
+            else:
+                logger.info("Full articles are served by the embedding server at %s", EMBEDDING_SERVER_SOCKET)
+                self.full_articles = RemoteArticles(EmbeddingClient(EMBEDDING_SERVER_SOCKET))
+                try:
+                    self.full_articles.refresh()
+                except EmbeddingServerError as e:
+                    # Not up yet (workers may start first); the count follows with the first articles fetched
+                    logger.warning("Could not reach the embedding server for the article count: %s", e)
+            return
         try:
-            logger.info(f"Loading full articles from {self.articles_path}")
+            logger.info("Loading full articles from %s", self.articles_path)
             if not os.path.exists(self.articles_path):
-                logger.error(f"Articles file not found at {self.articles_path}. Full article context will not be available.")
+                logger.error("Articles file not found at %s. Full article context will not be available.", self.articles_path)
                 self.full_articles = {}
                 return
 
-            with open(self.articles_path, 'r', encoding='utf-8') as f:
-                articles_data = json.load(f)
+            # Build a new dict and swap it in, so concurrent queries never see a partial reload
+            self.full_articles = read_articles(self.articles_path)
 
-            for article in articles_data:
-                article_id = article.get('id')
-                if article_id:
-                    self.full_articles[article_id] = article # Store the whole article dict
-                else:
-                    logger.warning("Skipping article without an 'id' field.")
-
-            logger.info(f"Loaded {len(self.full_articles)} full articles into memory.")
+            logger.info("Loaded %d full articles into memory.", len(self.full_articles))
 
         except Exception as e:
-            logger.error(f"Error loading full articles from {self.articles_path}: {e}")
+            logger.error("Error loading full articles from %s: %s", self.articles_path, e)
             self.full_articles = {}
     
+    def reload_articles(self):
+        """
+        Reload full articles and drop the caches derived from them. Called when the
+        API switches to a new collection version, which may index a newer corpus.
+        """
+        self._load_full_articles()
+        self._article_sentences.cache_clear()
+        self._article_simhashes.cache_clear()
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Sizes of the in-memory article store and the caches derived from it, for profiling snapshots"""
+        articles = self.full_articles
+        if isinstance(articles, RemoteArticles):
+            # Held by the embedding server; this worker only caches recently used ones
+            full_articles = {"count": len(articles), "served_by": articles.client.socket_path, "cached": articles.cached()}
+        else:
+            full_articles = {
+                "count": len(articles),
+                "content_bytes": sum(sys.getsizeof(article.get("content") or "") for article in articles.values())
+            }
+        return {
+            "full_articles": full_articles,
+            "article_sentences_cache": self._article_sentences.cache_info()._asdict(),
+            "article_simhashes_cache": self._article_simhashes.cache_info()._asdict()
+        }
+
+    def set_embedding_function(self, embedding_function):
+        """
+        Share the already-loaded retrieval embedding model, enabling context compression
+        
+        Args:
+            embedding_function: Callable embedding a list of texts (e.g. the ChromaDB embedding function)
+        """
+        if embedding_function is None:
+            self._compressor = None
+            return
+        self._compressor = ContextCompressor(
+            embed=embedding_function,
+            redundancy_threshold=float(os.getenv("COMPRESSION_REDUNDANCY_THRESHOLD", "0.9"))
+        )
+    
+    def _split_article_sentences(self, article_id: str) -> Tuple[str, ...]:
+        """Split a loaded article into sentences (cached via self._article_sentences)"""
+        article = self.full_articles.get(article_id)
+        if not article or not split_sentences:
+            return ()
+        return tuple(split_sentences(article.get("content", ""), article_id))
+
+    def _compute_article_simhash(self, article_id: str) -> Optional[int]:
+        """SimHash of a loaded article, for chunks indexed without a stored signature"""
+        article = self.full_articles.get(article_id)
+        if not article or not compute_simhash:
+            return None
+        return compute_simhash(article.get("content", ""))
+
+    def _suppress_near_duplicates(self, candidates: List[Any], retrieved_metadata: List[Dict[str, Any]]) -> Tuple[List[Any], Dict[str, List[str]]]:
+        """
+        Keep one representative per cluster of near-duplicate articles (reprints, wire stories).
+        The representative inherits its duplicates' relevance, since a story retrieved
+        several times is more likely to matter.
+        
+        Returns:
+            Remaining candidates and a mapping of representative ID to duplicate IDs
+        """
+        signatures = {}
+        for meta in retrieved_metadata:
+            article_id = meta.get("article_id")
+            if article_id and article_id not in signatures:
+                signatures[article_id] = parse_simhash(meta.get("simhash"))
+        for candidate in candidates:
+            if signatures.get(candidate.article_id) is None:
+                signatures[candidate.article_id] = self._article_simhashes(candidate.article_id)
+
+        ranked = sorted(candidates, key=lambda c: c.score, reverse=True)
+        clusters = cluster_near_duplicates([c.article_id for c in ranked], signatures, self.near_duplicate_max_distance)
+        by_id = {c.article_id: c for c in ranked}
+        kept = []
+        duplicates = {}
+        for representative_id, duplicate_ids in clusters.items():
+            candidate = by_id[representative_id]
+            if duplicate_ids:
+                duplicates[representative_id] = duplicate_ids
+                candidate = replace(candidate, score=candidate.score + sum(by_id[d].score for d in duplicate_ids))
+            kept.append(candidate)
+        if duplicates:
+            logger.debug("Suppressed %s near-duplicate articles in %s clusters.", sum(len(d) for d in duplicates.values()), len(duplicates))
+        return kept, duplicates
+
+    def _rank_candidates(self, retrieved_metadata: List[Dict[str, Any]], retrieved_documents: Optional[List[str]],
+                         timings: StageTimings) -> Tuple[List[Any], Dict[str, List[str]], int]:
+        """
+        Group retrieved chunks into ranked article candidates and suppress near-duplicates.
+        Blocking (article lookups, SimHashes, sentence splits); run in a thread.
+
+        Returns:
+            Candidates, representative ID -> near-duplicate IDs, and the number of unique articles
+        """
+        with timings.stage("candidates"), tracer.start_as_current_span("rank_candidates") as span:
+            span.set_attribute("rag.retrieved_chunks", len(retrieved_metadata))
+            full_articles = self.full_articles
+            if isinstance(full_articles, RemoteArticles):
+                # One round trip to the embedding server for all the candidates (also updates its count)
+                full_articles = full_articles.prefetch([meta.get("article_id") for meta in retrieved_metadata])
+            if not self.full_articles:
+                logger.warning("Full articles dictionary is empty. Cannot use full article context.")
+            candidates = rank_article_candidates(
+                retrieved_metadata,
+                full_articles,
+                retrieved_documents=retrieved_documents,
+                get_sentences=self.get_article_sentences
+            )
+            candidate_count = len(candidates)
+            logger.debug("Identified %s unique relevant articles from %s chunks.", len(candidates), len(retrieved_metadata))
+
+            # Only one copy of a reprinted story is worth prompt tokens
+            duplicates = {}
+            if self.near_duplicate_max_distance >= 0 and len(candidates) > 1:
+                candidates, duplicates = self._suppress_near_duplicates(candidates, retrieved_metadata)
+            span.set_attribute("rag.candidates", candidate_count)
+            span.set_attribute("rag.duplicates_suppressed", candidate_count - len(candidates))
+        return candidates, duplicates, candidate_count
+
+    def get_article_sentences(self, article_id: str, content: str) -> List[str]:
+        """
+        Get the sentences of an article, split the same way as at index time
+        
+        Args:
+            article_id: ID of the article
+            content: Article content (only used if the article is not loaded)
+            
+        Returns:
+            List of sentences
+        """
+        if article_id in self.full_articles:
+            return list(self._article_sentences(article_id))
+        return split_sentences(content, article_id) if split_sentences else []
+    
     def get_available_models(self) -> List[Dict[str, str]]:
         """
         Get list of available models with their ID and display name
@@ -153,49 +365,114 @@ class ModelManager:
         """
         return self.providers.get(provider_name)
     
-    async def generate_response(self, user_query: str, retrieved_metadata: List[Dict[str, Any]], model_id: Optional[str] = None) -> Tuple[str, List[str], int, int]:
+    def get_generation_options(self, model_config: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Build the provider options for a model from its configuration
+        
+        Args:
+            model_config: Model configuration dict
+            
+        Returns:
+            Options dict (temperature plus any model-specific options)
         """
-        Generate a response using the specified model and return the answer, used article IDs, prompt token count, and answer token count.
+        options = {
+            "temperature": model_config.get("temperature", 0.3)
+        }
+        if model_config_options := model_config.get("options"):
+            options.update(model_config_options)
+        return options
+    
+    def get_keep_warm_models(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Get the Ollama models to preload and keep resident, with their generation options.
+        
+        Models are selected with `"keep_warm": true` in model_configs.json, or overridden
+        with a comma-separated OLLAMA_WARM_MODELS environment variable.
+        
+        Returns:
+            Mapping of model ID to generation options
+        """
+        env_models = os.getenv("OLLAMA_WARM_MODELS")
+        if env_models is not None:
+            model_ids = [m.strip() for m in env_models.split(",") if m.strip()]
+        else:
+            model_ids = [model_id for model_id, config in self.models.items() if config.get("keep_warm")]
+        
+        warm_models = {}
+        for model_id in model_ids:
+            config = self.models.get(model_id)
+            if not config or config.get("provider") != "ollama":
+                logger.warning("Ignoring keep-warm model %s: not a configured Ollama model", model_id)
+                continue
+            warm_models[model_id] = self.get_generation_options(config)
+        return warm_models
+    
+    async def start_background_tasks(self):
+        """Start provider background tasks (Ollama warm-up and keep-alive pings)"""
+        ollama_provider = self.get_provider("ollama")
+        if ollama_provider:
+            await ollama_provider.start_keep_warm(self.get_keep_warm_models())
+    
+    async def stop_background_tasks(self):
+        """Stop provider background tasks"""
+        ollama_provider = self.get_provider("ollama")
+        if ollama_provider:
+            await ollama_provider.stop_keep_warm()
+    
+    async def generate_response(self, user_query: str, retrieved_metadata: List[Dict[str, Any]], model_id: Optional[str] = None, retrieved_documents: Optional[List[str]] = None, query_embedding: Optional[List[float]] = None, deadline: Optional[Deadline] = None, shared: Optional[SharedContext] = None,
+                                history: Optional[List[Tuple[str, str]]] = None, pinned_article_ids: Optional[List[str]] = None) -> ResponseResult:
+        """
+        Generate a response using the specified model and return the generation result, used article IDs, token counts and suppressed near-duplicates.
 
         Args:
             user_query: The user's original query.
             retrieved_metadata: Metadata list from the top N retrieved chunks.
             model_id: ID of the model to use (or default if None)
+            retrieved_documents: Chunk texts aligned with retrieved_metadata, used to locate
+                passages for chunks indexed without sentence ranges
+            query_embedding: Embedding of user_query, required for context compression
+            deadline: Request deadline; each stage is only started if time is left
+            shared: Candidates and token counts to reuse across models answering the same query
+            history: Earlier (question, answer) pairs of the conversation, added after the context
+            pinned_article_ids: Articles packed in the previous turn of the conversation; they are
+                packed first and in the same order while they still fit, so the prompt prefix is
+                unchanged and provider prefix caches stay warm
 
         Returns:
-            A tuple containing:
-                - The generated response text (str)
-                - A list of article IDs actually used in the context (List[str])
-                - The total number of tokens in the final prompt sent to the LLM (int)
-                - The total number of tokens in the generated answer (int)
+            A ResponseResult. Token counts are those reported by the provider when
+            available, otherwise our estimates. Timings cover the stages from candidate
+            ranking to generation.
 
         Raises:
+            DeadlineExceeded: If the deadline passes between stages
             Exception: If the model or provider is not found or generation fails
         """
+        deadline = deadline or Deadline(None)
         # Use provided model_id or default
         model_id = model_id or self.default_model_id
         
         # Get model configuration
         model_config = self.get_model_config(model_id)
         if not model_config:
-            logger.error(f"Model configuration not found for {model_id}")
+            logger.error("Model configuration not found for %s", model_id)
             raise Exception(f"Model configuration not found: {model_id}")
         
         # Get provider name and options from config
         provider_name = model_config.get("provider")
         if not provider_name:
-            logger.error(f"Provider not specified in config for model {model_id}")
+            logger.error("Provider not specified in config for model %s", model_id)
             raise Exception(f"Provider not specified for model {model_id}")
         
         # Get provider instance
         provider = self.get_provider(provider_name)
         if not provider:
-            logger.error(f"Provider {provider_name} not found")
+            logger.error("Provider %s not found", provider_name)
             raise Exception(f"Provider not found: {provider_name}")
         if not provider.validate_api_key(): # Validate API key early
-            logger.error(f"API key validation failed for provider {provider_name}")
+            logger.error("API key validation failed for provider %s", provider_name)
             raise Exception(f"API key not configured for provider {provider_name}")
 
+        timings = StageTimings()
         # Initialize token counting specific variables
         encoding = None
         # --- Removed Gemini-specific model instance initialization --- 
@@ -213,16 +490,34 @@ class ModelManager:
             try:
                 encoding = tiktoken.encoding_for_model(model_id)
             except KeyError:
-                logger.warning(f"No specific tiktoken encoding for {model_id}. Using cl100k_base.")
+                logger.debug("No specific tiktoken encoding for %s. Using cl100k_base.", model_id)
                 encoding = tiktoken.get_encoding("cl100k_base")
         elif provider_name != "gemini":
             logger.warning("tiktoken not available. Using approximate word count for non-Gemini models.")
             # Basic fallback for non-gemini
             encoding = type('obj', (object,), {'encode': lambda text: text.split()})()
 
+        # Models with the same tokenizer count the same texts alike (Gemini counts per model)
+        tokenizer_key = f"gemini:{model_id}" if provider_name == "gemini" else getattr(encoding, "name", "words")
+
         # Define token counting function based on provider
-        # NOTE: This function is now synchronous
+        # NOTE: This function is synchronous (a network call for Gemini), so it is only called in threads
         def count_tokens_func(text_to_count: str) -> int:
+            if shared is not None:
+                # Keyed by a digest, so cached counts do not keep the article texts alive
+                key = (tokenizer_key, hashlib.blake2b(text_to_count.encode("utf-8"), digest_size=16).digest())
+                tokens = shared.token_counts.get(key)
+                if tokens is not None:
+                    return tokens
+            with timings.stage("token_counting"), tracer.start_as_current_span("count_tokens") as span:
+                tokens = _count_tokens(text_to_count)
+                span.set_attribute("rag.chars", len(text_to_count))
+                span.set_attribute("rag.tokens", tokens)
+            if shared is not None:
+                shared.token_counts[key] = tokens
+            return tokens
+
+        def _count_tokens(text_to_count: str) -> int:
             # --- Use the new SDK client for Gemini token counting --- 
             if provider_name == "gemini":
                 try:
@@ -241,7 +536,7 @@ class ModelManager:
                         logger.error("Gemini provider or client not initialized for token counting. Falling back.")
                         return len(text_to_count.split()) # Fallback
                 except Exception as e:
-                    logger.error(f"Gemini count_tokens (google-genai SDK) failed: {e}. Falling back to approx.")
+                    logger.error("Gemini count_tokens (google-genai SDK) failed: %s. Falling back to approx.", e)
                     return len(text_to_count.split()) # Fallback
             elif encoding: # Use tiktoken for other providers if available
                 return len(encoding.encode(text_to_count))
@@ -251,14 +546,13 @@ class ModelManager:
         # --- Context Building & Token Calculation --- 
         
         # Extract base options from config
-        options = {
-            "temperature": model_config.get("temperature", 0.3)
-        }
-        if model_config_options := model_config.get("options"):
-            options.update(model_config_options)
+        options = self.get_generation_options(model_config)
 
-        # Define Max Tokens (remains the same logic)
+        # Define Max Tokens. For Ollama, num_ctx is the window actually allocated,
+        # anything beyond it is silently truncated by the server.
         max_model_tokens = model_config.get("context_window", 4096)
+        if options.get("num_ctx"):
+            max_model_tokens = min(max_model_tokens, int(options["num_ctx"]))
         output_buffer = options.get("maxOutputTokens", options.get("max_tokens", 1024)) 
         max_prompt_tokens = max_model_tokens - output_buffer
 
@@ -294,86 +588,156 @@ User question: {user_query}
 Answer:
 """)
         # Calculate base prompt tokens using the appropriate method
-        # Need to call the sync function directly
+        # Token counting, ranking and packing run in threads: they may make network calls
+        # (Gemini token counts), and the event loop must keep serving other requests
+        building_start = time.perf_counter()
         base_prompt_for_calc = base_prompt_template.format(context_section="placeholder", user_query="placeholder")
-        base_prompt_tokens = count_tokens_func(base_prompt_for_calc)
-
-        # Identify Relevant Articles (remains the same logic)
-        ranked_article_ids = []
-        seen_article_ids = set()
-        if not self.full_articles:
-             logger.warning("Full articles dictionary is empty. Cannot use full article context.")
+        base_prompt_tokens = await run_in_thread(deadline, count_tokens_func, base_prompt_for_calc)
+        building = time.perf_counter() - building_start
+
+        # Identify relevant articles and pack them (full text or excerpts) into the remaining budget
+        deadline.enter("candidates")
+        if shared is not None:
+            ranking = shared.ranked.get(len(retrieved_metadata))
+            if ranking is None:
+                ranking = shared.ranked[len(retrieved_metadata)] = asyncio.ensure_future(asyncio.to_thread(
+                    self._rank_candidates, retrieved_metadata, retrieved_documents, timings))
+            # Other models await the same ranking (started by the first); one model giving up does not cancel it
+            candidates, duplicates, candidate_count = await asyncio.shield(ranking)
+            candidates = list(candidates)
         else:
-            for meta in retrieved_metadata:
-                article_id = meta.get("article_id")
-                if article_id and article_id in self.full_articles and article_id not in seen_article_ids:
-                    ranked_article_ids.append(article_id)
-                    seen_article_ids.add(article_id)
-        logger.info(f"Identified {len(ranked_article_ids)} unique relevant articles from {len(retrieved_metadata)} chunks.")
-
-        # Add Full Article Content Iteratively using accurate token counts
-        included_articles_content = []
-        used_article_ids = []
-        current_context_tokens = 0
-        separator = "\n\n--- ARTICLE START ---\n\n"
-        num_articles_included = 0
-
-        for article_id in ranked_article_ids:
-            article_data = self.full_articles.get(article_id)
-            if not article_data or not article_data.get("content"):
-                logger.warning(f"Skipping article {article_id}: No content found.")
-                continue
+            candidates, duplicates, candidate_count = await run_in_thread(
+                deadline, self._rank_candidates, retrieved_metadata, retrieved_documents, timings)
 
-            article_content = article_data["content"] 
-            article_title = article_data.get("title", "Untitled")
-            article_meta_header = f"Title: {article_title}\n---\n"
-            # Construct text to add *for token calculation*
-            text_to_add_for_calc = (separator + article_meta_header + article_content) if included_articles_content else (article_meta_header + article_content)
-
-            # Calculate article tokens using the appropriate method (sync call)
-            article_tokens = count_tokens_func(text_to_add_for_calc)
-
-            # --- DEBUG LOG START ---
-            logger.debug(f"Article {article_id}: Content length={len(article_content)}, Calculated tokens={article_tokens}, Cumulative tokens={current_context_tokens + article_tokens}")
-            # --- DEBUG LOG END ---
-
-            if base_prompt_tokens + current_context_tokens + article_tokens <= max_prompt_tokens:
-                # If it fits, add the actual content (with separator if needed)
-                actual_text_to_append = (separator + article_meta_header + article_content) if included_articles_content else (article_meta_header + article_content)
-                included_articles_content.append(actual_text_to_append)
-                current_context_tokens += article_tokens # Add the calculated tokens
-                num_articles_included += 1
-                used_article_ids.append(article_id)
+        # Optionally reduce articles to their most relevant, non-redundant sentences (small context models)
+        if model_config.get("compress_context") and candidates:
+            if self._compressor is None or query_embedding is None:
+                logger.warning("Context compression requested for %s but no embedding model/query embedding is available. Skipping.", model_id)
             else:
-                logger.warning(f"Context truncated for model {model_id}. Stopped after {num_articles_included}/{len(ranked_article_ids)} articles due to token limit ({max_prompt_tokens} prompt tokens max). Last article ({article_id}) considered required {article_tokens} tokens.)")
-                break
-
-        final_context_str = "".join(included_articles_content)
+                deadline.enter("compression")
+                with timings.stage("compression"), tracer.start_as_current_span("compress_context") as span:
+                    span.set_attribute("rag.candidates", len(candidates))
+                    candidates = await asyncio.to_thread(
+                        self._compressor.compress,
+                        query_embedding,
+                        candidates,
+                        self.get_article_sentences,
+                        model_config.get("compression_sentences_per_article", 8)
+                    )
+
+        if pinned_article_ids and candidates:
+            pinned = {article_id: i for i, article_id in enumerate(pinned_article_ids)}
+            top_score = max(candidate.score for candidate in candidates)
+            candidates = [replace(candidate, score=top_score + len(pinned) - pinned[candidate.article_id])
+                          if candidate.article_id in pinned else candidate for candidate in candidates]
+
+        deadline.enter("prompt_building")
+        building_start = time.perf_counter()
+        history_section = ""
+        if history:
+            # Not labelled "User question:", which the Anthropic provider splits the prompt on
+            history_section = "\n\nPrevious conversation:\n" + "\n\n".join(
+                f"Earlier question: {question}\nEarlier answer: {answer}" for question, answer in history)
+
+        def build_context():
+            history_tokens = count_tokens_func(history_section) if history_section else 0
+            packer = ContextPacker(
+                count_tokens=count_tokens_func,
+                max_tokens=max_prompt_tokens - base_prompt_tokens - history_tokens,
+                get_sentences=self.get_article_sentences,
+                neighbour_sentences=model_config.get("excerpt_neighbour_sentences", 2),
+                long_article_tokens=model_config.get("max_article_tokens"),
+                check=deadline.check
+            )
+            with tracer.start_as_current_span("pack_context") as span:
+                packed = packer.pack(candidates)
+                span.set_attribute("rag.max_tokens", packer.max_tokens)
+                span.set_attribute("rag.context_tokens", packed.tokens)
+                span.set_attribute("rag.articles", len(packed.article_ids))
+                span.set_attribute("rag.excerpted", len(packed.excerpted_ids))
+                span.set_attribute("rag.skipped", len(packed.skipped_ids))
+            return packed, history_tokens
+
+        packed, history_tokens = await run_in_thread(deadline, build_context)
+        used_article_ids = packed.article_ids
+        if packed.skipped_ids:
+            logger.warning("Context truncated for model %s: %s/%s articles did not fit in %s prompt tokens.", model_id, len(packed.skipped_ids), len(candidates), max_prompt_tokens)
+
+        final_context_str = packed.text
         final_prompt = base_prompt_template.format(
-            context_section=final_context_str if final_context_str else "No context available.",
+            context_section=(final_context_str if final_context_str else "No context available.") + history_section,
             user_query=user_query
         )
+        # Prompt building excludes the token counting done while packing, which is reported on its own
+        building += time.perf_counter() - building_start
+        timings.add("prompt_building", building - timings.stages.get("token_counting", 0.0))
         
         # Calculate final prompt tokens accurately (sync call)
         # !!! BUG FIX: Use the sum of tokens calculated during context building, 
         #     don't recalculate on the potentially huge final_prompt string !!!
         # final_prompt_token_count = count_tokens_func(final_prompt) # Old buggy way
-        final_prompt_token_count = base_prompt_tokens + current_context_tokens # Correct way
-        logger.info(f"Constructed final prompt with {num_articles_included} full articles (IDs: {used_article_ids}), calculated {final_prompt_token_count} tokens (limit: {max_prompt_tokens}).")
+        final_prompt_token_count = base_prompt_tokens + packed.tokens + history_tokens # Correct way
+        logger.debug("Constructed final prompt with %s articles (%s excerpted, IDs: %s), calculated %s tokens (limit: %s).", len(used_article_ids), len(packed.excerpted_ids), used_article_ids, final_prompt_token_count, max_prompt_tokens)
 
         # --- Generate response using the chosen provider --- 
+        # A cancelled request (client gone, deadline passed) cancels the provider call, which closes its HTTP stream
+        deadline.enter("generation")
         try:
             # The provider.generate method only needs the final prompt, model_id, and options
-            answer = await provider.generate(final_prompt, model_id, options)
+            # Exceptions are recorded on the span, which is marked as failed
+            with tracer.start_as_current_span("provider.generate") as span:
+                span.set_attribute("rag.model", model_id)
+                span.set_attribute("rag.provider", provider_name)
+                span.set_attribute("rag.prompt_tokens_estimate", final_prompt_token_count)
+                provider_start = time.perf_counter()
+                result = await provider.generate(final_prompt, model_id, options)
+                provider_seconds = time.perf_counter() - provider_start
+                # Providers that queue requests (Ollama model slots) report the wait separately
+                queue_wait = min(result.timings.get("queue_wait", 0.0), provider_seconds)
+                span.set_attribute("rag.queue_wait", queue_wait)
+                for key, value in (("rag.input_tokens", result.input_tokens), ("rag.output_tokens", result.output_tokens),
+                                   ("rag.cached_tokens", result.cached_tokens)):
+                    if value is not None:
+                        span.set_attribute(key, value)
+            timings.add("provider_queue", queue_wait)
+            # Providers reporting their own phases (Ollama: model load, prompt evaluation, decoding)
+            # get them as stages; generation keeps the rest (transfer, scheduling)
+            generation_seconds = provider_seconds - queue_wait
+            for phase in _PROVIDER_PHASES:
+                if phase in result.timings:
+                    seconds = min(result.timings[phase], generation_seconds)
+                    timings.add(f"provider_{phase}", seconds)
+                    generation_seconds -= seconds
+            timings.add("generation", generation_seconds)
             
-            # Calculate answer token count accurately (sync call)
-            answer_token_count = count_tokens_func(answer)
-            logger.info(f"Calculated answer token count: {answer_token_count}")
-
-            # Return answer, used IDs, and both token counts
-            return answer, used_article_ids, final_prompt_token_count, answer_token_count 
+            # Prefer the usage reported by the provider over re-tokenising locally
+            if result.input_tokens is not None:
+                final_prompt_token_count = result.input_tokens
+            if result.output_tokens is not None:
+                answer_token_count = result.output_tokens
+            else:
+                answer_token_count = await asyncio.to_thread(count_tokens_func, result.text)
+                logger.debug("Provider did not report usage; estimated answer token count: %s", answer_token_count)
+            logger.debug("Usage for %s: input=%s, output=%s, cached=%s, timings=%s", model_id, final_prompt_token_count, answer_token_count, result.cached_tokens, result.timings)
+
+            return ResponseResult(
+                generation=result,
+                used_article_ids=used_article_ids,
+                prompt_token_count=final_prompt_token_count,
+                answer_token_count=answer_token_count,
+                duplicate_article_ids={a: duplicates[a] for a in used_article_ids if a in duplicates},
+                timings=timings.stages,
+                candidate_count=candidate_count,
+                context_tokens=packed.tokens,
+                skipped_article_ids=packed.skipped_ids
+            )
+        except EmbeddingServerError as e:
+            # Articles unavailable, not a provider failure: the API answers 503
+            logger.error("Embedding server failed while building the context for %s: %s", model_id, e)
+            raise
         except Exception as e:
-            logger.error(f"Error generating response with {model_id}: {e}")
+            PROVIDER_ERRORS.labels(model_id, provider_name).inc()
+            logger.error("Error generating response with %s: %s", model_id, e)
             raise
 
 # Create a singleton instance
@@ -1,8 +1,9 @@
 import os
+import time
 import logging
 import anthropic
-from typing import Dict, Any, Optional
-from .base import LLMProvider
+from typing import Dict, Any
+from .base import LLMProvider, GenerationResult
 
 logger = logging.getLogger(__name__)
 
@@ -19,14 +20,14 @@ class AnthropicProvider(LLMProvider):
             logger.warning("Anthropic API key not found in environment.")
             # The validate_api_key method will handle checks before generation
 
-    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> str:
+    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> GenerationResult:
         """
         Generate text using Anthropic API
         """
         if not self.validate_api_key():
             raise Exception("Anthropic API key not configured")
 
-        logger.info(f"Generating response with Anthropic model: {model_id}")
+        logger.debug("Generating response with Anthropic model: %s", model_id)
 
         # Extract relevant options or use defaults
         max_tokens = options.get("maxOutputTokens", 1024) # Use maxOutputTokens from config
@@ -59,6 +60,7 @@ class AnthropicProvider(LLMProvider):
             async_client = anthropic.AsyncAnthropic(api_key=self.api_key)
             
             # Use streaming API
+            start = time.perf_counter()
             response_chunks = []
             async with async_client.messages.stream(
                 model=model_id,
@@ -69,18 +71,29 @@ class AnthropicProvider(LLMProvider):
             ) as stream:
                 async for text in stream.text_stream:
                     response_chunks.append(text)
+                final_message = await stream.get_final_message()
             
             answer = "".join(response_chunks)
             logger.info("Anthropic streaming response received successfully")
-            return answer.strip()
+            # input_tokens excludes prompt-cache reads/writes; report the full prompt size
+            usage = final_message.usage
+            cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+            cache_creation = getattr(usage, "cache_creation_input_tokens", None) or 0
+            return GenerationResult(
+                text=answer.strip(),
+                input_tokens=usage.input_tokens + cache_read + cache_creation,
+                output_tokens=usage.output_tokens,
+                cached_tokens=cache_read,
+                timings={"wall": time.perf_counter() - start}
+            )
 
         except anthropic.APIError as e:
-            logger.error(f"Anthropic API error: {e}")
+            logger.error("Anthropic API error: %s", e)
             # Provide more context if possible, e.g., status code
             details = f"Status Code: {e.status_code}, Message: {e.message}" if hasattr(e, 'status_code') else str(e)
             raise Exception(f"Error communicating with Anthropic service: {details}")
         except Exception as e:
-            logger.exception(f"Unexpected error with Anthropic API call: {e}") # Use logger.exception for traceback
+            logger.exception("Unexpected error with Anthropic API call: %s", e) # Use logger.exception for traceback
             raise Exception(f"Unexpected error during Anthropic API call: {e}")
 
     def validate_api_key(self) -> bool:
@@ -1,12 +1,25 @@
 from abc import ABC, abstractmethod
+from dataclasses import dataclass, field
 from typing import Dict, Any, Optional
 
+@dataclass
+class GenerationResult:
+    """
+    Result of a provider generation call, with the usage reported by the provider itself.
+    Token counts are None when the provider did not report them.
+    """
+    text: str
+    input_tokens: Optional[int] = None # Prompt tokens billed/processed by the provider
+    output_tokens: Optional[int] = None # Generated tokens (including thinking tokens where reported)
+    cached_tokens: Optional[int] = None # Prompt tokens served from the provider's prompt cache
+    timings: Dict[str, float] = field(default_factory=dict) # Stage durations in seconds
+
 class LLMProvider(ABC):
     """
     Abstract base class for LLM providers
     """
     @abstractmethod
-    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> str:
+    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> GenerationResult:
         """
         Generate a response from the LLM.
         
@@ -16,7 +29,7 @@ class LLMProvider(ABC):
             options: Additional options for the model
             
         Returns:
-            The generated text response
+            A GenerationResult with the generated text, token usage and timings
         """
         pass
     
@@ -28,4 +41,4 @@ class LLMProvider(ABC):
         Returns:
             True if valid, False otherwise
         """
-        pass
\ No newline at end of file
+        pass
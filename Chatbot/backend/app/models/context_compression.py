@@ -0,0 +1,159 @@
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+from .context_packer import ArticleCandidate
+
+logger = logging.getLogger(__name__)
+
+# Sentences shorter than this (in words) are headings/bylines; never worth a slot
+MIN_SENTENCE_WORDS = 4
+
+
+class ContextCompressor:
+    """
+    Extractive compression of retrieved articles before packing.
+
+    Sentences close to the retrieved chunks are scored against the query embedding;
+    each article keeps its best sentences (in original order), and sentences that
+    repeat something already kept from a better-ranked article are dropped. Small
+    context models then get more distinct evidence per prompt token.
+    """
+    def __init__(self,
+                 embed: Callable[[List[str]], Sequence[Sequence[float]]],
+                 redundancy_threshold: float = 0.9,
+                 window_sentences: int = 5,
+                 max_sentences: int = 256,
+                 cache_size: int = 10000):
+        """
+        Args:
+            embed: Embedding function (the same model used for retrieval), called on batches of texts
+            redundancy_threshold: Cosine similarity above which a sentence counts as a repeat
+            window_sentences: Sentences around each retrieved chunk considered for selection
+            max_sentences: Cap on sentences embedded per query, to bound CPU time
+            cache_size: Number of sentence embeddings kept between queries
+        """
+        self.embed = embed
+        self.redundancy_threshold = redundancy_threshold
+        self.window_sentences = window_sentences
+        self.max_sentences = max_sentences
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        # compress() runs in worker threads; the cache and the model are shared
+        self._lock = threading.Lock()
+
+    def _embed_normalized(self, sentences: List[str]) -> np.ndarray:
+        """Embed sentences (unit-normalised), reusing cached vectors and batching the misses."""
+        missing = [s for s in dict.fromkeys(sentences) if s not in self._cache]
+        if missing:
+            vectors = np.asarray(self.embed(missing), dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.maximum(norms, 1e-12)
+            for sentence, vector in zip(missing, vectors):
+                self._cache[sentence] = vector
+        rows = []
+        for sentence in sentences:
+            self._cache.move_to_end(sentence)
+            rows.append(self._cache[sentence])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return np.vstack(rows) if rows else np.zeros((0, 0), dtype=np.float32)
+
+    def _candidate_indices(self, candidate: ArticleCandidate, num_sentences: int) -> List[int]:
+        """Sentence indices worth scoring: a window around the retrieved chunks, or the whole article."""
+        if not candidate.hit_spans:
+            return list(range(num_sentences))
+        indices = set()
+        for start, end in candidate.hit_spans:
+            indices.update(range(max(0, start - self.window_sentences), min(num_sentences, end + self.window_sentences)))
+        return sorted(indices)
+
+    def compress(self,
+                 query_embedding: Sequence[float],
+                 candidates: List[ArticleCandidate],
+                 get_sentences: Callable[[str, str], List[str]],
+                 sentences_per_article: int = 8) -> List[ArticleCandidate]:
+        """
+        Compress candidates to their most query-relevant, non-redundant sentences.
+
+        Args:
+            query_embedding: Embedding of the user query
+            candidates: Ranked article candidates
+            get_sentences: Sentence splitter taking (article_id, content)
+            sentences_per_article: Maximum sentences kept per article
+
+        Returns:
+            New candidates whose content is the selected sentences; articles left with
+            nothing new to say are dropped
+        """
+        ordered = sorted(candidates, key=lambda c: c.score, reverse=True)
+
+        # Collect (candidate position, sentence index, text) triples within the CPU budget
+        entries = []
+        sentences_by_candidate = []
+        for position, candidate in enumerate(ordered):
+            sentences = get_sentences(candidate.article_id, candidate.content)
+            sentences_by_candidate.append(sentences)
+            for idx in self._candidate_indices(candidate, len(sentences)):
+                if len(entries) >= self.max_sentences:
+                    break
+                if len(sentences[idx].split()) >= MIN_SENTENCE_WORDS:
+                    entries.append((position, idx, sentences[idx]))
+
+        if not entries:
+            return candidates
+
+        with self._lock:
+            vectors = self._embed_normalized([text for _, _, text in entries])
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = vectors @ query
+
+        rows_by_candidate: List[List[int]] = [[] for _ in ordered]
+        for row, (position, _, _) in enumerate(entries):
+            rows_by_candidate[position].append(row)
+
+        kept = np.zeros((len(entries), vectors.shape[1]), dtype=np.float32)
+        num_kept = 0
+        selected: List[List[int]] = [[] for _ in ordered]
+        # Articles are visited in rank order so repeats are attributed to the best-ranked source
+        for position, rows in enumerate(rows_by_candidate):
+            for row in sorted(rows, key=lambda r: scores[r], reverse=True):
+                if len(selected[position]) >= sentences_per_article:
+                    break
+                if num_kept and float(np.max(kept[:num_kept] @ vectors[row])) > self.redundancy_threshold:
+                    continue
+                kept[num_kept] = vectors[row]
+                num_kept += 1
+                selected[position].append(entries[row][1])
+
+        compressed = []
+        for candidate, sentences, rows, indices in zip(ordered, sentences_by_candidate, rows_by_candidate, selected):
+            if indices:
+                compressed.append(replace(candidate, content=self._join(sentences, sorted(indices)), hit_spans=[]))
+            elif not rows:
+                # Nothing scorable (beyond the CPU budget or too short): leave it to the packer
+                compressed.append(candidate)
+            else:
+                logger.debug("Dropping article %s: all its relevant sentences are redundant", candidate.article_id)
+
+        logger.debug("Compressed %s articles to %s sentences (%s scored, %s articles dropped as redundant)", len(candidates), sum(len(s) for s in selected), len(entries), len(candidates) - len(compressed))
+        return compressed
+
+    @staticmethod
+    def _join(sentences: List[str], indices: List[int]) -> str:
+        """Join selected sentences in article order, marking omitted text with [...]."""
+        parts = []
+        previous: Optional[int] = None
+        for idx in indices:
+            if (previous is None and idx > 0) or (previous is not None and idx != previous + 1):
+                parts.append("[...]")
+            parts.append(sentences[idx])
+            previous = idx
+        if previous is not None and previous < len(sentences) - 1:
+            parts.append("[...]")
+        return " ".join(parts)
@@ -0,0 +1,241 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Separator placed between articles in the context section
+ARTICLE_SEPARATOR = "\n\n--- ARTICLE START ---\n\n"
+# Separator placed between non-contiguous passages of an excerpted article
+PASSAGE_SEPARATOR = "\n[...]\n"
+# Stop packing once less than this many tokens remain; nothing useful fits anymore
+MIN_ITEM_TOKENS = 64
+
+
+@dataclass
+class ArticleCandidate:
+    """
+    A retrieved article that may be packed into the prompt context.
+    """
+    article_id: str
+    title: str
+    content: str
+    score: float # Relevance of the article, aggregated over its retrieved chunks
+    hit_spans: List[Tuple[int, int]] = field(default_factory=list) # Sentence ranges [start, end) of retrieved chunks
+
+
+@dataclass
+class PackedContext:
+    """
+    Result of packing candidates into a token budget.
+    """
+    text: str
+    tokens: int
+    article_ids: List[str] # Articles included, in prompt order
+    excerpted_ids: List[str] # Subset of article_ids included as excerpts rather than full text
+    skipped_ids: List[str] # Articles that did not fit in any form
+
+
+def locate_chunk_span(sentences: List[str], chunk_text: str) -> Optional[Tuple[int, int]]:
+    """
+    Find the sentence range of an article covered by a chunk text.
+    Used for chunks indexed before sent_start/sent_end were stored in the metadata.
+
+    Returns:
+        The longest contiguous [start, end) run of sentences contained in the chunk, or None
+    """
+    best: Optional[Tuple[int, int]] = None
+    run_start = None
+    for idx, sentence in enumerate(sentences + [None]):
+        if sentence is not None and sentence.strip() and sentence.strip() in chunk_text:
+            if run_start is None:
+                run_start = idx
+            continue
+        if run_start is not None:
+            if best is None or idx - run_start > best[1] - best[0]:
+                best = (run_start, idx)
+            run_start = None
+    return best
+
+
+class ContextPacker:
+    """
+    Packs ranked articles into a prompt token budget.
+
+    Articles are considered in order of relevance. Short articles are included in full;
+    long ones (or ones that no longer fit) are reduced to the passages around their
+    retrieved chunks. An article that does not fit in any form is skipped and packing
+    continues with the next one, so a single long article cannot block smaller ones.
+    """
+    def __init__(self,
+                 count_tokens: Callable[[str], int],
+                 max_tokens: int,
+                 get_sentences: Callable[[str, str], List[str]],
+                 neighbour_sentences: int = 2,
+                 long_article_tokens: Optional[int] = None,
+                 check: Optional[Callable[[], None]] = None):
+        """
+        Args:
+            count_tokens: Token counting function for the target model
+            max_tokens: Token budget for the whole context section
+            get_sentences: Sentence splitter taking (article_id, content), as used at index time
+            neighbour_sentences: Sentences of surrounding text kept around each retrieved chunk
+            long_article_tokens: Articles above this size are excerpted even if they would fit
+            check: Called before each article and variant is counted; raises to abandon
+                packing (e.g. Deadline.check, as counting may be a remote call per text)
+        """
+        self.count_tokens = count_tokens
+        self.max_tokens = max_tokens
+        self.get_sentences = get_sentences
+        self.neighbour_sentences = neighbour_sentences
+        self.long_article_tokens = long_article_tokens if long_article_tokens is not None else max(max_tokens // 3, MIN_ITEM_TOKENS)
+        self.check = check or (lambda: None)
+
+    def _excerpt(self, candidate: ArticleCandidate, neighbours: int) -> Optional[str]:
+        """Build an excerpt made of the retrieved passages plus `neighbours` sentences on each side."""
+        if not candidate.hit_spans:
+            return None
+        sentences = self.get_sentences(candidate.article_id, candidate.content)
+        if not sentences:
+            return None
+
+        spans = sorted(
+            (max(0, start - neighbours), min(len(sentences), end + neighbours))
+            for start, end in candidate.hit_spans
+        )
+        merged: List[List[int]] = []
+        for start, end in spans:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        passages = [" ".join(sentences[start:end]) for start, end in merged if end > start]
+        if not passages:
+            return None
+        # Mark omitted text at the edges too, so the model knows it is reading extracts
+        prefix = "[...] " if merged[0][0] > 0 else ""
+        suffix = " [...]" if merged[-1][1] < len(sentences) else ""
+        return prefix + PASSAGE_SEPARATOR.join(passages) + suffix
+
+    def _variants(self, candidate: ArticleCandidate, is_first: bool) -> Iterator[Tuple[str, int, bool]]:
+        """
+        Yield (block text, token count, is_excerpt) for a candidate, from largest to smallest.
+        Token counts are computed lazily since counting may be a remote call.
+        """
+        separator = "" if is_first else ARTICLE_SEPARATOR
+
+        full_block = f"{separator}Title: {candidate.title}\n---\n{candidate.content}"
+        self.check()
+        full_tokens = self.count_tokens(full_block)
+        is_long = full_tokens > self.long_article_tokens
+        if not is_long:
+            yield full_block, full_tokens, False
+
+        seen_texts = {candidate.content}
+        for neighbours in (self.neighbour_sentences, 0):
+            excerpt = self._excerpt(candidate, neighbours)
+            if not excerpt or excerpt in seen_texts:
+                continue
+            seen_texts.add(excerpt)
+            block = f"{separator}Title: {candidate.title} (excerpts)\n---\n{excerpt}"
+            self.check()
+            yield block, self.count_tokens(block), True
+
+        # A long article we could not excerpt is still better than nothing if it fits
+        if is_long and len(seen_texts) == 1:
+            yield full_block, full_tokens, False
+
+    def pack(self, candidates: List[ArticleCandidate]) -> PackedContext:
+        """
+        Pack candidates into the token budget.
+
+        Args:
+            candidates: Articles to consider, in any order (they are sorted by score)
+
+        Returns:
+            The packed context
+        """
+        blocks: List[str] = []
+        article_ids: List[str] = []
+        excerpted_ids: List[str] = []
+        skipped_ids: List[str] = []
+        used_tokens = 0
+
+        ordered = sorted(candidates, key=lambda c: c.score, reverse=True)
+        for position, candidate in enumerate(ordered):
+            remaining = self.max_tokens - used_tokens
+            if remaining < MIN_ITEM_TOKENS:
+                skipped_ids.extend(c.article_id for c in ordered[position:])
+                break
+
+            for block, tokens, is_excerpt in self._variants(candidate, is_first=not blocks):
+                if tokens <= remaining:
+                    blocks.append(block)
+                    article_ids.append(candidate.article_id)
+                    if is_excerpt:
+                        excerpted_ids.append(candidate.article_id)
+                    used_tokens += tokens
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Packed article %s (%s): %s tokens, cumulative %s/%s", candidate.article_id,
+                                     "excerpt" if is_excerpt else "full", tokens, used_tokens, self.max_tokens)
+                    break
+            else:
+                skipped_ids.append(candidate.article_id)
+
+        return PackedContext(
+            text="".join(blocks),
+            tokens=used_tokens,
+            article_ids=article_ids,
+            excerpted_ids=excerpted_ids,
+            skipped_ids=skipped_ids
+        )
+
+
+def rank_article_candidates(retrieved_metadata: List[Dict[str, Any]],
+                            full_articles: Dict[str, Dict[str, Any]],
+                            retrieved_documents: Optional[List[str]] = None,
+                            get_sentences: Optional[Callable[[str, str], List[str]]] = None) -> List[ArticleCandidate]:
+    """
+    Group retrieved chunks by article and build packing candidates.
+
+    An article's score is the sum of the reciprocal ranks of its chunks, so articles
+    with several well-ranked chunks come first. Chunk sentence ranges come from the
+    sent_start/sent_end metadata, or are located from the chunk text for older indexes.
+
+    Args:
+        retrieved_metadata: Chunk metadata in retrieval rank order
+        full_articles: Full article dicts keyed by article ID
+        retrieved_documents: Chunk texts aligned with retrieved_metadata (optional)
+        get_sentences: Sentence splitter taking (article_id, content), used to locate chunk texts
+
+    Returns:
+        Candidates in order of first appearance
+    """
+    candidates: Dict[str, ArticleCandidate] = {}
+    for rank, meta in enumerate(retrieved_metadata):
+        article_id = meta.get("article_id")
+        article = full_articles.get(article_id) if article_id else None
+        if not article or not article.get("content"):
+            continue
+
+        candidate = candidates.get(article_id)
+        if candidate is None:
+            candidate = ArticleCandidate(
+                article_id=article_id,
+                title=article.get("title", "Untitled"),
+                content=article["content"],
+                score=0.0
+            )
+            candidates[article_id] = candidate
+        candidate.score += 1.0 / (rank + 1)
+
+        span = None
+        if meta.get("sent_start") is not None and meta.get("sent_end") is not None:
+            span = (int(meta["sent_start"]), int(meta["sent_end"]))
+        elif retrieved_documents is not None and get_sentences is not None and rank < len(retrieved_documents):
+            span = locate_chunk_span(get_sentences(article_id, article["content"]), retrieved_documents[rank])
+        if span and span[1] > span[0]:
+            candidate.hit_spans.append(span)
+
+    return list(candidates.values())
@@ -0,0 +1,98 @@
+import logging
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+SIMHASH_BITS = 64
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two signatures."""
+    return bin(a ^ b).count("1")
+
+
+def parse_simhash(value: Optional[str]) -> Optional[int]:
+    """Parse a hex SimHash stored in chunk metadata (empty/missing -> None)."""
+    if not value:
+        return None
+    try:
+        return int(value, 16)
+    except (TypeError, ValueError):
+        return None
+
+
+class SimHashIndex:
+    """
+    Band index over SimHash signatures for near-duplicate lookup.
+
+    Signatures are split into max_distance + 1 bands: two signatures within
+    max_distance bits of each other must agree exactly on at least one band
+    (pigeonhole principle), so only signatures sharing a band are compared.
+    """
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        num_bands = max_distance + 1
+        band_width = -(-SIMHASH_BITS // num_bands) # Ceiling division
+        self._bands = [
+            (offset, (1 << min(band_width, SIMHASH_BITS - offset)) - 1)
+            for offset in range(0, SIMHASH_BITS, band_width)
+        ]
+        self._buckets: List[Dict[int, List[str]]] = [{} for _ in self._bands]
+        self._signatures: Dict[str, int] = {}
+        self._positions: Dict[str, int] = {} # Insertion order of the keys
+
+    def add(self, key: str, signature: int):
+        self._signatures[key] = signature
+        self._positions.setdefault(key, len(self._positions))
+        for (offset, mask), buckets in zip(self._bands, self._buckets):
+            buckets.setdefault(signature >> offset & mask, []).append(key)
+
+    def query(self, signature: int) -> List[str]:
+        """Keys whose signatures are within max_distance of the given one, in insertion order."""
+        seen = set()
+        matches = []
+        for (offset, mask), buckets in zip(self._bands, self._buckets):
+            for key in buckets.get(signature >> offset & mask, []):
+                if key in seen:
+                    continue
+                seen.add(key)
+                if hamming_distance(signature, self._signatures[key]) <= self.max_distance:
+                    matches.append(key)
+        # Bands are scanned in turn, so a key found through a later band may have been added first
+        return sorted(matches, key=self._positions.__getitem__)
+
+
+def cluster_near_duplicates(ranked_ids: List[str], signatures: Dict[str, Optional[int]], max_distance: int) -> Dict[str, List[str]]:
+    """
+    Group near-duplicate articles, keeping the best-ranked one as representative.
+
+    Args:
+        ranked_ids: Article IDs in order of relevance
+        signatures: SimHash per article ID (None if unknown; such articles are never clustered)
+        max_distance: Maximum Hamming distance between near-duplicates
+
+    Returns:
+        Mapping of representative ID to the IDs of its duplicates (in rank order).
+        Articles without duplicates map to an empty list.
+    """
+    index = SimHashIndex(max_distance)
+    clusters: Dict[str, List[str]] = {}
+    representative_of: Dict[str, str] = {}
+
+    for article_id in ranked_ids:
+        signature = signatures.get(article_id)
+        if signature is None:
+            clusters[article_id] = []
+            continue
+        matches = index.query(signature)
+        if matches:
+            # Join the cluster of the best-ranked match
+            representative = representative_of[matches[0]]
+            clusters[representative].append(article_id)
+            representative_of[article_id] = representative
+        else:
+            clusters[article_id] = []
+            representative_of[article_id] = article_id
+        index.add(article_id, signature)
+
+    return clusters
@@ -1,7 +1,8 @@
 import os
+import time
 import logging
 from typing import Dict, Any
-from .base import LLMProvider
+from .base import LLMProvider, GenerationResult
 # Updated imports for the new SDK
 from google import genai
 from google.genai import types 
@@ -29,20 +30,20 @@ class GeminiProvider(LLMProvider):
                 #    raise Exception("Failed to list models. API key might be invalid or no models accessible.")
                 logger.info("GeminiProvider initialized successfully with google-genai Client.")
             except Exception as e:
-                logger.error(f"Failed to initialize Gemini Client (google-genai): {e}")
+                logger.error("Failed to initialize Gemini Client (google-genai): %s", e)
                 self.client = None # Ensure client is None if init fails
         else:
             logger.warning("GEMINI_API_KEY not found in environment.")
             # self.api_key is already None if not found
 
-    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> str:
+    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> GenerationResult:
         """
         Generate text using the google-genai SDK.
         """
         if not self.validate_api_key():
             raise Exception("Gemini Client not initialized. Check API key and initial setup.")
 
-        logger.info(f"Generating response with Gemini model: {model_id} using google-genai SDK")
+        logger.debug("Generating response with Gemini model: %s using google-genai SDK", model_id)
 
         try:
             # Model ID for the new SDK usually doesn't need the 'models/' prefix for generate_content
@@ -74,9 +75,9 @@ class GeminiProvider(LLMProvider):
                     thinking_config = types.ThinkingConfig(
                         thinking_budget=int(thinking_budget)
                     )
-                    logger.info(f"Using thinking budget: {thinking_budget}")
+                    logger.debug("Using thinking budget: %s", thinking_budget)
                 except ValueError:
-                    logger.warning(f"Invalid thinkingBudget value: {thinking_budget}. Ignoring.")
+                    logger.warning("Invalid thinkingBudget value: %s. Ignoring.", thinking_budget)
                 except AttributeError:
                     logger.warning("ThinkingConfig attribute not found unexpectedly. Skipping.")
 
@@ -89,11 +90,13 @@ class GeminiProvider(LLMProvider):
             full_model_id = f'models/{model_id}' if not model_id.startswith("models/") else model_id
 
             # Generate content using async client
+            start = time.perf_counter()
             response = await self.client.aio.models.generate_content(
                 model=full_model_id,
                 contents=prompt,
                 config=generation_config
             )
+            elapsed = time.perf_counter() - start
             
             # --- Extract the text response using the new simpler way --- 
             # Need to handle potential blocking reasons first
@@ -102,7 +105,7 @@ class GeminiProvider(LLMProvider):
                 block_details = ""
                 if hasattr(response.prompt_feedback, 'safety_ratings'):
                     block_details = f" Safety Ratings: {response.prompt_feedback.safety_ratings}"
-                logger.error(f"Gemini request blocked. Reason: {block_reason}.{block_details}")
+                logger.error("Gemini request blocked. Reason: %s.%s", block_reason, block_details)
                 raise Exception(f"Content blocked by Gemini API due to: {block_reason}.{block_details}")
             
             # Check if response has text (might not if blocked or other issues)
@@ -110,17 +113,28 @@ class GeminiProvider(LLMProvider):
             try:
                 answer = response.text.strip()
                 logger.info("Gemini response received successfully via google-genai SDK.")
-                return answer
+                usage = response.usage_metadata
+                output_tokens = None
+                if usage and usage.candidates_token_count is not None:
+                    # Thinking tokens are billed as output
+                    output_tokens = usage.candidates_token_count + (usage.thoughts_token_count or 0)
+                return GenerationResult(
+                    text=answer,
+                    input_tokens=usage.prompt_token_count if usage else None,
+                    output_tokens=output_tokens,
+                    cached_tokens=usage.cached_content_token_count if usage else None,
+                    timings={"wall": elapsed}
+                )
             except ValueError as e:
                 # Handle cases where response.text access fails (e.g., blocked content with no text part)
-                logger.error(f"Could not extract text from Gemini response. Finish Reason: {response.candidates[0].finish_reason if response.candidates else 'N/A'}. Error: {e}. Response: {response}")
+                logger.error("Could not extract text from Gemini response. Finish Reason: %s. Error: %s. Response: %s", response.candidates[0].finish_reason if response.candidates else "N/A", e, response)
                 raise Exception(f"Failed to get valid response content from Gemini API. Check logs for details.")
 
         except errors.APIError as e: # Catch specific API errors from the new SDK (Use APIError)
-            logger.exception(f"Gemini API Error (google-genai): {e}")
+            logger.exception("Gemini API Error (google-genai): %s", e)
             raise Exception(f"Error interacting with Gemini service (google-genai): {e}")
         except Exception as e:
-            logger.exception(f"Unexpected error during Gemini SDK (google-genai) call: {e}")
+            logger.exception("Unexpected error during Gemini SDK (google-genai) call: %s", e)
             raise Exception(f"Unexpected error interacting with Gemini service (google-genai): {e}")
 
     def validate_api_key(self) -> bool:
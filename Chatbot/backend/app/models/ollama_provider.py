@@ -1,61 +1,207 @@
 import os
+import time
+import asyncio
 import logging
 import httpx
+from contextlib import asynccontextmanager
 from typing import Dict, Any, Optional
-from .base import LLMProvider
+from .base import LLMProvider, GenerationResult
 
 logger = logging.getLogger(__name__)
 
+# Ollama reports durations in nanoseconds
+_NS_PER_SECOND = 1_000_000_000
+
+
+def _timings_from_response(result: Dict[str, Any]) -> Dict[str, float]:
+    """
+    Convert Ollama's *_duration fields (nanoseconds) into seconds.
+    Missing fields are reported as 0.0 so load-vs-inference splits are always comparable.
+    """
+    return {
+        "load": result.get("load_duration", 0) / _NS_PER_SECOND,
+        "prompt_eval": result.get("prompt_eval_duration", 0) / _NS_PER_SECOND,
+        "eval": result.get("eval_duration", 0) / _NS_PER_SECOND,
+        "total": result.get("total_duration", 0) / _NS_PER_SECOND,
+    }
+
+
+class _ModelSlots:
+    """
+    Admission control for Ollama model slots.
+
+    Requests for a model that is already running are admitted (up to `per_model`
+    concurrent calls), while a request for a different model waits until fewer than
+    `max_models` distinct models are busy. This keeps bursts for the same model together
+    instead of interleaving models and forcing Ollama to unload/reload them.
+    """
+    def __init__(self, max_models: int, per_model: int):
+        self.max_models = max(1, max_models)
+        self.per_model = max(1, per_model)
+        self._active: Dict[str, int] = {}
+        self._cond = asyncio.Condition()
+
+    def _can_enter(self, model_id: str) -> bool:
+        running = self._active.get(model_id, 0)
+        if running:
+            return running < self.per_model
+        return len(self._active) < self.max_models
+
+    @asynccontextmanager
+    async def acquire(self, model_id: str):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._can_enter(model_id))
+            self._active[model_id] = self._active.get(model_id, 0) + 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._active[model_id] -= 1
+                if not self._active[model_id]:
+                    del self._active[model_id]
+                self._cond.notify_all()
+
+
 class OllamaProvider(LLMProvider):
     """
     Implementation of LLMProvider for Ollama
     """
     def __init__(self):
         self.base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-        logger.info(f"Initialized OllamaProvider with base URL: {self.base_url}")
+        # How long Ollama should keep a model in memory after each request (Ollama duration string)
+        self.keep_alive = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+        # Seconds between keep-alive pings for warm models (should be shorter than keep_alive)
+        self.keepalive_interval = float(os.getenv("OLLAMA_KEEPALIVE_INTERVAL", "600"))
+        # Mirror the Ollama server settings so we never ask for more models/slots than it holds.
+        # Admission is per process: each of the API_WORKERS uvicorn workers gets its share
+        # (at least one slot, so with more workers than slots Ollama queues the excess).
+        workers = max(1, int(os.getenv("API_WORKERS", "1")))
+        max_loaded_models = max(1, int(os.getenv("OLLAMA_MAX_LOADED_MODELS", "2")) // workers)
+        num_parallel = max(1, int(os.getenv("OLLAMA_NUM_PARALLEL", "1")) // workers)
+        self._slots = _ModelSlots(max_loaded_models, num_parallel)
+        self.warm_models: Dict[str, Dict[str, Any]] = {} # model_id -> options used to load it
+        self._keepalive_task: Optional[asyncio.Task] = None
+        logger.info("Initialized OllamaProvider with base URL: %s (keep_alive=%s, max_loaded_models=%s, num_parallel=%s per worker of %s)", self.base_url, self.keep_alive, max_loaded_models, num_parallel, workers)
 
-    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> str:
+    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> GenerationResult:
         """
         Generate text using Ollama API
         """
-        logger.info(f"Generating response with Ollama model: {model_id}")
-        
+        logger.debug("Generating response with Ollama model: %s", model_id)
+
         # Merge provided options with defaults
         request_options = options.copy() if options else {}
-        
+
         # Prepare the API request
         request_data = {
             "model": model_id,
             "prompt": prompt,
             "stream": False,
-            "options": request_options
+            "options": request_options,
+            "keep_alive": self.keep_alive
         }
-        
+
         # Add temperature if provided
         if "temperature" in options:
             request_data["temperature"] = options["temperature"]
-        
+
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/generate",
-                    json=request_data
-                )
-                response.raise_for_status()
-                result = response.json()
-                answer = result.get("response", "").strip()
-                logger.info(f"Ollama response generated successfully")
-                return answer
-                
+            start = time.perf_counter()
+            async with self._slots.acquire(model_id):
+                queue_wait = time.perf_counter() - start
+                async with httpx.AsyncClient(timeout=120.0) as client:
+                    response = await client.post(
+                        f"{self.base_url}/api/generate",
+                        json=request_data
+                    )
+                    response.raise_for_status()
+                    result = response.json()
+            answer = result.get("response", "").strip()
+            timings = _timings_from_response(result)
+            timings["queue_wait"] = queue_wait
+            timings["wall"] = time.perf_counter() - start
+            logger.info("Ollama response generated successfully for %s: load=%.2fs, prompt_eval=%.2fs, eval=%.2fs, total=%.2fs", model_id, timings["load"], timings["prompt_eval"], timings["eval"], timings["total"])
+            if timings["load"] > 1.0:
+                logger.warning("Ollama spent %.2fs loading %s; consider adding it to the keep-warm set.", timings["load"], model_id)
+            return GenerationResult(
+                text=answer,
+                input_tokens=result.get("prompt_eval_count"),
+                output_tokens=result.get("eval_count"),
+                timings=timings
+            )
+
         except httpx.HTTPError as e:
-            logger.error(f"HTTP error with Ollama API: {e}")
+            logger.error("HTTP error with Ollama API: %s", e)
             raise Exception(f"Error communicating with Ollama service: {e}")
         except Exception as e:
-            logger.error(f"Unexpected error with Ollama API: {e}")
+            logger.error("Unexpected error with Ollama API: %s", e)
             raise Exception(f"Unexpected error with Ollama service: {e}")
-    
+
+    async def preload(self, model_id: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, float]:
+        """
+        Load a model into Ollama memory (or refresh its keep-alive) without generating text.
+
+        The same options as regular generation (notably num_ctx) must be passed, otherwise
+        Ollama reloads the model with a different context size on the next real request.
+
+        Returns:
+            The load/total timings reported by Ollama, in seconds
+        """
+        request_data = {
+            "model": model_id,
+            "prompt": "",
+            "stream": False,
+            "options": options or {},
+            "keep_alive": self.keep_alive
+        }
+        async with self._slots.acquire(model_id):
+            async with httpx.AsyncClient(timeout=300.0) as client:
+                response = await client.post(f"{self.base_url}/api/generate", json=request_data)
+                response.raise_for_status()
+                return _timings_from_response(response.json())
+
+    async def start_keep_warm(self, models: Dict[str, Dict[str, Any]]):
+        """
+        Preload the given models and keep pinging them in the background.
+
+        Args:
+            models: Mapping of model ID to the generation options used for that model
+        """
+        self.warm_models = dict(models)
+        if not self.warm_models or self._keepalive_task is not None:
+            return
+        logger.info("Keeping Ollama models warm: %s (every %.0fs)", ", ".join(self.warm_models), self.keepalive_interval)
+        self._keepalive_task = asyncio.create_task(self._keep_warm_loop())
+
+    async def stop_keep_warm(self):
+        """Cancel the background keep-alive task, if running."""
+        if self._keepalive_task is None:
+            return
+        self._keepalive_task.cancel()
+        try:
+            await self._keepalive_task
+        except asyncio.CancelledError:
+            pass
+        self._keepalive_task = None
+
+    async def _keep_warm_loop(self):
+        while True:
+            failed = False
+            for model_id, options in self.warm_models.items():
+                try:
+                    timings = await self.preload(model_id, options)
+                    if timings["load"] > 0.5:
+                        logger.info("Warmed Ollama model %s (load took %.2fs)", model_id, timings["load"])
+                    else:
+                        logger.debug("Ollama model %s already resident, keep-alive refreshed", model_id)
+                except Exception as e:
+                    # Ollama may still be pulling models at startup; retry shortly
+                    logger.warning("Failed to warm Ollama model %s: %s", model_id, e)
+                    failed = True
+            await asyncio.sleep(min(self.keepalive_interval, 30.0) if failed else self.keepalive_interval)
+
     def validate_api_key(self) -> bool:
         """
         Ollama doesn't require an API key, so this always returns True
         """
-        return True
\ No newline at end of file
+        return True
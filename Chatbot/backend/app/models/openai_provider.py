@@ -1,8 +1,9 @@
 import os
+import time
 import logging
 import openai # Use the official library
 from typing import Dict, Any
-from .base import LLMProvider
+from .base import LLMProvider, GenerationResult
 
 logger = logging.getLogger(__name__)
 
@@ -20,14 +21,14 @@ class OpenAIProvider(LLMProvider):
             self.client = None
             logger.warning("OPENAI_API_KEY not found. OpenAIProvider client not initialized.")
 
-    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> str:
+    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> GenerationResult:
         """
         Generate text using OpenAI API via the openai library.
         """
         if not self.validate_api_key():
             raise Exception("OpenAI API key not configured or client not initialized.")
 
-        logger.info(f"Generating response with OpenAI model: {model_id} using official SDK")
+        logger.debug("Generating response with OpenAI model: %s using official SDK", model_id)
 
         # Extract relevant options
         max_tokens = options.get("max_tokens", 4096)
@@ -65,27 +66,39 @@ class OpenAIProvider(LLMProvider):
 
 
         try:
+            start = time.perf_counter()
             response = await self.client.chat.completions.create(**api_kwargs)
+            elapsed = time.perf_counter() - start
 
             if response.choices and response.choices[0].message and response.choices[0].message.content:
                 answer = response.choices[0].message.content.strip()
                 logger.info("OpenAI response received successfully via SDK.")
-                return answer
+                usage = response.usage
+                cached_tokens = None
+                if usage and getattr(usage, "prompt_tokens_details", None):
+                    cached_tokens = usage.prompt_tokens_details.cached_tokens
+                return GenerationResult(
+                    text=answer,
+                    input_tokens=usage.prompt_tokens if usage else None,
+                    output_tokens=usage.completion_tokens if usage else None,
+                    cached_tokens=cached_tokens,
+                    timings={"wall": elapsed}
+                )
             else:
                 # Log the full response if structure is unexpected
-                logger.error(f"Unexpected OpenAI response format: {response}")
+                logger.error("Unexpected OpenAI response format: %s", response)
                 finish_reason = response.choices[0].finish_reason if response.choices else "unknown"
                 raise Exception(f"Failed to get valid content from OpenAI API response. Finish reason: {finish_reason}")
 
         except openai.APIError as e:
             # Handle API errors (e.g., rate limits, server errors)
-            logger.error(f"OpenAI API error: Status={e.status_code}, Message={e.message}, Type={e.type}, Code={e.code}")
+            logger.error("OpenAI API error: Status=%s, Message=%s, Type=%s, Code=%s", e.status_code, e.message, e.type, e.code)
             # Provide specific details if available in the error body
             error_details = getattr(e, 'body', {}).get('error', {}).get('message', str(e))
             raise Exception(f"OpenAI API Error ({e.status_code}): {error_details}")
         except Exception as e:
             # Handle other potential errors (network issues, etc.)
-            logger.exception(f"Unexpected error during OpenAI API call: {e}") # Log traceback
+            logger.exception("Unexpected error during OpenAI API call: %s", e) # Log traceback
             raise Exception(f"Unexpected error communicating with OpenAI service: {e}")
 
     def validate_api_key(self) -> bool:
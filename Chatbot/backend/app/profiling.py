@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Sessions started by SIGUSR1 run this long and write their results here
+PROFILE_SIGNAL_SECONDS = float(os.getenv("PROFILE_SIGNAL_SECONDS", "30"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp")
+
+# Leaf frames of threads that are blocked waiting for work; left out unless idle stacks are requested
+_IDLE_FRAMES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"), ("selectors.py", "select"),
+    ("queue.py", "get"), ("thread.py", "_worker"), ("handlers.py", "_monitor"), ("handlers.py", "dequeue"),
+    ("socket.py", "accept"),
+}
+_PREFIXES = sorted({p for p in sys.path if p and os.path.isdir(p)}, key=len, reverse=True)
+
+_session_lock = threading.Lock()
+_active_session: Optional["ProfileSession"] = None
+
+
+def _short_path(filename: str) -> str:
+    for prefix in _PREFIXES:
+        if filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+    return filename
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: a background thread snapshots the Python stacks of all other
+    threads every `interval` seconds. The request threads only pay for the GIL hand-offs.
+    """
+    def __init__(self, interval: float = 0.005, include_idle: bool = False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._labels: Dict[Any, str] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            # Semicolons separate frames in the folded format
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+            self._labels[code] = label
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(f"thread:{names.get(ident, ident)}")
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self) -> str:
+        """Stacks in the folded format read by flamegraph.pl, speedscope and inferno ("root;...;leaf count")"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+def memory_snapshot(top: int = 25) -> Dict[str, Any]:
+    """Process memory and, if tracemalloc is tracing, the top allocation sites"""
+    snapshot: Dict[str, Any] = {}
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    snapshot["rss_bytes" if key == "VmRSS" else "peak_rss_bytes"] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot["traced_bytes"] = current
+        snapshot["traced_peak_bytes"] = peak
+        snapshot["top_allocations"] = [
+            {"location": f"{_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}", "bytes": stat.size, "count": stat.count}
+            for stat in tracemalloc.take_snapshot().statistics("lineno")[:top]
+        ]
+    return snapshot
+
+
+class ProfileSession:
+    """
+    One profiling run: samples stacks for a number of seconds, or until a number of
+    /query requests have completed, and traces allocations meanwhile.
+    """
+    def __init__(self, seconds: Optional[float] = None, queries: Optional[int] = None, interval: float = 0.005,
+                 include_idle: bool = False, trace_memory: bool = True):
+        self.seconds = seconds
+        self.queries = queries
+        self.remaining_queries = queries or 0
+        self.trace_memory = trace_memory
+        self.profiler = SamplingProfiler(interval, include_idle)
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._started_tracemalloc = False
+        self._start = 0.0
+
+    def start(self):
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._start = time.perf_counter()
+        self.profiler.start()
+
+    def query_completed(self):
+        with self._lock:
+            self.remaining_queries -= 1
+            if self.queries and self.remaining_queries <= 0:
+                self.done.set()
+
+    def finish(self, describe_memory: Optional[Callable[[], Dict[str, Any]]] = None, top: int = 25) -> Dict[str, Any]:
+        """Stop sampling and return the stacks and a memory snapshot"""
+        self.profiler.stop()
+        duration = time.perf_counter() - self._start
+        memory = memory_snapshot(top)
+        if describe_memory is not None:
+            memory.update(describe_memory())
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        return {
+            "mode": "queries" if self.queries else "seconds",
+            "requested": self.queries or self.seconds,
+            "completed_queries": (self.queries - max(self.remaining_queries, 0)) if self.queries else None,
+            "duration": duration,
+            "interval": self.profiler.interval,
+            "samples": self.profiler.samples,
+            "folded": self.profiler.folded(),
+            "memory": memory,
+        }
+
+
+def start_session(**kwargs) -> ProfileSession:
+    """Start a session; raises RuntimeError if one is already running"""
+    global _active_session
+    with _session_lock:
+        if _active_session is not None:
+            raise RuntimeError("A profiling session is already running")
+        _active_session = ProfileSession(**kwargs)
+        _active_session.start()
+        return _active_session
+
+
+def end_session(session: ProfileSession, describe_memory: Optional[Callable[[], Dict[str, Any]]] = None, top: int = 25) -> Dict[str, Any]:
+    global _active_session
+    try:
+        return session.finish(describe_memory, top)
+    finally:
+        with _session_lock:
+            _active_session = None
+
+
+class QueryCompletionMiddleware:
+    """ASGI middleware counting completed /query requests for sessions that profile the next N queries"""
+    def __init__(self, app, path: str = "/query"):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            session = _active_session
+            if session is not None and session.queries and scope["type"] == "http" and scope["path"] == self.path:
+                session.query_completed()
+
+
+def install_signal_handler(describe_memory: Optional[Callable[[], Dict[str, Any]]] = None, signum: int = getattr(signal, "SIGUSR1", 0)):
+    """
+    On SIGUSR1, profile for PROFILE_SIGNAL_SECONDS and write <PROFILE_DIR>/profile-<pid>-<time>.folded
+    (stacks) and .json (everything else). Must be called from the main thread.
+    """
+    if not signum:
+        return
+
+    def run():
+        try:
+            session = start_session(seconds=PROFILE_SIGNAL_SECONDS)
+        except RuntimeError as e:
+            logger.warning("Ignoring profiling signal: %s", e)
+            return
+        session.done.wait(PROFILE_SIGNAL_SECONDS)
+        result = end_session(session, describe_memory)
+        base = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+        with open(f"{base}.folded", "w", encoding="utf-8") as f:
+            f.write(result.pop("folded") + "\n")
+        with open(f"{base}.json", "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, default=str)
+        logger.info("Profile written to %s.folded and %s.json (%d samples)", base, base, result["samples"])
+
+    def handler(signum, frame):
+        # Keep the handler itself trivial; the session runs on its own thread
+        threading.Thread(target=run, name="signal-profile", daemon=True).start()
+
+    try:
+        signal.signal(signum, handler)
+    except ValueError:
+        # Not the main thread (e.g. an embedding server or test harness running the app)
+        logger.warning("Profiling signal handler not installed: not running in the main thread")
+        return
+    logger.info("Send signal %s to pid %s to profile for %.0fs (results in %s)", signum, os.getpid(), PROFILE_SIGNAL_SECONDS, PROFILE_DIR)
@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Idle time after which a conversation is forgotten, and conversations kept at most (least recently used go first)
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", "1800"))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "1000"))
+# Retrieved chunks kept per conversation (the article set follow-ups draw on)
+SESSION_MAX_CHUNKS = int(os.getenv("SESSION_MAX_CHUNKS", "400"))
+# Earlier question/answer pairs included in the prompt of a follow-up
+SESSION_HISTORY_TURNS = int(os.getenv("SESSION_HISTORY_TURNS", "3"))
+
+# Session IDs are chosen by the client (e.g. a UUID per chat)
+SESSION_ID_PATTERN = r"^[A-Za-z0-9_-]{8,64}$"
+# Token counts cached per session before the cache is reset (a turn packs a few dozen blocks per model)
+_MAX_TOKEN_COUNTS = 500
+
+
+class Session:
+    """
+    State of one conversation: the chunks retrieved over its turns (newest turn first), the
+    articles packed into the last prompt, recent turns, and token counts of texts already seen.
+    """
+    def __init__(self, session_id: str, filters: Optional[Dict[str, Any]]):
+        self.id = session_id
+        self.filters_key = _filters_key(filters)
+        self.chunk_ids: List[str] = []
+        self.metadata: List[Dict[str, Any]] = []
+        self.documents: List[str] = []
+        self.packed_article_ids: List[str] = []
+        self.turns: Deque[Tuple[str, str]] = deque(maxlen=max(SESSION_HISTORY_TURNS, 0))
+        self.turn_count = 0
+        self.token_counts: Dict[Tuple[str, bytes], int] = {}
+        self.last_used = time.monotonic()
+        # One turn at a time: a follow-up builds on the state left by the previous one
+        self.lock = asyncio.Lock()
+
+    @property
+    def is_follow_up(self) -> bool:
+        return bool(self.chunk_ids)
+
+    def use_filters(self, filters: Optional[Dict[str, Any]]):
+        """Forget the article set if the filters changed, as it no longer applies; the turns are kept"""
+        key = _filters_key(filters)
+        if key != self.filters_key:
+            logger.debug("Filters changed in session %s; starting a new article set", self.id)
+            self.filters_key = key
+            self.chunk_ids, self.metadata, self.documents, self.packed_article_ids = [], [], [], []
+
+    def extend(self, results: Dict[str, Any]) -> int:
+        """
+        Put the chunks retrieved for this turn in front of those of earlier turns (already
+        known chunks move up), keeping at most SESSION_MAX_CHUNKS.
+
+        Returns:
+            Number of chunks not seen in earlier turns
+        """
+        ids = results["ids"][0] if results and results["ids"] else []
+        known = dict(zip(self.chunk_ids, zip(self.metadata, self.documents)))
+        new = sum(1 for chunk_id in ids if chunk_id not in known)
+        fresh = dict(zip(ids, zip(results["metadatas"][0], results["documents"][0]))) if ids else {}
+        merged = list(fresh.items()) + [(chunk_id, item) for chunk_id, item in known.items() if chunk_id not in fresh]
+        merged = merged[:SESSION_MAX_CHUNKS]
+        self.chunk_ids = [chunk_id for chunk_id, _ in merged]
+        self.metadata = [item[0] for _, item in merged]
+        self.documents = [item[1] for _, item in merged]
+        return new
+
+    def as_results(self) -> Dict[str, Any]:
+        """The session's chunks in the shape of a ChromaDB query result"""
+        return {"ids": [self.chunk_ids], "metadatas": [self.metadata], "documents": [self.documents]}
+
+    def record_turn(self, question: str, answer: str, packed_article_ids: List[str]):
+        self.turns.append((question, answer))
+        self.turn_count += 1
+        self.packed_article_ids = list(packed_article_ids)
+        if len(self.token_counts) > _MAX_TOKEN_COUNTS:
+            self.token_counts.clear()
+
+
+def _filters_key(filters: Optional[Dict[str, Any]]) -> str:
+    return json.dumps(filters or {}, sort_keys=True, default=str)
+
+
+class SessionStore:
+    """In-process conversations with idle expiry and a least-recently-used cap"""
+    def __init__(self, ttl: float = SESSION_TTL_SECONDS, max_sessions: int = SESSION_MAX):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.lookups = {"hits": 0, "misses": 0}
+
+    def get_or_create(self, session_id: str, filters: Optional[Dict[str, Any]]) -> Session:
+        """The live session with this ID, or a new one with these filters"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                self.lookups["misses"] += 1
+                session = self._sessions[session_id] = Session(session_id, filters)
+                while len(self._sessions) > self.max_sessions:
+                    evicted, _ = self._sessions.popitem(last=False)
+                    logger.debug("Evicted session %s (SESSION_MAX=%d)", evicted, self.max_sessions)
+            else:
+                self.lookups["hits"] += 1
+                self._sessions.move_to_end(session_id)
+            session.last_used = now
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def _expire(self, now: float):
+        # Least recently used first, so expired sessions are at the front
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_used < self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+
+# Create a singleton instance
+session_store = SessionStore()
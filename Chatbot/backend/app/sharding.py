@@ -0,0 +1,106 @@
+import re
+import json
+import hashlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Sharded layouts: one collection per decade of the article date, or per newspaper
+SHARD_SCHEMES = ("decade", "newspaper")
+SHARD_SEPARATOR = "__shard_"
+UNKNOWN_SHARD = "unknown"
+# Root collection metadata keys describing the layout; the root itself holds no chunks
+SCHEME_KEY = "sharded_by"
+SHARDS_KEY = "shards"
+
+_DATE_YEAR = re.compile(r"^(\d{4})")
+
+
+def shard_key(metadata: Dict[str, Any], scheme: str) -> str:
+    """Shard of a chunk, from its metadata"""
+    if scheme == "decade":
+        match = _DATE_YEAR.match(metadata.get("date") or "")
+        return f"{int(match.group(1)) // 10 * 10}s" if match else UNKNOWN_SHARD
+    if scheme == "newspaper":
+        return metadata.get("newspaper") or UNKNOWN_SHARD
+    raise ValueError(f"Unknown shard scheme '{scheme}' (expected one of {', '.join(SHARD_SCHEMES)})")
+
+
+def shard_collection_name(root: str, key: str) -> str:
+    """
+    ChromaDB-safe collection name of a shard (max 63 characters of [a-zA-Z0-9._-]).
+    Newspaper names are slugged, with a hash suffix to keep distinct names distinct.
+    """
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", key).strip("-").lower()
+    if slug != key or len(root) + len(SHARD_SEPARATOR) + len(slug) > 63:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:6]
+        room = max(0, 63 - len(root) - len(SHARD_SEPARATOR) - len(digest) - 1)
+        slug = f"{slug[:room].strip('-')}-{digest}".lstrip("-")
+    return f"{root}{SHARD_SEPARATOR}{slug}"
+
+
+def read_shard_map(collection) -> Optional[Tuple[str, Dict[str, str]]]:
+    """(scheme, {shard key: collection name}) of a sharded root collection, or None if it is not sharded"""
+    metadata = collection.metadata or {}
+    if not metadata.get(SCHEME_KEY):
+        return None
+    return metadata[SCHEME_KEY], json.loads(metadata.get(SHARDS_KEY) or "{}")
+
+
+def write_shard_map(collection, scheme: str, shards: Dict[str, str]):
+    """Record the layout in the root collection's metadata (readers pick it up on their next refresh)"""
+    metadata = dict(collection.metadata or {})
+    metadata.update({SCHEME_KEY: scheme, SHARDS_KEY: json.dumps(shards, ensure_ascii=False, sort_keys=True)})
+    collection.modify(metadata=metadata)
+
+
+def total_count(client, collection) -> int:
+    """Chunks in a collection, summed over its shards if it is a sharded root"""
+    shard_map = read_shard_map(collection)
+    if shard_map is None:
+        return collection.count()
+    return sum(client.get_collection(name, embedding_function=None).count() for name in shard_map[1].values())
+
+
+def route_shards(scheme: str, shards: Dict[str, Any], filters: Optional[Dict[str, Any]]) -> List[str]:
+    """
+    Shard keys that can hold chunks matching the /query filters. A date range keeps the
+    decades it overlaps (undated chunks never match it); a newspaper filter keeps that
+    newspaper's shard. Filters that do not constrain the scheme keep every shard.
+    """
+    keys = list(shards)
+    filters = filters or {}
+    if scheme == "decade":
+        date_range = filters.get("date_range")
+        if isinstance(date_range, dict) and (date_range.get("from") or date_range.get("to")):
+            low = _year(date_range.get("from"), 0)
+            high = _year(date_range.get("to"), 9999)
+            keys = [k for k in keys if k != UNKNOWN_SHARD and int(k[:-1]) <= high and int(k[:-1]) + 9 >= low]
+    elif scheme == "newspaper":
+        newspaper = filters.get("newspaper")
+        if isinstance(newspaper, str) and newspaper:
+            keys = [k for k in keys if k == newspaper]
+    return keys
+
+
+def _year(date: Optional[str], default: int) -> int:
+    match = _DATE_YEAR.match(date or "")
+    return int(match.group(1)) if match else default
+
+
+def merge_query_results(results: List[Dict[str, Any]], n_results: int) -> Dict[str, Any]:
+    """Merge single-query ChromaDB results from several shards into one top-n result, by distance"""
+    rows = []
+    for result in results:
+        if not result or not result.get("ids") or not result["ids"][0]:
+            continue
+        rows.extend(zip(result["distances"][0], result["ids"][0], result["documents"][0], result["metadatas"][0]))
+    rows.sort(key=lambda row: row[0])
+    rows = rows[:n_results]
+    return {
+        "ids": [[row[1] for row in rows]],
+        "documents": [[row[2] for row in rows]],
+        "metadatas": [[row[3] for row in rows]],
+        "distances": [[row[0] for row in rows]],
+    }
@@ -0,0 +1,71 @@
+import re
+import hashlib
+import logging
+from typing import List, Optional
+
+import nltk
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def ensure_nltk_data():
+    """
+    Download the NLTK punkt sentence models (English and French) if missing. Called by
+    the indexer; the API relies on the data baked into the image and never downloads.
+    """
+    # nltk.data.find raises LookupError when a resource is missing
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+    try:
+        nltk.data.find('tokenizers/punkt/french.pickle')
+    except LookupError:
+        # punkt contains multiple languages, including French
+        logger.info("Downloading NLTK punkt data (includes French)...")
+        nltk.download('punkt')
+
+
+def split_sentences(content: str, article_id: str = "") -> List[str]:
+    """
+    Normalise line breaks and split article content into French sentences.
+    The API reuses this to map chunk sentence ranges back onto full articles,
+    so any change here changes the meaning of the sent_start/sent_end metadata.
+    """
+    if not content:
+        return []
+    
+    # Pre-process content to handle different newline/paragraph break styles
+    content = content.replace('\\r\\n\\r\\n', ' ') # Replace double carriage return/newline
+    content = content.replace('\\n\\n', ' ')     # Replace double newline
+    content = content.replace('\\r\\n', ' ')    # Replace single carriage return/newline
+    content = content.replace('\\n', ' ')       # Replace single newline just in case
+    
+    # Use NLTK to split into sentences, specifying French
+    try:
+        return nltk.sent_tokenize(content, language='french')
+    except Exception as e:
+        logger.warning("Error tokenizing article %s: %s. Falling back to default tokenization.", article_id, e)
+        # Fallback to default if French data isn't loaded or causes error
+        return nltk.sent_tokenize(content)
+
+
+def compute_simhash(text: str, shingle_size: int = 3) -> Optional[int]:
+    """
+    Compute a 64-bit SimHash of a text over word shingles.
+    Reprints of the same wire story end up a few bits apart, so the API can
+    cluster near-duplicate articles by Hamming distance.
+    Returns None for texts too short to shingle.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < shingle_size:
+        return None
+    digests = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(" ".join(words[i:i + shingle_size]).encode("utf-8"), digest_size=8).digest(), "big")
+         for i in range(len(words) - shingle_size + 1)),
+        dtype=np.uint64
+    )
+    # Each bit votes +1/-1 per shingle; the signature keeps the majority
+    bit_counts = ((digests[:, None] >> np.arange(64, dtype=np.uint64)) & np.uint64(1)).sum(axis=0)
+    return sum(1 << bit for bit in range(64) if 2 * int(bit_counts[bit]) > len(digests))
@@ -0,0 +1,57 @@
+import os
+import logging
+
+from opentelemetry import trace
+
+logger = logging.getLogger(__name__)
+
+# "none" (default), "console" (spans printed to stdout) or "otlp" (OTLP/gRPC to a collector,
+# at OTEL_EXPORTER_OTLP_ENDPOINT, default http://localhost:4317)
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "iwac-rag-api")
+# Fraction of requests traced (parent-based, so a trace is kept or dropped as a whole)
+TRACING_SAMPLE_RATIO = float(os.getenv("TRACING_SAMPLE_RATIO", "1.0"))
+
+# Until setup_tracing() installs a provider, spans from this tracer are no-ops
+tracer = trace.get_tracer("iwac_rag")
+
+
+def setup_tracing(app) -> bool:
+    """
+    Configure the OpenTelemetry SDK and instrument the FastAPI app, if TRACING_EXPORTER is set.
+
+    Args:
+        app: FastAPI application (each request becomes the root span of its trace)
+
+    Returns:
+        True if tracing was enabled
+    """
+    if TRACING_EXPORTER in ("", "none"):
+        return False
+
+    # SDK and exporters are only imported when tracing is on
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+
+    if TRACING_EXPORTER == "console":
+        exporter = ConsoleSpanExporter()
+    elif TRACING_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    else:
+        logger.error("Unknown TRACING_EXPORTER '%s' (expected 'none', 'console' or 'otlp'); tracing disabled", TRACING_EXPORTER)
+        return False
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": SERVICE_NAME}),
+        sampler=ParentBased(TraceIdRatioBased(TRACING_SAMPLE_RATIO))
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    # Scrapes and probes would drown out the queries
+    FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics,ready")
+    logger.info("Tracing enabled: %s exporter, service '%s', sample ratio %s", TRACING_EXPORTER, SERVICE_NAME, TRACING_SAMPLE_RATIO)
+    return True
@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import time
+from typing import Any, Dict, Optional
+
+from app.models.base import GenerationResult, LLMProvider
+
+# Registered with the ModelManager under these names by run_benchmarks.py
+FAKE_PROVIDER_NAME = "fake"
+FAKE_MODEL_ID = "fake-llm"
+
+_WORDS = ("analyse", "islam", "afrique", "ouest", "presse", "communauté", "imam", "mosquée", "association",
+          "gouvernement", "conférence", "jeunesse", "éducation", "réforme", "dialogue", "religieux")
+
+
+class FakeProvider(LLMProvider):
+    """
+    Deterministic stand-in for an LLM provider, for benchmarks.
+
+    Simulates a time to first token and a decoding speed, plus a limited number of
+    parallel generation slots (like OLLAMA_NUM_PARALLEL), so queueing shows up under
+    load. The answer only depends on the prompt, and usage is reported like a real provider.
+    """
+    def __init__(self, first_token_latency: float = 0.2, tokens_per_second: float = 50.0,
+                 answer_tokens: int = 200, max_parallel: Optional[int] = None):
+        """
+        Args:
+            first_token_latency: Seconds before the first token (prompt processing)
+            tokens_per_second: Decoding speed
+            answer_tokens: Tokens per answer
+            max_parallel: Concurrent generations (None = unlimited)
+        """
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.max_parallel = max_parallel
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.calls = 0
+
+    async def generate(self, prompt: str, model_id: str, options: Dict[str, Any]) -> GenerationResult:
+        self.calls += 1
+        if self.max_parallel and self._slots is None:
+            # Created lazily so it binds to the running event loop
+            self._slots = asyncio.Semaphore(self.max_parallel)
+        start = time.perf_counter()
+        if self._slots is not None:
+            await self._slots.acquire()
+        try:
+            queued = time.perf_counter() - start
+            duration = self.first_token_latency + self.answer_tokens / self.tokens_per_second
+            await asyncio.sleep(duration)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+        seed = int.from_bytes(hashlib.sha1(prompt.encode("utf-8")).digest()[:8], "big")
+        words = [_WORDS[(seed >> (i % 60)) % len(_WORDS)] for i in range(self.answer_tokens)]
+        return GenerationResult(
+            text=" ".join(words),
+            input_tokens=len(prompt.split()),
+            output_tokens=self.answer_tokens,
+            timings={"queue_wait": queued, "wall": time.perf_counter() - start}
+        )
+
+    def validate_api_key(self) -> bool:
+        return True
+
+
+def fake_model_config(context_window: int = 8192, compress_context: bool = False) -> Dict[str, Any]:
+    """ModelManager configuration entry for the fake model (same shape as model_configs.json)"""
+    return {
+        "id": FAKE_MODEL_ID,
+        "name": "Benchmark: fake LLM",
+        "provider": FAKE_PROVIDER_NAME,
+        "context_window": context_window,
+        "temperature": 0.1,
+        "compress_context": compress_context,
+        "options": {"max_tokens": 1024}
+    }
@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import chromadb
+from chromadb import Documents, EmbeddingFunction, Embeddings
+
+# Make app.* and scripts.* importable whether this file is run directly or imported
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+from benchmarks.fake_provider import FAKE_MODEL_ID, FAKE_PROVIDER_NAME, FakeProvider, fake_model_config
+from benchmarks.synthetic_corpus import generate_articles, generate_queries
+
+RESULTS_DIR = os.path.join(BACKEND_ROOT, "benchmarks", "results")
+BENCH_COLLECTION = "bench_articles"
+
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    """
+    Deterministic bag-of-words vectors, for runs that should not depend on the
+    embedding model (e.g. measuring the rest of the pipeline on a small machine).
+    """
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def __call__(self, input: Documents) -> Embeddings:
+        vectors = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            for word in text.lower().split():
+                digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+                vectors[row, int.from_bytes(digest[:4], "little") % self.dim] += 1.0 if digest[4] & 1 else -1.0
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return list(vectors)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Latency distribution in milliseconds"""
+    if not values:
+        return {}
+    ms = np.asarray(values) * 1000.0
+    return {
+        "count": int(ms.size),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+    }
+
+
+def git_commit() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BACKEND_ROOT, capture_output=True, text=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": "unknown", "dirty": None}
+
+
+def bench_chunking(articles: List[Dict[str, Any]], model_name: str) -> Dict[str, Any]:
+    """Chunking cost per article (tokenization + sentence packing), in-process"""
+    from scripts.index_to_chroma import process_article
+    process_article(articles[0], model_name=model_name) # Load the tokenizer outside the timings
+    durations, chunks = [], 0
+    start = time.perf_counter()
+    for article in articles:
+        article_start = time.perf_counter()
+        chunks += len(process_article(article, model_name=model_name))
+        durations.append(time.perf_counter() - article_start)
+    elapsed = time.perf_counter() - start
+    return {
+        "articles": len(articles),
+        "chunks": chunks,
+        "articles_per_second": len(articles) / elapsed,
+        "chunks_per_second": chunks / elapsed,
+        "per_article": summarize(durations),
+    }
+
+
+def bench_embedding(embed: Callable[[List[str]], Any], texts: List[str], batch_size: int = 32, repeats: int = 50) -> Dict[str, Any]:
+    """Single-query latency (the /query case) and batch throughput (the indexing case)"""
+    embed(texts[:1]) # Warm up
+    single = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        embed([texts[i % len(texts)]])
+        single.append(time.perf_counter() - start)
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    start = time.perf_counter()
+    for batch in batches:
+        embed(batch)
+    elapsed = time.perf_counter() - start
+    return {
+        "single": summarize(single),
+        "batch_size": batch_size,
+        "texts": len(texts),
+        "texts_per_second": len(texts) / elapsed,
+    }
+
+
+async def bench_context_packing(model_manager, collection, embed, queries: List[str], top_k: int) -> Dict[str, Any]:
+    """
+    ModelManager.generate_response with a zero-latency provider: candidate ranking,
+    near-duplicate suppression, optional compression, token counting and packing.
+    """
+    instant = FakeProvider(first_token_latency=0.0, answer_tokens=0)
+    model_manager.providers[FAKE_PROVIDER_NAME] = instant
+    retrieved = []
+    for query in queries:
+        query_embedding = embed([query])[0]
+        results = collection.query(query_embeddings=[query_embedding], n_results=top_k, include=["metadatas", "documents"])
+        retrieved.append((query, query_embedding, results["metadatas"][0], results["documents"][0]))
+    await model_manager.generate_response(retrieved[0][0], retrieved[0][2], FAKE_MODEL_ID, retrieved[0][3], retrieved[0][1])
+
+    durations, articles = [], 0
+    for query, query_embedding, metadatas, documents in retrieved:
+        start = time.perf_counter()
+        result = await model_manager.generate_response(query, metadatas, FAKE_MODEL_ID, documents, query_embedding)
+        durations.append(time.perf_counter() - start)
+        articles += len(result.used_article_ids)
+    return {"queries": len(retrieved), "top_k": top_k, "articles_per_context": articles / len(retrieved), "per_query": summarize(durations)}
+
+
+async def run_load(app, queries: List[str], concurrency: int, requests: int, warmup: int, top_k: int) -> Dict[str, Any]:
+    """
+    Send `requests` /query calls from `concurrency` concurrent clients, after `warmup` unmeasured
+    ones. Stage latencies come from the `timings` of each response; `server` is the reported
+    query_time and `total` the latency seen by the client.
+    """
+    import httpx
+
+    samples: Dict[str, List[float]] = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        async def send(index: int) -> bool:
+            payload = {"query": queries[index % len(queries)], "top_k": top_k, "model_name": FAKE_MODEL_ID}
+            start = time.perf_counter()
+            response = await client.post("/query", json=payload)
+            if response.status_code != 200:
+                return False
+            body = response.json()
+            for stage, seconds in {**(body.get("timings") or {}), "server": body["query_time"],
+                                   "total": time.perf_counter() - start}.items():
+                samples.setdefault(stage, []).append(seconds)
+            return True
+
+        await asyncio.gather(*(send(i) for i in range(warmup)))
+        samples.clear()
+
+        next_index = iter(range(requests))
+        outcomes: List[bool] = []
+
+        async def client_loop():
+            for index in next_index:
+                outcomes.append(await send(warmup + index))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    succeeded = sum(outcomes)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - succeeded,
+        "seconds": elapsed,
+        "requests_per_second": succeeded / elapsed,
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+    }
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Numeric leaves of a results tree, keyed by dotted path"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = float(value)
+    return flat
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any]):
+    """Print relative changes of timing and throughput metrics against a previous run"""
+    current, previous = flatten(results), flatten(baseline)
+    print(f"\nComparison with {baseline.get('meta', {}).get('commit', 'baseline')}:")
+    changed = sorted(k for k, v in results["meta"]["args"].items()
+                     if k not in ("output", "baseline", "work_dir", "verbose") and baseline.get("meta", {}).get("args", {}).get(k) != v)
+    if changed:
+        print(f"  Warning: runs used different settings ({', '.join(changed)}), numbers may not be comparable")
+    for path in sorted(current):
+        if path.startswith("meta.") or path not in previous or not previous[path]:
+            continue
+        if not (path.endswith("_ms") or path.endswith("_per_second")):
+            continue
+        change = (current[path] - previous[path]) / previous[path] * 100
+        # Higher latency or lower throughput is worse
+        worse = change > 0 if path.endswith("_ms") else change < 0
+        flag = "  <-- regression" if worse and abs(change) >= 10 else ""
+        print(f"  {path}: {previous[path]:.2f} -> {current[path]:.2f} ({change:+.1f}%){flag}")
+
+
+async def main(args) -> Dict[str, Any]:
+    # The API reads its configuration at import time
+    os.environ["EMBEDDING_MODEL_NAME"] = args.embedding_model
+    os.environ["COLLECTION_NAME"] = BENCH_COLLECTION
+    from app import api
+    from app.models import model_manager
+    from scripts.index_to_chroma import index_articles
+    # The API configures logging from LOG_LEVEL (INFO by default) on import; per-query INFO lines would add to the timings
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.ERROR)
+
+    if args.fake_embeddings:
+        embedding_function = HashingEmbeddingFunction()
+    elif api._embedding_function is not None:
+        embedding_function = api._embedding_function
+    else:
+        raise RuntimeError(f"Embedding model {args.embedding_model} could not be loaded (use --fake-embeddings to run without it)")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="iwac-bench-")
+    os.makedirs(work_dir, exist_ok=True)
+    articles = generate_articles(args.articles, seed=args.seed)
+    queries = generate_queries(max(args.requests, 64), seed=args.seed + 1)
+    articles_path = os.path.join(work_dir, "input_articles.json")
+    with open(articles_path, "w", encoding="utf-8") as f:
+        json.dump(articles, f, ensure_ascii=False)
+    print(f"Synthetic corpus: {len(articles)} articles in {work_dir}")
+
+    results: Dict[str, Any] = {
+        "meta": {
+            **git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "embedding_model": "hashing" if args.fake_embeddings else args.embedding_model,
+            "args": vars(args),
+        },
+        "micro": {},
+    }
+
+    print("Benchmarking chunking...")
+    results["micro"]["chunking"] = bench_chunking(articles[:args.micro_articles], args.embedding_model)
+
+    print("Seeding ChromaDB...")
+    client = chromadb.PersistentClient(path=os.path.join(work_dir, "chroma"))
+    try:
+        client.delete_collection(BENCH_COLLECTION)
+    except Exception:
+        pass
+    stats = index_articles(articles_path, "", 0, BENCH_COLLECTION, args.chunk_size, args.overlap, workers=0,
+                           manifest_path=os.path.join(work_dir, "index_manifest.json"), model_name=args.embedding_model,
+                           client=client, embedding_function=embedding_function, show_progress=False)
+    results["indexing"] = {"articles": stats.articles, "chunks": stats.upserted, "seconds": stats.elapsed,
+                           "chunks_per_second": stats.upserted / stats.elapsed if stats.elapsed else 0.0}
+
+    print("Benchmarking embedding...")
+    chunk_texts = client.get_collection(BENCH_COLLECTION, embedding_function=None).get(limit=args.micro_texts, include=["documents"])["documents"]
+    results["micro"]["embedding"] = bench_embedding(embedding_function, chunk_texts)
+
+    # Point the API at the seeded collection, the synthetic corpus and the fake LLM
+    api._chroma_client = client
+    api._embedding_function = embedding_function
+    model_manager.set_embedding_function(embedding_function)
+    model_manager.articles_path = articles_path
+    model_manager.reload_articles()
+    model_manager.models[FAKE_MODEL_ID] = fake_model_config(args.context_window, args.compress_context)
+    model_manager.default_model_id = FAKE_MODEL_ID
+
+    print("Benchmarking context packing...")
+    results["micro"]["context_packing"] = await bench_context_packing(
+        model_manager, api.get_collection(), embedding_function, queries[:args.micro_queries], args.top_k)
+
+    model_manager.providers[FAKE_PROVIDER_NAME] = FakeProvider(args.first_token_latency, args.tokens_per_second,
+                                                               args.answer_tokens, args.llm_parallel or None)
+
+    results["load"] = {}
+    for concurrency in args.concurrency:
+        print(f"Load test: {args.requests} requests at concurrency {concurrency}...")
+        run = await run_load(api.app, queries, concurrency, args.requests, args.warmup, args.top_k)
+        results["load"][f"c{concurrency}"] = run
+        total = run["stages"].get("total", {})
+        print(f"  {run['requests_per_second']:.2f} req/s, p50 {total.get('p50_ms', 0):.0f} ms, "
+              f"p95 {total.get('p95_ms', 0):.0f} ms, p99 {total.get('p99_ms', 0):.0f} ms, {run['errors']} errors")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of indexing, retrieval and /query, with a fake LLM")
+    parser.add_argument("--articles", type=int, default=2000, help="Synthetic articles to index")
+    parser.add_argument("--seed", type=int, default=42, help="Corpus and query seed")
+    parser.add_argument("--embedding-model", default=os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"),
+                        help="Embedding model (run with the EMBEDDING_BACKEND backend); also provides the chunking tokenizer")
+    parser.add_argument("--fake-embeddings", action="store_true", help="Use deterministic hashing vectors instead of the embedding model")
+    parser.add_argument("--chunk-size", type=int, default=128, help="Chunk size in tokens")
+    parser.add_argument("--overlap", type=int, default=32, help="Chunk overlap in tokens")
+    parser.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 4, 16],
+                        help="Comma-separated concurrency levels of the load test")
+    parser.add_argument("--requests", type=int, default=200, help="Measured /query requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests before each level")
+    parser.add_argument("--top-k", type=int, default=10, help="Chunks retrieved per query")
+    parser.add_argument("--context-window", type=int, default=8192, help="Context window of the fake model")
+    parser.add_argument("--compress-context", action="store_true", help="Enable context compression for the fake model")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="Fake LLM time to first token (seconds)")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Fake LLM decoding speed")
+    parser.add_argument("--answer-tokens", type=int, default=200, help="Fake LLM answer length")
+    parser.add_argument("--llm-parallel", type=int, default=0, help="Concurrent fake LLM generations (0 = unlimited)")
+    parser.add_argument("--micro-articles", type=int, default=500, help="Articles in the chunking micro-benchmark")
+    parser.add_argument("--micro-texts", type=int, default=512, help="Chunks in the embedding micro-benchmark")
+    parser.add_argument("--micro-queries", type=int, default=50, help="Queries in the context packing micro-benchmark")
+    parser.add_argument("--work-dir", default=None, help="Directory for the corpus and ChromaDB data (default: a new temporary directory)")
+    parser.add_argument("--output", default=None, help="Results JSON file (default: benchmarks/results/bench-<commit>-<time>.json)")
+    parser.add_argument("--baseline", default=None, help="Previous results JSON to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Show the API's logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR,
+                        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+
+    results = asyncio.run(main(args))
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench-{results['meta']['commit']}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            compare(results, json.load(f))
@@ -0,0 +1,71 @@
+import random
+from typing import Any, Dict, List
+
+# Vocabulary loosely modelled on the IWAC press corpus, so that chunking, retrieval
+# and packing see French text of realistic length and structure
+NEWSPAPERS = ["Fraternité Matin", "Sidwaya", "L'Observateur Paalga", "Le Pays", "Notre Voie", "La Nation",
+              "Le Soleil", "Togo-Presse", "L'Indépendant", "Le Républicain"]
+LOCATIONS = ["Côte d'Ivoire", "Burkina Faso", "Bénin", "Togo", "Niger", "Nigeria", "Abidjan", "Ouagadougou",
+             "Cotonou", "Lomé", "Bobo-Dioulasso", "Niamey", "Bouaké", "Porto-Novo"]
+SUBJECTS = ["Islam", "Hajj", "Ramadan", "Tabaski", "Mosquées", "Enseignement franco-arabe", "Associations islamiques",
+            "Dialogue interreligieux", "Laïcité", "Confréries soufies", "Tijaniyya", "Wahhabisme", "Jeunesse musulmane",
+            "Femmes musulmanes", "Politique", "Élections"]
+ACTORS = ["le Conseil supérieur des imams", "l'Union musulmane", "l'AEEMB", "le ministre de l'Administration territoriale",
+          "le grand imam", "la Fédération des associations islamiques", "les responsables de la communauté",
+          "le président de la République", "les jeunes de la mosquée centrale", "la commission nationale du Hajj"]
+VERBS = ["a organisé", "a dénoncé", "a annoncé", "a célébré", "a appelé à", "a inauguré", "a rencontré", "a débattu de"]
+OBJECTS = ["une conférence sur la paix", "la construction d'une nouvelle mosquée", "le pèlerinage à La Mecque",
+           "la réforme de l'enseignement coranique", "le calendrier du Ramadan", "le dialogue avec les autorités",
+           "la formation des imams", "les tensions entre confréries", "la place des femmes dans les associations",
+           "le financement des écoles franco-arabes"]
+CLAUSES = ["en présence de nombreux fidèles", "selon un communiqué publié la veille", "après plusieurs mois de négociations",
+           "dans un climat de grande ferveur", "malgré les réserves de certains responsables",
+           "à l'issue de la prière du vendredi", "devant la presse nationale", "au cours d'une cérémonie officielle"]
+
+
+def _sentence(rng: random.Random, location: str) -> str:
+    sentence = f"À {location}, {rng.choice(ACTORS)} {rng.choice(VERBS)} {rng.choice(OBJECTS)} {rng.choice(CLAUSES)}."
+    return sentence[0].upper() + sentence[1:]
+
+
+def generate_articles(count: int, seed: int = 42, min_sentences: int = 4, max_sentences: int = 120) -> List[Dict[str, Any]]:
+    """
+    Deterministic IWAC-shaped articles (same fields as input_articles.json).
+    Lengths are skewed like the press corpus: mostly short pieces, a tail of long ones.
+    """
+    rng = random.Random(seed)
+    articles = []
+    for i in range(count):
+        locations = rng.sample(LOCATIONS, rng.randint(1, 3))
+        num_sentences = min(max_sentences, max(min_sentences, int(rng.lognormvariate(2.8, 0.7))))
+        paragraphs = []
+        sentences = [_sentence(rng, rng.choice(locations)) for _ in range(num_sentences)]
+        for start in range(0, len(sentences), 5):
+            paragraphs.append(" ".join(sentences[start:start + 5]))
+        year = rng.randint(1960, 2023)
+        articles.append({
+            "id": f"bench_{i:06d}",
+            "title": f"{rng.choice(ACTORS).capitalize()} {rng.choice(VERBS)} {rng.choice(OBJECTS)}",
+            "newspaper": rng.choice(NEWSPAPERS),
+            "date": f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "content": "\n\n".join(paragraphs),
+            "subject": rng.sample(SUBJECTS, rng.randint(1, 4)),
+            "spatial": locations,
+        })
+    return articles
+
+
+def generate_queries(count: int, seed: int = 7) -> List[str]:
+    """Deterministic user questions about the synthetic corpus"""
+    rng = random.Random(seed)
+    templates = [
+        "Que dit la presse sur {object} à {location} ?",
+        "Quel rôle a joué {actor} dans {object} ?",
+        "Comment {subject} est-il présenté dans les journaux de {location} ?",
+        "Résume les débats autour de {object}.",
+    ]
+    return [
+        rng.choice(templates).format(object=rng.choice(OBJECTS), location=rng.choice(LOCATIONS),
+                                     actor=rng.choice(ACTORS), subject=rng.choice(SUBJECTS))
+        for _ in range(count)
+    ]
@@ -7,9 +7,20 @@ set -e
 # Run the check and index script
 # This script will exit with 0 if successful (indexing done or skipped)
 # or non-zero if connection/indexing fails.
-echo "--- Running check_and_index.py script --- "
-python /app/scripts/check_and_index.py
+# With INDEX_IN_BACKGROUND=true the API runs the same check in a background thread instead
+if [ "$INDEX_IN_BACKGROUND" != "true" ]; then
+    echo "--- Running check_and_index.py script --- "
+    python /app/scripts/check_and_index.py
+fi
+
+# Optional shared embedding server: one process holds the embedding model and the full
+# articles for all the API workers (restarted if it dies)
+if [ -n "$EMBEDDING_SERVER_SOCKET" ]; then
+    echo "--- Starting embedding server on $EMBEDDING_SERVER_SOCKET --- "
+    (while true; do python -m app.embedding_server; echo "Embedding server exited, restarting"; sleep 1; done) &
+    python -m app.embedding_server --wait 600
+fi
 
 # If the check script succeeded (exit code 0), start the main application
-echo "--- Starting Uvicorn server --- "
-exec uvicorn app.api:app --host 0.0.0.0 --port 5000 
\ No newline at end of file
+echo "--- Starting Uvicorn server with ${API_WORKERS:-1} worker(s) --- "
+exec uvicorn app.api:app --host 0.0.0.0 --port 5000 --workers "${API_WORKERS:-1}" 
\ No newline at end of file
@@ -1,120 +1,166 @@
 import os
 import sys
-import subprocess
 import time
+from typing import Callable, Optional
+
 import chromadb
 from chromadb.config import Settings
-from chromadb.utils import embedding_functions
 
-print("--- Running Check and Index Script ---")
+# Make sibling modules importable as scripts.* whether this file is run directly or imported by the API
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+from app.collection_versions import resolve_collection_name
+from app.embeddings import EMBEDDING_BACKEND, create_embedding_function, open_collection
+from app.sharding import total_count
+from scripts.index_to_chroma import DEFAULT_CHUNK_TOKENS, DEFAULT_OVERLAP_TOKENS, IndexStats, index_articles
 
 # Configuration from Environment Variables
 chroma_host = os.getenv("CHROMADB_HOST", "chromadb")
 chroma_port = int(os.getenv("CHROMADB_PORT", 8000))
 collection_name = os.getenv("COLLECTION_NAME", "iwac_articles") # Ensure this matches your .env or default
-input_json_path_default = "/app/data/processed/input_articles.json" 
-# Allow overriding input path via script argument if needed in the future
-input_json_path = sys.argv[1] if len(sys.argv) > 1 else input_json_path_default
-
+input_json_path_default = "/app/data/processed/input_articles.json"
+# "if_empty": index only when the collection is empty; "incremental": also sync new/changed/removed articles on every start
+index_mode = os.getenv("INDEX_MODE", "if_empty")
 # Embedding function (ensure consistency with indexer)
 embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
-print(f"Using embedding model: {embedding_model_name} for check/creation")
-try:
-    embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name=embedding_model_name
-    )
-except Exception as e:
-    print(f"ERROR: Failed to initialize embedding function: {e}", file=sys.stderr)
-    sys.exit(1) # Exit if we can't even load the embedder
-
-print(f"ChromaDB Host: {chroma_host}")
-print(f"ChromaDB Port: {chroma_port}")
-print(f"Collection Name: {collection_name}")
-print(f"Input JSON Path: {input_json_path}")
-
-# Check if input file exists
-if not os.path.exists(input_json_path):
-    print(f"ERROR: Input JSON file not found at {input_json_path}. Skipping indexing check.", file=sys.stderr)
-    # Exit cleanly if no input file, as indexing cannot proceed.
-    # The main application might still run, depending on requirements.
-    sys.exit(0) 
-
-# --- Wait for ChromaDB ---
-# Although docker-compose depends_on helps, add a small explicit wait/retry
-max_retries = 10
-retry_delay = 5 # seconds
-for i in range(max_retries):
+embedding_cache_dir = os.getenv("EMBEDDING_CACHE_DIR")
+# Embedding worker processes (0 = embed with the given embedding function)
+embed_workers = int(os.getenv("EMBED_WORKERS", "0"))
+# "decade" or "newspaper" to build a new collection as one collection per shard
+shard_by = os.getenv("SHARD_BY") or None
+
+
+class IndexingError(Exception):
+    """Raised when ChromaDB cannot be reached or indexing fails"""
+
+
+def wait_for_chroma(max_retries: int = 10, retry_delay: int = 5):
+    """Connect to ChromaDB, retrying while the service starts up"""
+    # Although docker-compose depends_on helps, add a small explicit wait/retry
+    for i in range(max_retries):
+        try:
+            # Test connection - List collections is a lightweight operation
+            client = chromadb.HttpClient(host=chroma_host, port=chroma_port, settings=Settings(allow_reset=True))
+            client.list_collections()
+            print("Successfully connected to ChromaDB.")
+            return client
+        except Exception as e:
+            print(f"Waiting for ChromaDB ({i+1}/{max_retries})... Error: {e}")
+            if i < max_retries - 1:
+                time.sleep(retry_delay)
+    raise IndexingError("Could not connect to ChromaDB after multiple retries.")
+
+
+def indexing_lock_path(input_json_path: str = input_json_path_default) -> str:
+    """Lock file that API workers use so only one of them indexes (next to the input and its manifest)."""
+    return os.path.join(os.path.dirname(os.path.abspath(input_json_path)), f"index.{collection_name}.lock")
+
+
+def check_and_index(embedding_function,
+                    input_json_path: str = input_json_path_default,
+                    progress_callback: Optional[Callable[[IndexStats], None]] = None,
+                    show_progress: bool = True) -> Optional[IndexStats]:
+    """
+    Make sure the collection exists and index articles into it if needed.
+
+    Indexing runs in-process with the given (already loaded) embedding function,
+    so the model is loaded only once. The API calls this from a background thread
+    when INDEX_IN_BACKGROUND is enabled.
+
+    Args:
+        embedding_function: Loaded embedding function for EMBEDDING_MODEL_NAME
+        input_json_path: Articles to index
+        progress_callback: Receives live IndexStats while indexing
+        show_progress: Show a tqdm progress bar
+
+    Returns:
+        Statistics of the indexing run, or None if indexing was not needed
+
+    Raises:
+        IndexingError: If ChromaDB is unreachable, the collection cannot be checked or indexing fails
+    """
+    print(f"ChromaDB Host: {chroma_host}")
+    print(f"ChromaDB Port: {chroma_port}")
+    print(f"Collection Name: {collection_name}")
+    print(f"Input JSON Path: {input_json_path}")
+    print(f"Index Mode: {index_mode}")
+
+    # Check if input file exists
+    if not os.path.exists(input_json_path):
+        # Return cleanly if no input file, as indexing cannot proceed.
+        # The main application might still run, depending on requirements.
+        print(f"ERROR: Input JSON file not found at {input_json_path}. Skipping indexing check.", file=sys.stderr)
+        return None
+
+    client = wait_for_chroma()
+
+    # --- Check Collection ---
     try:
-        # Test connection - List collections is a lightweight operation
-        client = chromadb.HttpClient(host=chroma_host, port=chroma_port, settings=Settings(allow_reset=True))
-        client.list_collections()
-        print("Successfully connected to ChromaDB.")
-        break 
+        # COLLECTION_NAME may be an alias of a versioned collection (see scripts/manage_collections.py)
+        target = resolve_collection_name(client, collection_name)
+        if target != collection_name:
+            print(f"Collection '{collection_name}' is an alias of '{target}'.")
+        # Use get_or_create_collection to ensure the collection exists
+        # Pass the embedding function to ensure consistency!
+        collection = open_collection(client, target, embedding_function)
+        print(f"Ensured collection '{target}' exists.")
+
+        # Now check the count (summed over shards for a sharded layout)
+        count = total_count(client, collection)
+        print(f"Collection '{target}' contains {count} documents.")
     except Exception as e:
-        print(f"Waiting for ChromaDB ({i+1}/{max_retries})... Error: {e}")
-        if i == max_retries - 1:
-            print("ERROR: Could not connect to ChromaDB after multiple retries. Exiting.", file=sys.stderr)
-            sys.exit(1) # Exit with error if ChromaDB connection fails
-        time.sleep(retry_delay)
-
-# --- Check Collection ---
-needs_indexing = False
-try:
-    # Use get_or_create_collection to ensure the collection exists
-    # Pass the embedding function to ensure consistency!
-    collection = client.get_or_create_collection(
-        name=collection_name, 
-        embedding_function=embedding_function
-    )
-    print(f"Ensured collection '{collection_name}' exists.")
-    
-    # Now check the count
-    count = collection.count()
-    print(f"Collection '{collection_name}' contains {count} documents.")
+        raise IndexingError(f"Failed during collection check/creation: {e}") from e
+
+    incremental = False
     if count == 0:
         print("Collection is empty. Indexing required.")
-        needs_indexing = True
+    elif index_mode == "incremental":
+        print("Collection already contains data. Running incremental indexing.")
+        incremental = True
     else:
         print("Collection already contains data. Skipping indexing.")
-except Exception as e:
-    print(f"ERROR: Failed during collection check/creation: {e}", file=sys.stderr)
-    # Exit if we can't even ensure the collection exists or check its count
-    sys.exit(1) 
+        return None
 
-# --- Run Indexing Script if Needed ---
-if needs_indexing:
+    # --- Run Indexing In-Process ---
     print(f"Starting indexing from {input_json_path}...")
-    indexing_script_path = "/app/scripts/index_to_chroma.py"
-    command = [
-        "python", 
-        indexing_script_path,
-        "--input", input_json_path,
-        "--chroma-host", chroma_host,
-        "--chroma-port", str(chroma_port),
-        "--collection", collection_name
-        # Add other necessary arguments for index_to_chroma.py if any
-    ]
-    
     try:
-        # Use subprocess.run to execute the script
-        result = subprocess.run(command, check=True, capture_output=True, text=True)
-        print("Indexing script completed successfully.")
-        print("--- Indexing Script STDOUT ---")
-        print(result.stdout)
-        print("-----------------------------")
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR: Indexing script failed with exit code {e.returncode}.", file=sys.stderr)
-        print("--- Indexing Script STDOUT --- DUMP:", file=sys.stderr)
-        print(e.stdout, file=sys.stderr)
-        print("--- Indexing Script STDERR --- DUMP:", file=sys.stderr)
-        print(e.stderr, file=sys.stderr)
-        print("-----------------------------------", file=sys.stderr)
-        sys.exit(1) # Exit with error if indexing fails
-    except FileNotFoundError:
-        print(f"ERROR: Indexing script not found at {indexing_script_path}", file=sys.stderr)
-        sys.exit(1)
-else:
-    print("Skipping indexing process.")
-
-print("--- Check and Index Script Finished ---")
-sys.exit(0) # Ensure exiting with 0 if successful 
\ No newline at end of file
+        stats = index_articles(
+            input_json_path, chroma_host, chroma_port, target,
+            chunk_size=DEFAULT_CHUNK_TOKENS, overlap=DEFAULT_OVERLAP_TOKENS,
+            incremental=incremental,
+            model_name=embedding_model_name,
+            embedding_cache_dir=embedding_cache_dir or os.path.join(os.path.dirname(os.path.abspath(input_json_path)), "embedding_cache"),
+            embed_workers=embed_workers,
+            shard_by=shard_by,
+            client=client,
+            embedding_function=embedding_function,
+            progress_callback=progress_callback,
+            show_progress=show_progress
+        )
+    except Exception as e:
+        raise IndexingError(f"Indexing failed: {e}") from e
+    print("Indexing completed successfully.")
+    return stats
+
+
+if __name__ == "__main__":
+    print("--- Running Check and Index Script ---")
+    # Allow overriding input path via script argument if needed in the future
+    input_json_path = sys.argv[1] if len(sys.argv) > 1 else input_json_path_default
+
+    print(f"Using embedding model: {embedding_model_name} ({EMBEDDING_BACKEND} backend) for check/creation")
+    try:
+        embedding_function = create_embedding_function(embedding_model_name)
+    except Exception as e:
+        print(f"ERROR: Failed to initialize embedding function: {e}", file=sys.stderr)
+        sys.exit(1) # Exit if we can't even load the embedder
+
+    try:
+        check_and_index(embedding_function, input_json_path)
+    except IndexingError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1) # Exit with error if connection or indexing fails
+
+    print("--- Check and Index Script Finished ---")
+    sys.exit(0) # Ensure exiting with 0 if successful
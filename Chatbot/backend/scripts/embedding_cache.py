@@ -0,0 +1,137 @@
+import os
+import re
+import hashlib
+import sqlite3
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+
+def text_key(text: str) -> bytes:
+    """Content address of a chunk text"""
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Content-addressed, on-disk cache of embeddings for one model.
+
+    Vectors are appended to a float32 file that is read through a memory map, and
+    a SQLite index maps sha1(text) to a row of that file. Rebuilding a collection,
+    changing the chunk size or indexing into another collection then only embeds
+    texts that were never seen before. Several indexer processes may share a cache:
+    appends happen inside a SQLite write transaction, which serialises writers.
+
+    Layout: <cache_dir>/<model slug>/{index.sqlite,vectors.f32}
+    """
+    def __init__(self, cache_dir: str, model_name: str):
+        """
+        Args:
+            cache_dir: Root directory of the cache (created if missing)
+            model_name: Embedding model (and backend) the vectors come from; each gets its own cache
+        """
+        self.model_name = model_name
+        slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model_name).strip("_")
+        self.directory = os.path.join(cache_dir, slug)
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self._db = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), timeout=60, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS vectors (text_hash BLOB PRIMARY KEY, row INTEGER NOT NULL)")
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row and row[0] != model_name:
+            raise ValueError(f"Embedding cache {self.directory} belongs to model {row[0]}, not {model_name}")
+        self.dim = self._load_dim()
+        self._map: Optional[np.memmap] = None
+        self.hits = 0
+        self.misses = 0
+
+    def _load_dim(self) -> Optional[int]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        return int(row[0]) if row else None
+
+    def _rows_on_disk(self) -> int:
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (4 * self.dim)
+
+    def _vectors(self, min_rows: int) -> np.memmap:
+        """Memory map of the vector file, remapped when rows were appended since the last call"""
+        if self._map is None or self._map.shape[0] < min_rows:
+            self._map = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self._rows_on_disk(), self.dim))
+        return self._map
+
+    def get_many(self, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+        """Cached vector per text, or None for texts not in the cache"""
+        if self.dim is None or not texts:
+            self.misses += len(texts)
+            return [None] * len(texts)
+        keys = [text_key(t) for t in texts]
+        rows = {}
+        # Stay below SQLite's bound parameter limit
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            query = f"SELECT text_hash, row FROM vectors WHERE text_hash IN ({','.join('?' * len(part))})"
+            rows.update(self._db.execute(query, part).fetchall())
+        vectors = self._vectors(max(rows.values()) + 1) if rows else None
+        result = [np.array(vectors[rows[k]]) if k in rows else None for k in keys]
+        found = sum(1 for r in result if r is not None)
+        self.hits += found
+        self.misses += len(texts) - found
+        return result
+
+    def put_many(self, texts: Sequence[str], vectors: np.ndarray) -> None:
+        """Store vectors for texts (texts already cached are skipped)"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not len(texts):
+            return
+        self._db.execute("BEGIN IMMEDIATE") # Serialises appends across processes
+        try:
+            if self.dim is None:
+                self.dim = self._load_dim()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                self._db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                     [("model", self.model_name), ("dim", str(self.dim))])
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+
+            # Drop texts cached meanwhile (or repeated within the batch)
+            new = {}
+            for text, vector in zip(texts, vectors):
+                key = text_key(text)
+                if key not in new and self._db.execute("SELECT 1 FROM vectors WHERE text_hash = ?", (key,)).fetchone() is None:
+                    new[key] = vector
+            if new:
+                first_row = self._rows_on_disk()
+                with open(self.vectors_path, "ab") as f:
+                    # Truncate a partial row left by an interrupted append
+                    f.truncate(first_row * 4 * self.dim)
+                    f.write(np.vstack(list(new.values())).tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._db.executemany("INSERT INTO vectors (text_hash, row) VALUES (?, ?)",
+                                     [(key, first_row + i) for i, key in enumerate(new)])
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def embed(self, texts: List[str], embedding_function: Callable[[List[str]], Sequence[Sequence[float]]]) -> np.ndarray:
+        """Embed texts, computing (and caching) only those not already cached"""
+        cached = self.get_many(texts)
+        missing = [i for i, vector in enumerate(cached) if vector is None]
+        if missing:
+            computed = np.asarray(embedding_function([texts[i] for i in missing]), dtype=np.float32)
+            self.put_many([texts[i] for i in missing], computed)
+            for i, vector in zip(missing, computed):
+                cached[i] = vector
+        return np.vstack(cached)
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def close(self):
+        self._map = None
+        self._db.close()
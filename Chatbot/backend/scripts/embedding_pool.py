@@ -0,0 +1,222 @@
+import os
+import sys
+import multiprocessing
+from multiprocessing import shared_memory
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Make app.* importable whether this file is run directly or imported by the API
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+
+# Environment variables read by the BLAS/OpenMP runtimes when they load
+_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+
+class _Buffers:
+    """
+    Shared-memory blocks of one worker: texts in (offsets + UTF-8 bytes), vectors out (float32).
+    """
+    def __init__(self, input_bytes: int, output_bytes: int):
+        self.input = shared_memory.SharedMemory(create=True, size=max(input_bytes, 1))
+        self.output = shared_memory.SharedMemory(create=True, size=max(output_bytes, 1))
+
+    @property
+    def names(self) -> Tuple[str, str]:
+        return self.input.name, self.output.name
+
+    def close(self):
+        for block in (self.input, self.output):
+            block.close()
+            block.unlink()
+
+
+def _write_texts(block: shared_memory.SharedMemory, encoded: List[bytes]) -> int:
+    """Lay out texts as [n + 1 int64 offsets][concatenated UTF-8]; returns bytes used"""
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    header = offsets.nbytes
+    np.frombuffer(block.buf, dtype=np.int64, count=len(offsets))[:] = offsets
+    block.buf[header:header + int(offsets[-1])] = b"".join(encoded)
+    return header + int(offsets[-1])
+
+
+def _read_texts(block: shared_memory.SharedMemory, count: int) -> List[str]:
+    offsets = np.frombuffer(block.buf, dtype=np.int64, count=count + 1)
+    base = offsets.nbytes
+    data = bytes(block.buf[base:base + int(offsets[-1])])
+    return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(count)]
+
+
+def _worker_main(connection, model_name: str, backend: str, threads: int):
+    """
+    Embedding worker: loads its own model copy with a fixed thread count, then embeds
+    texts found in shared memory and writes the vectors back in place.
+    """
+    # Pin thread pools before torch/onnxruntime load, so workers do not oversubscribe cores
+    for name in _THREAD_ENV_VARS:
+        os.environ[name] = str(threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    if backend == "torch":
+        import torch
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+
+    from app.embeddings import create_embedding_function
+    try:
+        embedding_function = create_embedding_function(model_name, backend=backend, threads=threads)
+        dim = len(np.asarray(embedding_function(["dimension probe"]))[0])
+    except Exception as e:
+        connection.send(("error", f"{type(e).__name__}: {e}"))
+        return
+    connection.send(("ready", dim))
+
+    blocks = None
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        if message[0] == "buffers":
+            if blocks is not None:
+                for block in blocks:
+                    block.close()
+            blocks = tuple(shared_memory.SharedMemory(name=name) for name in message[1])
+            continue
+        _, count = message
+        try:
+            texts = _read_texts(blocks[0], count)
+            vectors = np.asarray(embedding_function(texts), dtype=np.float32)
+            np.ndarray(vectors.shape, dtype=np.float32, buffer=blocks[1].buf)[:] = vectors
+            connection.send(("done", count))
+        except Exception as e:
+            connection.send(("error", f"{type(e).__name__}: {e}"))
+    if blocks is not None:
+        for block in blocks:
+            block.close()
+
+
+class EmbeddingWorkerPool:
+    """
+    Pool of embedding processes for bulk indexing on many-core hosts.
+
+    Each worker holds its own model copy and runs with cpu_count / workers threads,
+    so together they use every core without oversubscription. A batch is split into
+    one shard per worker; texts and vectors travel through per-worker shared memory
+    blocks, so only tiny control messages are pickled.
+    """
+    def __init__(self, model_name: str, backend: str, workers: int, threads_per_worker: Optional[int] = None):
+        """
+        Args:
+            model_name: Sentence-transformers model name
+            backend: Embedding backend ("torch" or "onnx", see app.embeddings)
+            workers: Number of worker processes
+            threads_per_worker: Threads per worker (default: CPU count // workers)
+        """
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        context = multiprocessing.get_context("spawn")
+        self._processes = []
+        self._connections = []
+        self._buffers: List[Optional[_Buffers]] = [None] * workers
+        # Set once a worker is gone: its shards can no longer be embedded
+        self._broken: Optional[str] = None
+        for _ in range(workers):
+            parent_end, child_end = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child_end, model_name, backend, self.threads_per_worker), daemon=True)
+            process.start()
+            child_end.close()
+            self._processes.append(process)
+            self._connections.append(parent_end)
+        try:
+            dims = {self._receive(i, "ready") for i in range(workers)}
+        except Exception:
+            self.close()
+            raise
+        self.dim = dims.pop()
+
+    def _receive(self, worker: int, expected: str):
+        try:
+            status, value = self._connections[worker].recv()
+        except EOFError:
+            self._broken = f"Embedding worker {worker} exited (exit code {self._processes[worker].exitcode})"
+            raise RuntimeError(self._broken)
+        if status != expected:
+            raise RuntimeError(f"Embedding worker {worker} failed: {value}")
+        return value
+
+    def _ensure_buffers(self, worker: int, input_bytes: int, output_bytes: int):
+        """(Re)allocate a worker's blocks when a shard does not fit, with headroom to avoid frequent resizing"""
+        buffers = self._buffers[worker]
+        if buffers is not None and buffers.input.size >= input_bytes and buffers.output.size >= output_bytes:
+            return
+        new = _Buffers(input_bytes * 2, output_bytes * 2)
+        self._connections[worker].send(("buffers", new.names))
+        if buffers is not None:
+            buffers.close()
+        self._buffers[worker] = new
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Embed texts across all workers; returns a float32 array in input order.
+
+        Raises:
+            RuntimeError: A worker failed on its shard (the pool remains usable), or a
+                worker is gone (the pool is broken and every later call fails)
+        """
+        if self._broken:
+            raise RuntimeError(f"Embedding worker pool is broken: {self._broken}")
+        texts = list(texts)
+        output = np.empty((len(texts), self.dim), dtype=np.float32)
+        if not texts:
+            return output
+        bounds = np.linspace(0, len(texts), min(self.workers, len(texts)) + 1).astype(int)
+        shards = [(worker, int(start), int(end)) for worker, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if end > start]
+
+        sent = []
+        error: Optional[Exception] = None
+        for worker, start, end in shards:
+            encoded = [t.encode("utf-8") for t in texts[start:end]]
+            input_bytes = 8 * (len(encoded) + 1) + sum(len(b) for b in encoded)
+            try:
+                self._ensure_buffers(worker, input_bytes, 4 * (end - start) * self.dim)
+                _write_texts(self._buffers[worker].input, encoded)
+                self._connections[worker].send(("embed", end - start))
+            except OSError as e:
+                self._broken = f"Could not send a shard to embedding worker {worker}: {e}"
+                error = RuntimeError(self._broken)
+                break
+            sent.append((worker, start, end))
+
+        # Read the reply of every shard sent, even after a failure, so none is left
+        # unread and taken for the reply to the next call
+        for worker, start, end in sent:
+            try:
+                self._receive(worker, "done")
+            except RuntimeError as e:
+                error = error or e
+                continue
+            output[start:end] = np.ndarray((end - start, self.dim), dtype=np.float32, buffer=self._buffers[worker].output.buf)
+        if error is not None:
+            raise error
+        return output
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        return self.embed(texts)
+
+    def close(self):
+        """Stop the workers and release shared memory"""
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        for buffers in self._buffers:
+            if buffers is not None:
+                buffers.close()
+        self._buffers = [None] * self.workers
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import argparse
+from typing import List
+
+import numpy as np
+
+# Make app.* importable whether this file is run directly or imported
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+from app.embeddings import EXPORT_INFO_FILE, FP32_MODEL_FILE, INT8_MODEL_FILE, ONNXEmbeddingFunction, onnx_model_dir
+
+DEFAULT_MODEL = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+
+# Parity sentences: French and English, short and long (truncated at max_seq_length)
+PARITY_SENTENCES = [
+    "Le Conseil supérieur des affaires islamiques a tenu sa session annuelle à Dakar.",
+    "Quelle est la position de l'AEEMB sur l'enseignement franco-arabe au Burkina Faso ?",
+    "The pilgrimage to Mecca was organised by the national Hajj commission.",
+    "Tijaniyya",
+    "Les imams de Bobo-Dioulasso ont appelé au calme après les incidents de vendredi. " * 12,
+    "Le gouvernement ivoirien a annoncé de nouvelles mesures pour les écoles coraniques.",
+]
+
+
+def export(model_name: str, output_dir: str, quantize: bool = True, opset: int = 14) -> dict:
+    """
+    Export the transformer of a sentence-transformers model to ONNX (token embeddings
+    out), plus the tokenizer and pooling settings needed to reproduce its sentence embeddings.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(output_dir, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    model.eval()
+    transformer = model[0].auto_model
+    tokenizer = model.tokenizer
+
+    pooling = "mean"
+    normalize = False
+    for module in model:
+        module_type = type(module).__name__
+        if module_type == "Pooling":
+            pooling = "cls" if module.pooling_mode_cls_token else "mean"
+            if not (module.pooling_mode_cls_token or module.pooling_mode_mean_tokens):
+                raise ValueError(f"Unsupported pooling mode in {model_name}: {module.get_pooling_mode_str()}")
+        elif module_type == "Normalize":
+            normalize = True
+        elif module_type not in ("Transformer",):
+            raise ValueError(f"Unsupported sentence-transformers module {module_type} in {model_name}")
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    sample = tokenizer(["Exemple de phrase", "Un autre exemple un peu plus long"], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(output_dir, FP32_MODEL_FILE)
+    print(f"Exporting {model_name} to {fp32_path} (opset {opset})...")
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenEmbeddings(transformer),
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["token_embeddings"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "token_embeddings": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset,
+            do_constant_folding=True,
+        )
+    tokenizer.save_pretrained(output_dir) # Writes tokenizer.json for fast tokenizers
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = os.path.join(output_dir, INT8_MODEL_FILE)
+        print(f"Quantising to {int8_path} (dynamic int8 weights)...")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    info = {
+        "model_name": model_name,
+        "max_seq_length": model.max_seq_length,
+        "dimension": model.get_sentence_embedding_dimension(),
+        "pooling": pooling,
+        "normalize": normalize,
+        "pad_token_id": tokenizer.pad_token_id,
+        "quantized": quantize,
+        "opset": opset,
+    }
+    with open(os.path.join(output_dir, EXPORT_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    return info
+
+
+def parity_check(model_name: str, output_dir: str, sentences: List[str], quantized: bool) -> dict:
+    """Compare ONNX sentence embeddings with the sentence-transformers (torch) ones"""
+    from sentence_transformers import SentenceTransformer
+
+    reference = SentenceTransformer(model_name, device="cpu").encode(sentences, convert_to_numpy=True)
+    onnx_function = ONNXEmbeddingFunction(output_dir, quantized=quantized)
+    candidate = onnx_function.embed(sentences)
+
+    cosine = np.sum(reference * candidate, axis=1) / (np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+    return {
+        "model_file": INT8_MODEL_FILE if onnx_function.quantized else FP32_MODEL_FILE,
+        "min_cosine": float(cosine.min()),
+        "mean_cosine": float(cosine.mean()),
+        "max_abs_diff": float(np.abs(reference - candidate).max()),
+    }
+
+
+def benchmark(output_dir: str, quantized: bool, sentences: List[str], rounds: int = 20) -> float:
+    """Mean seconds to embed one short query"""
+    onnx_function = ONNXEmbeddingFunction(output_dir, quantized=quantized)
+    onnx_function.embed(sentences[:1]) # Warm-up
+    start = time.perf_counter()
+    for i in range(rounds):
+        onnx_function.embed([sentences[i % len(sentences)]])
+    return (time.perf_counter() - start) / rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a sentence-transformers model to ONNX (optionally int8) and check parity with torch")
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL_NAME", DEFAULT_MODEL), help="Sentence-transformers model name")
+    parser.add_argument("--output-dir", default=None, help="Output directory (default: ONNX_MODEL_DIR/<model>)")
+    parser.add_argument("--no-quantize", action="store_true", help="Skip dynamic int8 quantisation")
+    parser.add_argument("--opset", type=int, default=14, help="ONNX opset version")
+    parser.add_argument("--min-cosine-fp32", type=float, default=0.9999, help="Minimum cosine similarity to torch for the fp32 model")
+    parser.add_argument("--min-cosine-int8", type=float, default=0.98, help="Minimum cosine similarity to torch for the int8 model")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or onnx_model_dir(args.model)
+    info = export(args.model, output_dir, quantize=not args.no_quantize, opset=args.opset)
+
+    failed = False
+    info["parity"] = {}
+    variants = [(False, args.min_cosine_fp32)] + ([(True, args.min_cosine_int8)] if info["quantized"] else [])
+    for quantized, threshold in variants:
+        result = parity_check(args.model, output_dir, PARITY_SENTENCES, quantized)
+        result["query_seconds"] = benchmark(output_dir, quantized, PARITY_SENTENCES)
+        info["parity"][result["model_file"]] = result
+        status = "OK" if result["min_cosine"] >= threshold else "FAILED"
+        print(f"{result['model_file']}: min cosine {result['min_cosine']:.5f} (threshold {threshold}), mean {result['mean_cosine']:.5f}, "
+              f"max abs diff {result['max_abs_diff']:.5f}, {result['query_seconds'] * 1000:.1f} ms/query - {status}")
+        failed = failed or status == "FAILED"
+
+    info["parity_ok"] = not failed
+    with open(os.path.join(output_dir, EXPORT_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=2)
+    if failed:
+        print("ERROR: ONNX outputs diverge from torch; do not use this export", file=sys.stderr)
+        sys.exit(1)
+    print(f"Exported to {output_dir}. Set EMBEDDING_BACKEND=onnx to use it.")
@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+from typing import Any, Dict, List, Optional
+
+MANIFEST_VERSION = 1
+
+
+def article_hash(article: Dict[str, Any]) -> str:
+    """Content hash of an article (all fields, key order independent)"""
+    canonical = json.dumps(article, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def chunk_ids(article_id: str, start: int, end: int) -> List[str]:
+    """IDs of chunks start..end-1 of an article (see process_article)"""
+    return [f"{article_id}_chunk_{i}" for i in range(start, end)]
+
+
+class IndexManifest:
+    """
+    Record of what is in a collection: per-article content hash and chunk count,
+    plus the chunking/embedding parameters the chunks were produced with.
+
+    An article is only recorded once all of its chunks are stored, and the file is
+    replaced atomically, so after a crash the manifest under-reports and the next
+    incremental run simply redoes the unfinished articles (upserts are idempotent).
+    """
+    def __init__(self, path: str, params: Dict[str, Any]):
+        self.path = path
+        self.params = params
+        self.articles: Dict[str, Dict[str, Any]] = {} # article_id -> {"hash": str, "chunks": int}
+        self.params_changed = False
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: str, params: Dict[str, Any]) -> "IndexManifest":
+        """Load the manifest at path, or start an empty one"""
+        manifest = cls(path, params)
+        if not os.path.exists(path):
+            return manifest
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        manifest.articles = data.get("articles", {})
+        if data.get("version") != MANIFEST_VERSION or data.get("params") != params:
+            # Every article must be re-embedded; chunk counts are kept to delete stale chunks
+            manifest.params_changed = True
+            for entry in manifest.articles.values():
+                entry["hash"] = None
+        return manifest
+
+    def is_current(self, article_id: str, content_hash: str) -> bool:
+        entry = self.articles.get(article_id)
+        return entry is not None and entry.get("hash") == content_hash
+
+    def chunk_count(self, article_id: str) -> int:
+        entry = self.articles.get(article_id)
+        return entry.get("chunks", 0) if entry else 0
+
+    def record(self, article_id: str, content_hash: str, num_chunks: int):
+        """Mark an article as fully stored"""
+        with self._lock:
+            self.articles[article_id] = {"hash": content_hash, "chunks": num_chunks}
+            self._dirty = True
+
+    def remove(self, article_id: str):
+        with self._lock:
+            if self.articles.pop(article_id, None) is not None:
+                self._dirty = True
+
+    def save(self, force: bool = False):
+        """Atomically write the manifest (no-op when nothing changed)"""
+        with self._lock:
+            if not (self._dirty or force):
+                return
+            data = {"version": MANIFEST_VERSION, "params": self.params, "articles": dict(self.articles)}
+            self._dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest-", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+
+def default_manifest_path(input_file: str, collection_name: str) -> str:
+    """Manifest location next to the input file, one per collection"""
+    return os.path.join(os.path.dirname(os.path.abspath(input_file)), f"index_manifest.{collection_name}.json")
+
+
+class ArticleTracker:
+    """
+    Counts outstanding chunks per article during a run and records an article in
+    the manifest once its last chunk has been upserted.
+    """
+    def __init__(self, manifest: IndexManifest):
+        self.manifest = manifest
+        self._pending: Dict[str, List[Any]] = {} # article_id -> [hash, num_chunks, remaining]
+        self._lock = threading.Lock()
+
+    def expect(self, article_id: str, content_hash: str, num_chunks: int):
+        if num_chunks == 0:
+            self.manifest.record(article_id, content_hash, 0)
+            return
+        with self._lock:
+            self._pending[article_id] = [content_hash, num_chunks, num_chunks]
+
+    def upserted(self, article_ids: List[str]):
+        """Called with the article_id of every chunk in a successfully upserted batch"""
+        completed = []
+        with self._lock:
+            for article_id in article_ids:
+                state = self._pending.get(article_id)
+                if state is None:
+                    continue
+                state[2] -= 1
+                if state[2] == 0:
+                    completed.append((article_id, state[0], state[1]))
+                    del self._pending[article_id]
+        for article_id, content_hash, num_chunks in completed:
+            self.manifest.record(article_id, content_hash, num_chunks)
+
+    @property
+    def incomplete(self) -> Optional[int]:
+        with self._lock:
+            return len(self._pending)
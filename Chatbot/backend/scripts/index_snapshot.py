@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import tempfile
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SNAPSHOT_VERSION = 1
+INFO_FILE = "snapshot.json"
+CHUNKS_FILE = "chunks.parquet"
+VECTORS_FILE = "embeddings.npy"
+MANIFEST_FILE = "index_manifest.json"
+
+# Typed columns for the metadata written by index_to_chroma.chunk_metadata;
+# other keys (or values of another type) are kept as JSON in "extra_metadata"
+METADATA_COLUMNS = {
+    "article_id": pa.string(),
+    "title": pa.string(),
+    "newspaper": pa.string(),
+    "date": pa.string(),
+    "subjects": pa.string(),
+    "locations": pa.string(),
+    "chunk_idx": pa.int64(),
+    "sent_start": pa.int64(),
+    "sent_end": pa.int64(),
+    "simhash": pa.string(),
+    "token_count": pa.int64(),
+}
+SCHEMA = pa.schema(
+    [("id", pa.string()), ("document", pa.string())]
+    + list(METADATA_COLUMNS.items())
+    + [("extra_metadata", pa.string())]
+)
+
+
+def _fits(value: Any, column_type: pa.DataType) -> bool:
+    if column_type == pa.int64():
+        return isinstance(value, int) and not isinstance(value, bool)
+    return isinstance(value, str)
+
+
+def read_snapshot_info(directory: str) -> Dict[str, Any]:
+    """Read a snapshot's description; a snapshot without one is incomplete"""
+    path = os.path.join(directory, INFO_FILE)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{directory} is not a complete index snapshot ({INFO_FILE} missing)")
+    with open(path, "r", encoding="utf-8") as f:
+        info = json.load(f)
+    if info.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {info.get('version')} in {directory} (expected {SNAPSHOT_VERSION})")
+    return info
+
+
+class SnapshotWriter:
+    """
+    Writes a columnar snapshot of a collection: chunk IDs, texts and metadata to
+    Parquet, embeddings to a float32 .npy file (memory-mappable on load).
+
+    snapshot.json is written last, atomically, so a snapshot interrupted mid-export
+    is never mistaken for a complete one.
+    """
+    def __init__(self, directory: str, count: int, dimension: int, info: Dict[str, Any]):
+        """
+        Args:
+            directory: Output directory (created if needed; an existing snapshot is replaced)
+            count: Maximum number of chunks (rows of the embeddings file)
+            dimension: Embedding dimension
+            info: Extra fields for snapshot.json (collection, embedding model...)
+        """
+        self.directory = directory
+        self.info = dict(info, dimension=dimension)
+        self.rows = 0
+        os.makedirs(directory, exist_ok=True)
+        info_path = os.path.join(directory, INFO_FILE)
+        if os.path.exists(info_path):
+            os.remove(info_path)
+        self._vectors = np.lib.format.open_memmap(os.path.join(directory, VECTORS_FILE), mode="w+",
+                                                  dtype=np.float32, shape=(count, dimension))
+        self._chunks = pq.ParquetWriter(os.path.join(directory, CHUNKS_FILE), SCHEMA, compression="zstd")
+
+    def write_batch(self, ids: List[str], documents: List[Optional[str]], metadatas: List[Optional[Dict[str, Any]]], embeddings) -> None:
+        """Append chunks; row i of the embeddings file belongs to row i of the Parquet file"""
+        if self.rows + len(ids) > len(self._vectors):
+            raise ValueError(f"Snapshot sized for {len(self._vectors)} chunks, got more (the collection grew during export)")
+        columns: Dict[str, list] = {name: [] for name in METADATA_COLUMNS}
+        extras = []
+        for metadata in metadatas:
+            metadata = metadata or {}
+            extra = {}
+            for name, column_type in METADATA_COLUMNS.items():
+                value = metadata.get(name)
+                columns[name].append(value if value is None or _fits(value, column_type) else None)
+            for key, value in metadata.items():
+                if key not in METADATA_COLUMNS or not _fits(value, METADATA_COLUMNS[key]):
+                    extra[key] = value
+            extras.append(json.dumps(extra, ensure_ascii=False) if extra else None)
+        table = pa.table({"id": ids, "document": documents, **columns, "extra_metadata": extras}, schema=SCHEMA)
+        self._chunks.write_table(table)
+        self._vectors[self.rows:self.rows + len(ids)] = np.asarray(embeddings, dtype=np.float32)
+        self.rows += len(ids)
+
+    def close(self) -> Dict[str, Any]:
+        """Flush the data files and write snapshot.json; returns the snapshot description"""
+        self._chunks.close()
+        self._vectors.flush()
+        del self._vectors
+        self.info.update({
+            "version": SNAPSHOT_VERSION,
+            "count": self.rows,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        })
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".snapshot.", suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self.info, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.directory, INFO_FILE))
+        return self.info
+
+
+class SnapshotReader:
+    """
+    Reads a snapshot in batches. Embeddings are memory-mapped, so loading is bounded
+    by disk throughput and memory use by the batch size.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.info = read_snapshot_info(directory)
+        self.vectors = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode="r")
+        self.count = self.info["count"]
+
+    def iter_batches(self, batch_size: int = 1000) -> Iterator[Tuple[List[str], List[str], List[Optional[Dict[str, Any]]], np.ndarray]]:
+        """Yield (ids, documents, metadatas, embeddings) batches in snapshot order"""
+        parquet = pq.ParquetFile(os.path.join(self.directory, CHUNKS_FILE))
+        row = 0
+        for record_batch in parquet.iter_batches(batch_size=batch_size):
+            data = record_batch.to_pydict()
+            metadatas = []
+            for i in range(record_batch.num_rows):
+                metadata = {name: data[name][i] for name in METADATA_COLUMNS if data[name][i] is not None}
+                if data["extra_metadata"][i]:
+                    metadata.update(json.loads(data["extra_metadata"][i]))
+                metadatas.append(metadata or None) # ChromaDB rejects empty metadata dicts
+            embeddings = np.array(self.vectors[row:row + record_batch.num_rows])
+            row += record_batch.num_rows
+            yield data["id"], data["document"], metadatas, embeddings
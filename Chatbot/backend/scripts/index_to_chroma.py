@@ -1,51 +1,111 @@
+import os
+import sys
 import json
+import time
+import math
+import itertools
+import shutil
+import threading
+import multiprocessing
 import chromadb
 import argparse
-import nltk
-from chromadb.utils import embedding_functions
+import numpy as np
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from huggingface_hub import hf_hub_download
+from tokenizers import Tokenizer
 from tqdm import tqdm
-from typing import List, Dict, Any
-
-# Download necessary NLTK resources for English (default) and French
-try:
-    nltk.data.find('tokenizers/punkt')
-except nltk.downloader.DownloadError:
-    nltk.download('punkt')
-try:
-    nltk.data.find('tokenizers/punkt/french.pickle')
-except nltk.downloader.DownloadError:
-    # punkt contains multiple languages, including French
-    # If the above fails, redownloading punkt might be needed
-    # Or specifically download french part if possible
-    print("Downloading NLTK punkt data (includes French)...")
-    nltk.download('punkt')
-
-def process_article(article: Dict[str, Any], chunk_size: int = 512, overlap: int = 100) -> List[Dict[str, Any]]:
+from typing import List, Dict, Any, Optional, Callable, Iterable, Iterator, Tuple
+
+# Make sibling modules importable as scripts.* whether this file is run directly or imported by the API
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+from app.collection_versions import new_version_name, resolve_collection_name, set_alias
+from app.text_utils import compute_simhash, ensure_nltk_data, split_sentences
+from app.embeddings import EMBEDDING_BACKEND, create_embedding_function, embedding_model_id, open_collection
+from app.sharding import SHARD_SCHEMES, read_shard_map, shard_collection_name, shard_key, total_count, write_shard_map
+from scripts.embedding_cache import EmbeddingCache
+from scripts.embedding_pool import EmbeddingWorkerPool
+from scripts.index_manifest import IndexManifest, ArticleTracker, article_hash, chunk_ids, default_manifest_path
+from scripts.index_snapshot import MANIFEST_FILE, SnapshotReader, SnapshotWriter
+
+# Bump when process_article changes the chunks it produces for the same input
+CHUNKER_VERSION = 2
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+# max_seq_length of the default model: longer inputs are silently truncated when embedded
+DEFAULT_CHUNK_TOKENS = 128
+DEFAULT_OVERLAP_TOKENS = 32
+
+# Download the NLTK sentence models if missing (the API only uses what the image ships)
+ensure_nltk_data()
+
+@lru_cache(maxsize=4)
+def get_tokenizer(model_name: str) -> Tokenizer:
+    """Fast tokenizer of the embedding model, loaded once per process (from the local Hugging Face cache if present)"""
+    tokenizer = Tokenizer.from_file(hf_hub_download(model_name, "tokenizer.json"))
+    tokenizer.no_truncation()
+    tokenizer.no_padding()
+    return tokenizer
+
+def content_token_budget(tokenizer: Tokenizer, chunk_size: int) -> int:
+    """Tokens available for text once the model's special tokens ([CLS]/[SEP], <s>/</s>) are added"""
+    special_tokens = tokenizer.post_processor.num_special_tokens_to_add(False) if tokenizer.post_processor else 0
+    return max(1, chunk_size - special_tokens)
+
+def _sentence_pieces(sentences: List[str], tokenizer: Tokenizer, budget: int, overlap: int) -> List[Tuple[str, int, int]]:
+    """
+    Token-count sentences, returning (text, tokens, sentence index) pieces.
+    Sentences longer than the budget are cut into overlapping windows at word boundaries.
+    """
+    pieces = []
+    for idx, (sentence, encoding) in enumerate(zip(sentences, tokenizer.encode_batch(sentences, add_special_tokens=False))):
+        num_tokens = len(encoding.ids)
+        if num_tokens <= budget:
+            pieces.append((sentence, num_tokens, idx))
+            continue
+        offsets = encoding.offsets
+        # Tokens separated from the previous one by whitespace start a word
+        word_starts = [i for i in range(num_tokens) if i == 0 or offsets[i][0] > offsets[i - 1][1]] + [num_tokens]
+        start = 0
+        while start < num_tokens:
+            end = max((w for w in word_starts if w <= start + budget), default=start)
+            if end <= start: # A single word longer than the budget
+                end = min(start + budget, num_tokens)
+            pieces.append((sentence[offsets[start][0]:offsets[end - 1][1]].strip(), end - start, idx))
+            if end >= num_tokens:
+                break
+            start = min((w for w in word_starts if w >= end - overlap and w > start), default=end)
+    return [piece for piece in pieces if piece[0]]
+
+def process_article(article: Dict[str, Any], chunk_size: int = DEFAULT_CHUNK_TOKENS, overlap: int = DEFAULT_OVERLAP_TOKENS,
+                    model_name: str = DEFAULT_EMBEDDING_MODEL) -> List[Dict[str, Any]]:
     """
     Process an article into chunks suitable for embedding, using the provided JSON structure.
     Maps 'subject' -> 'subjects' and 'spatial' -> 'locations'.
+
+    Lengths are measured with the embedding model's tokenizer: each chunk fits in chunk_size
+    tokens including special tokens, so nothing is truncated at embedding time, and starts
+    with the trailing sentences of the previous chunk, up to overlap tokens.
+    Each chunk records the range of article sentences it covers (sent_start inclusive,
+    sent_end exclusive) and its token count.
     """
     content = article.get("content", "")
     if not content:
         return []
     
-    # Pre-process content to handle different newline/paragraph break styles
-    content = content.replace('\\r\\n\\r\\n', ' ') # Replace double carriage return/newline
-    content = content.replace('\\n\\n', ' ')     # Replace double newline
-    content = content.replace('\\r\\n', ' ')    # Replace single carriage return/newline
-    content = content.replace('\\n', ' ')       # Replace single newline just in case
-    
-    # Use NLTK to split into sentences, specifying French
-    try:
-        sentences = nltk.sent_tokenize(content, language='french')
-    except Exception as e:
-        print(f"Error tokenizing article {article.get('id', '')}: {e}. Falling back to default tokenization.")
-        # Fallback to default if French data isn't loaded or causes error
-        sentences = nltk.sent_tokenize(content)
-    
-    chunks = []
-    current_chunk = ""
-    current_chunk_sentences = []
+    sentences = split_sentences(content, article.get("id", ""))
+    # Article-level signature, stored on every chunk, used to suppress reprints at query time
+    signature = compute_simhash(content)
+    simhash = f"{signature:016x}" if signature is not None else ""
+
+    tokenizer = get_tokenizer(model_name)
+    budget = content_token_budget(tokenizer, chunk_size)
+    # Keep room for new text in every chunk
+    overlap = max(0, min(overlap, budget // 2))
+    pieces = _sentence_pieces(sentences, tokenizer, budget, overlap)
     
     # Extract metadata, handling potential missing keys gracefully
     article_id = article.get("id", "")
@@ -63,46 +123,27 @@ def process_article(article: Dict[str, Any], chunk_size: int = 512, overlap: int
     if isinstance(locations_keywords, str): # Handle if it's a single string
         locations_keywords = [locations_keywords]
 
-    for sentence in sentences:
-        # If adding this sentence would exceed chunk size and we already have content
-        if len(current_chunk) + len(sentence) > chunk_size and current_chunk:
-            # Create chunk document
-            chunk_doc = {
-                "id": f"{article_id}_chunk_{len(chunks)}",
-                "article_id": article_id,
-                "text": current_chunk.strip(), # Strip leading/trailing whitespace
-                "title": title,
-                "newspaper": newspaper,
-                "date": date,
-                # "url": url, # Reverted
-                "subjects": subjects_keywords, # Use the mapped list
-                "locations": locations_keywords, # Use the mapped list
-                "chunk_idx": len(chunks),
-            }
-            chunks.append(chunk_doc)
-            
-            # Start new chunk with overlap using sentences
-            overlap_sentences = current_chunk_sentences[-3:] 
-            overlap_text = " ".join(overlap_sentences)
-            
-            if len(overlap_text) < chunk_size: 
-                current_chunk = overlap_text + " " + sentence
-                current_chunk_sentences = overlap_sentences + [sentence]
-            else:
-                current_chunk = sentence
-                current_chunk_sentences = [sentence]
-
-        else:
-            # Add sentence to current chunk
-            current_chunk += (" " + sentence) if current_chunk else sentence
-            current_chunk_sentences.append(sentence)
-    
-    # Add the last chunk if it has content
-    if current_chunk:
-        chunk_doc = {
+    chunks = []
+    start = 0 # Index of the first piece of the current chunk
+    while start < len(pieces):
+        # Greedily add pieces while they fit
+        end = start
+        used = 0
+        while end < len(pieces) and (end == start or used + pieces[end][1] <= budget):
+            used += pieces[end][1]
+            end += 1
+        text = " ".join(piece[0] for piece in pieces[start:end])
+        # Tokens may merge across the joins, so check the exact count
+        num_tokens = len(tokenizer.encode(text, add_special_tokens=False).ids)
+        while num_tokens > budget and end - start > 1:
+            end -= 1
+            text = " ".join(piece[0] for piece in pieces[start:end])
+            num_tokens = len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+        chunks.append({
             "id": f"{article_id}_chunk_{len(chunks)}",
             "article_id": article_id,
-            "text": current_chunk.strip(), # Strip leading/trailing whitespace
+            "text": text,
             "title": title,
             "newspaper": newspaper,
             "date": date,
@@ -110,72 +151,608 @@ def process_article(article: Dict[str, Any], chunk_size: int = 512, overlap: int
             "subjects": subjects_keywords, # Use the mapped list
             "locations": locations_keywords, # Use the mapped list
             "chunk_idx": len(chunks),
-        }
-        chunks.append(chunk_doc)
+            "sent_start": pieces[start][2],
+            "sent_end": pieces[end - 1][2] + 1,
+            "simhash": simhash,
+            "token_count": num_tokens,
+        })
+        if end >= len(pieces):
+            break
+
+        # Start the next chunk with trailing pieces of this one, up to `overlap` tokens,
+        # as long as the next new piece still fits after them
+        next_start = end
+        carried = 0
+        while (next_start - 1 > start
+               and carried + pieces[next_start - 1][1] <= overlap
+               and carried + pieces[next_start - 1][1] + pieces[end][1] <= budget):
+            next_start -= 1
+            carried += pieces[next_start][1]
+        start = next_start
     
     return chunks
 
-def index_articles(input_file: str, chroma_host: str, chroma_port: int, collection_name: str, chunk_size: int, overlap: int) -> None:
+def iter_json_array(path: str, buffer_size: int = 1 << 20) -> Iterator[Dict[str, Any]]:
+    """
+    Stream the objects of a top-level JSON array without loading the whole file.
+    Elements must be JSON objects (as in input_articles.json): an object cut at a
+    buffer boundary never decodes, so we simply read more and retry.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(buffer_size)
+        pos = 0
+
+        def skip(chars: str) -> bool:
+            """Skip the given separator characters, refilling the buffer; False at EOF."""
+            nonlocal buf, pos
+            while True:
+                while pos < len(buf) and buf[pos] in chars:
+                    pos += 1
+                if pos < len(buf):
+                    return True
+                more = f.read(buffer_size)
+                if not more:
+                    return False
+                buf, pos = more, 0
+
+        if not skip(" \t\r\n\ufeff") or buf[pos] != "[":
+            raise ValueError(f"{path} does not contain a JSON array")
+        pos += 1
+        while True:
+            if not skip(" \t\r\n,"):
+                raise ValueError(f"Unexpected end of file in {path}")
+            if buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                more = f.read(buffer_size)
+                if not more:
+                    raise
+                buf, pos = buf[pos:] + more, 0
+                continue
+            yield obj
+            pos = end
+            # Drop consumed text so the buffer stays around buffer_size
+            if pos > buffer_size:
+                buf, pos = buf[pos:], 0
+
+def chunk_metadata(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the ChromaDB metadata stored with a chunk (new fields: see also index_snapshot.METADATA_COLUMNS)"""
+    return {
+        "article_id": chunk["article_id"],
+        "title": chunk["title"],
+        "newspaper": chunk["newspaper"],
+        "date": chunk["date"],
+        # "url": chunk.get("url", ""), # Reverted
+        # Ensure subjects/locations are dumped as JSON strings for ChromaDB metadata
+        "subjects": json.dumps(chunk.get("subjects", [])), 
+        "locations": json.dumps(chunk.get("locations", [])),
+        "chunk_idx": chunk["chunk_idx"],
+        "sent_start": chunk["sent_start"],
+        "sent_end": chunk["sent_end"],
+        "simhash": chunk["simhash"],
+        "token_count": chunk["token_count"]
+    }
+
+def summarize_token_counts(token_counts: Counter) -> str:
+    """Mean/percentiles of chunk sizes from a histogram of token counts"""
+    total = sum(token_counts.values())
+    values = sorted(token_counts.items())
+    def percentile(q: float) -> int:
+        # Nearest-rank percentile
+        rank = max(0, math.ceil(q * total) - 1)
+        seen = 0
+        for value, count in values:
+            seen += count
+            if seen > rank:
+                return value
+        return values[-1][0]
+    mean = sum(value * count for value, count in values) / total
+    return f"mean {mean:.1f}, median {percentile(0.5)}, p95 {percentile(0.95)}, min {values[0][0]}, max {values[-1][0]} over {total} chunks"
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count used to size embedding batches (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+def _bounded(iterable: Iterable[Any], slots: threading.Semaphore, stop: threading.Event) -> Iterator[Any]:
+    """Yield items only while a slot is free, so worker pools cannot read far ahead of the consumer."""
+    for item in iterable:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+def _chunk_article(args: Tuple[Dict[str, Any], int, int, str]) -> List[Dict[str, Any]]:
+    """Pool entry point (must be a picklable top-level function)"""
+    article, chunk_size, overlap, model_name = args
+    return process_article(article, chunk_size, overlap, model_name)
+
+def iter_chunks(articles: Iterable[Dict[str, Any]], chunk_size: int, overlap: int, workers: int, max_pending: int = 256,
+                model_name: str = DEFAULT_EMBEDDING_MODEL) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Chunk articles, in parallel when workers > 0, yielding each article's chunks in input order.
+    At most max_pending articles are held by the pool at any time.
+    """
+    if workers <= 0:
+        for article in articles:
+            yield process_article(article, chunk_size, overlap, model_name)
+        return
+
+    slots = threading.Semaphore(max_pending)
+    stop = threading.Event()
+    tasks = _bounded(((article, chunk_size, overlap, model_name) for article in articles), slots, stop)
+    # imap groups tasks before dispatching them; groups must fit in the window or the feeder deadlocks
+    imap_chunksize = max(1, min(8, max_pending // (2 * workers)))
+    # spawn: the parent may already hold an initialised torch/OpenMP runtime, which does not survive fork
+    with multiprocessing.get_context("spawn").Pool(workers) as pool:
+        try:
+            for chunks in pool.imap(_chunk_article, tasks, chunksize=imap_chunksize):
+                slots.release()
+                yield chunks
+        finally:
+            # Unblock the pool's task feeder if we stop early, otherwise terminating the pool hangs
+            stop.set()
+            slots.release()
+
+def iter_embedding_batches(chunks: Iterable[Dict[str, Any]], max_batch_tokens: int, max_batch_size: int) -> Iterator[List[Dict[str, Any]]]:
+    """Group chunks into batches bounded by tokens and by count"""
+    batch: List[Dict[str, Any]] = []
+    batch_tokens = 0
+    for chunk in chunks:
+        tokens = chunk.get("token_count") or estimate_tokens(chunk["text"])
+        if batch and (batch_tokens + tokens > max_batch_tokens or len(batch) >= max_batch_size):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(chunk)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+class BoundedUploader:
     """
-    Index articles into ChromaDB
+    Runs collection upserts on background threads with a bounded in-flight window,
+    so embedding the next batch overlaps with sending the previous ones.
     """
-    client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
+    def __init__(self, collection, max_in_flight: int = 4, retries: int = 3):
+        self.collection = collection
+        self.retries = retries
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="chroma-upsert")
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self.upserted = 0
+        self.failed_batches = 0
+
+    def submit(self, ids: List[str], embeddings: np.ndarray, documents: List[str], metadatas: List[Dict[str, Any]],
+               on_success: Optional[Callable[[], None]] = None, collection=None):
+        """Queue an upsert (into collection, default: the uploader's collection)"""
+        self._slots.acquire() # Blocks while max_in_flight upserts are pending
+        future = self._executor.submit(self._upsert, collection or self.collection, ids, embeddings, documents, metadatas, on_success)
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _upsert(self, collection, ids, embeddings, documents, metadatas, on_success):
+        for attempt in range(1, self.retries + 1):
+            try:
+                collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+                with self._lock:
+                    self.upserted += len(ids)
+                if on_success is not None:
+                    on_success()
+                return
+            except Exception as e:
+                print(f"Error upserting batch of {len(ids)} chunks (attempt {attempt}/{self.retries}): {e}")
+                time.sleep(attempt)
+        with self._lock:
+            self.failed_batches += 1
+        print(f"Giving up on batch starting with chunk {ids[0]}")
+
+    def close(self):
+        """Wait for all pending upserts"""
+        self._executor.shutdown(wait=True)
+
+def delete_chunks(collection, ids: List[str], batch_size: int = 1000) -> None:
+    """Delete chunks by ID in batches (IDs that do not exist are ignored by ChromaDB)"""
+    for i in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[i:i + batch_size])
+
+@dataclass
+class IndexStats:
+    """
+    Progress of an indexing run, updated live and passed to progress callbacks.
+    """
+    articles: int = 0 # Articles chunked (new or changed)
+    chunks: int = 0 # Chunks embedded and submitted
+    upserted: int = 0 # Chunks confirmed stored
+    unchanged: int = 0 # Articles skipped by incremental mode
+    removed: int = 0 # Articles deleted by incremental mode
+    failed_batches: int = 0
+    cache_hits: int = 0 # Chunks whose embedding came from the embedding cache
+    elapsed: float = 0.0 # Seconds since the run started
+    done: bool = False
+
+def index_articles(input_file: str, chroma_host: str, chroma_port: int, collection_name: str, chunk_size: int, overlap: int,
+                   workers: Optional[int] = None, batch_tokens: int = 16384, batch_size: int = 256, max_in_flight: int = 4,
+                   incremental: bool = False, manifest_path: Optional[str] = None, model_name: str = DEFAULT_EMBEDDING_MODEL,
+                   embedding_cache_dir: Optional[str] = None, embed_workers: int = 0, shard_by: Optional[str] = None,
+                   client=None, embedding_function=None,
+                   progress_callback: Optional[Callable[[IndexStats], None]] = None, show_progress: bool = True) -> IndexStats:
+    """
+    Index articles into ChromaDB.
+
+    Articles are streamed from the JSON file and chunked by a pool of worker processes,
+    while the main process embeds token-bounded batches and background threads upsert
+    them. All stages overlap and memory stays bounded by the in-flight windows.
+
+    A manifest of per-article content hashes is maintained next to the input file.
+    In incremental mode, unchanged articles are skipped and chunks of articles that
+    disappeared from the input are deleted, so a run costs in proportion to the change set.
+    The manifest only records articles whose chunks are all stored, so an interrupted
+    run can simply be restarted.
+
+    With embed_workers > 0, batches are embedded by a pool of worker processes, each
+    with its own model copy and a share of the CPU threads (see scripts/embedding_pool.py).
+    Batches are scaled by the number of workers so that every worker gets a full shard.
+
+    With shard_by ("decade" or "newspaper"), chunks are written to one collection per
+    shard (<collection>__shard_<key>) and the collection itself only records the shard
+    map in its metadata (see app/sharding.py). Later runs keep the recorded layout.
+
+    Callers that already hold a ChromaDB client or a loaded embedding model (the startup
+    check, the API) pass them in so the model is not loaded a second time.
+
+    Args:
+        workers: Chunking processes (default: CPU count - 1; 0 chunks in-process)
+        batch_tokens: Tokens per embedding batch
+        batch_size: Maximum chunks per embedding batch
+        max_in_flight: Maximum concurrent upsert requests
+        incremental: Only index new/changed articles and delete removed ones
+        manifest_path: Manifest file (default: index_manifest.<collection>.json next to the input)
+        model_name: Sentence-transformers embedding model (run with the EMBEDDING_BACKEND backend)
+        embedding_cache_dir: On-disk embedding cache reused across runs and collections (None disables it)
+        embed_workers: Embedding processes (0 embeds in this process)
+        shard_by: Shard scheme for a new or empty collection (default: the collection's recorded layout, if any)
+        client: ChromaDB client to use instead of connecting to chroma_host/chroma_port
+        embedding_function: Loaded embedding function for model_name
+        progress_callback: Called with the live stats after every batch and once at the end
+        show_progress: Show a tqdm progress bar
+
+    Returns:
+        Final statistics of the run
+    """
+    if client is None:
+        client = chromadb.HttpClient(host=chroma_host, port=chroma_port)
     
-    # Use a multilingual model for embedding
-    # model_name = "all-MiniLM-L6-v2" # Old model
-    model_name = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
-    print(f"Using embedding model: {model_name}")
-    embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
-        model_name=model_name
-    )
+    print(f"Using embedding model: {model_name} ({EMBEDDING_BACKEND} backend)")
+    if embedding_function is None and embed_workers <= 0:
+        embedding_function = create_embedding_function(model_name)
+    # Vectors from different backends (e.g. int8 ONNX) must not be mixed in caches or manifests
+    vectors_id = embedding_model_id(model_name)
     
     # Create or get collection
-    try:
-        collection = client.get_collection(name=collection_name, embedding_function=embedding_function)
-        print(f"Using existing collection: {collection_name}")
-    except Exception as e:
-        print(f"Collection not found, creating new one: {e}")
-        collection = client.create_collection(name=collection_name, embedding_function=embedding_function)
-        print(f"Created new collection: {collection_name}")
-    
-    with open(input_file, "r", encoding="utf-8") as f:
-        articles = json.load(f)
-    
-    all_chunks = []
-    for article in tqdm(articles, desc="Processing articles"):
-        chunks = process_article(article, chunk_size, overlap)
-        all_chunks.extend(chunks)
+    collection = open_collection(client, collection_name, embedding_function)
+    existing_chunks = total_count(client, collection)
+    print(f"Using collection: {collection_name} ({existing_chunks} chunks)")
+
+    # Sharded layout: chunks go to one collection per shard, the root only holds the shard map
+    shard_map = read_shard_map(collection)
+    if shard_by and shard_by not in SHARD_SCHEMES:
+        raise ValueError(f"Unknown shard scheme '{shard_by}' (expected one of {', '.join(SHARD_SCHEMES)})")
+    if shard_by and shard_map is None and existing_chunks > 0:
+        raise ValueError(f"Collection '{collection_name}' already holds unsharded chunks; build the sharded layout in a new version (--new-version)")
+    if shard_by and shard_map is not None and shard_map[0] != shard_by:
+        raise ValueError(f"Collection '{collection_name}' is sharded by {shard_map[0]}, not {shard_by}; change layouts in a new version (--new-version)")
+    shard_scheme = shard_by or (shard_map[0] if shard_map else None)
+    shard_names: Dict[str, str] = dict(shard_map[1]) if shard_map else {}
+    shard_collections: Dict[str, Any] = {}
+    shard_lock = threading.Lock()
+    if shard_scheme:
+        if shard_map is None:
+            write_shard_map(collection, shard_scheme, shard_names)
+        print(f"Sharded by {shard_scheme}: {len(shard_names)} shards")
+
+    def shard_collection(key: str):
+        with shard_lock:
+            if key not in shard_collections:
+                name = shard_names.get(key) or shard_collection_name(collection_name, key)
+                shard_collections[key] = open_collection(client, name, embedding_function)
+                if key not in shard_names:
+                    shard_names[key] = name
+                    write_shard_map(collection, shard_scheme, shard_names)
+            return shard_collections[key]
+
+    def delete_everywhere(ids: List[str]):
+        for target in ([shard_collection(key) for key in list(shard_names)] if shard_scheme else [collection]):
+            delete_chunks(target, ids)
+
+    # Shard key -> previous chunk IDs of re-indexed articles now stored in that shard. An article
+    # whose date or newspaper changed keeps the same chunk IDs but moves to another shard, so
+    # these IDs are deleted from every other shard (never from the one being written).
+    moved_ids: Dict[str, List[str]] = defaultdict(list)
+
+    def delete_moved():
+        for key in list(shard_names):
+            ids = [chunk_id for target, group in moved_ids.items() if target != key for chunk_id in group]
+            if ids:
+                delete_chunks(shard_collection(key), ids)
+        moved_ids.clear()
+
+    embedding_cache = EmbeddingCache(embedding_cache_dir, vectors_id) if embedding_cache_dir else None
+    if embedding_cache is not None:
+        print(f"Using embedding cache {embedding_cache.directory} ({len(embedding_cache)} vectors)")
+
+    # Anything that changes chunk texts or vectors invalidates every stored chunk
+    params = {"model": vectors_id, "chunk_size": chunk_size, "overlap": overlap, "chunker": CHUNKER_VERSION}
+    if shard_scheme:
+        params["shard_by"] = shard_scheme
+    manifest_path = manifest_path or default_manifest_path(input_file, collection_name)
+    manifest = IndexManifest.load(manifest_path, params)
+    if manifest.articles and existing_chunks == 0:
+        # The collection was wiped (e.g. volume loss): the manifest describes nothing
+        print(f"Collection '{collection_name}' is empty, ignoring manifest {manifest_path}")
+        manifest = IndexManifest(manifest_path, params)
+    elif manifest.params_changed:
+        print("Chunking/embedding parameters changed since the last run: all articles will be re-indexed")
+    if incremental:
+        print(f"Incremental mode: manifest {manifest_path} lists {len(manifest.articles)} articles")
     
-    # Add documents in batches
-    batch_size = 100
-    for i in tqdm(range(0, len(all_chunks), batch_size), desc="Indexing chunks"):
-        batch = all_chunks[i:i+batch_size]
-        
-        ids = [chunk["id"] for chunk in batch]
-        texts = [chunk["text"] for chunk in batch]
-        metadatas = [{
-            "article_id": chunk["article_id"],
-            "title": chunk["title"],
-            "newspaper": chunk["newspaper"],
-            "date": chunk["date"],
-            # "url": chunk.get("url", ""), # Reverted
-            # Ensure subjects/locations are dumped as JSON strings for ChromaDB metadata
-            "subjects": json.dumps(chunk.get("subjects", [])), 
-            "locations": json.dumps(chunk.get("locations", [])),
-            "chunk_idx": chunk["chunk_idx"]
-        } for chunk in batch]
-        
-        try:
-            collection.add(
-                ids=ids,
-                documents=texts,
-                metadatas=metadatas
-            )
-        except Exception as e:
-             print(f"Error adding batch {i//batch_size}: {e}")
-             # Optional: Add more robust error handling, e.g., retries or logging failed IDs
+    # Fail fast if the tokenizer is unavailable, before starting the worker pool
+    budget = content_token_budget(get_tokenizer(model_name), chunk_size)
+    print(f"Chunking to at most {chunk_size} tokens ({budget} of text) with {overlap} tokens of overlap")
+
+    if workers is None:
+        workers = max(1, (os.cpu_count() or 2) - 1)
+    if embed_workers > 0:
+        batch_tokens *= embed_workers
+        batch_size *= embed_workers
+    print(f"Chunking with {workers} worker processes, embedding batches of up to {batch_tokens} tokens, {max_in_flight} upserts in flight")
+
+    embedding_pool = None
+    if embed_workers > 0:
+        embedding_pool = EmbeddingWorkerPool(model_name, EMBEDDING_BACKEND, embed_workers)
+        print(f"Embedding with {embed_workers} worker processes, {embedding_pool.threads_per_worker} threads each")
+    embed = embedding_pool.embed if embedding_pool is not None else embedding_function
+
+    stats = IndexStats()
+    token_counts: Counter = Counter() # Chunk token count -> number of chunks
+    seen_ids = set()
+    stale_ids: List[str] = []
+    # (article_id, hash) of articles sent for chunking; iter_chunks preserves input order
+    queued: deque = deque()
+    tracker = ArticleTracker(manifest)
+    uploader = BoundedUploader(collection, max_in_flight=max_in_flight)
+    start = time.perf_counter()
+
+    def report(done: bool = False):
+        stats.upserted = uploader.upserted
+        stats.failed_batches = uploader.failed_batches
+        stats.cache_hits = embedding_cache.hits if embedding_cache is not None else 0
+        stats.elapsed = time.perf_counter() - start
+        stats.done = done
+        if progress_callback is not None:
+            progress_callback(stats)
 
-    print(f"Indexed {len(all_chunks)} chunks from {len(articles)} articles into ChromaDB collection '{collection_name}'")
+    def changed_articles() -> Iterator[Dict[str, Any]]:
+        for article in iter_json_array(input_file):
+            article_id = article.get("id", "")
+            content_hash = article_hash(article)
+            seen_ids.add(article_id)
+            if incremental and manifest.is_current(article_id, content_hash):
+                stats.unchanged += 1
+                continue
+            queued.append((article_id, content_hash))
+            yield article
+
+    def all_chunks() -> Iterator[Dict[str, Any]]:
+        for chunks in iter_chunks(changed_articles(), chunk_size, overlap, workers, model_name=model_name):
+            article_id, content_hash = queued.popleft()
+            stats.articles += 1
+            # Chunks beyond the new count are left over from the previous version of the article
+            stale_ids.extend(chunk_ids(article_id, len(chunks), manifest.chunk_count(article_id)))
+            if len(stale_ids) >= 1000:
+                delete_everywhere(stale_ids)
+                stale_ids.clear()
+            if shard_scheme and chunks and manifest.chunk_count(article_id):
+                moved_ids[shard_key(chunk_metadata(chunks[0]), shard_scheme)].extend(
+                    chunk_ids(article_id, 0, min(len(chunks), manifest.chunk_count(article_id))))
+                if sum(len(group) for group in moved_ids.values()) >= 1000:
+                    delete_moved()
+            tracker.expect(article_id, content_hash, len(chunks))
+            for chunk in chunks:
+                token_counts[chunk["token_count"]] += 1
+            yield from chunks
+
+    last_save = time.monotonic()
+    try:
+        with tqdm(desc="Indexing chunks", unit="chunk", disable=not show_progress) as progress:
+            for batch in iter_embedding_batches(all_chunks(), batch_tokens, batch_size):
+                texts = [chunk["text"] for chunk in batch]
+                if embedding_cache is not None:
+                    embeddings = embedding_cache.embed(texts, embed)
+                else:
+                    embeddings = np.asarray(embed(texts), dtype=np.float32)
+                metadatas = [chunk_metadata(chunk) for chunk in batch]
+                if shard_scheme:
+                    groups = defaultdict(list)
+                    for i, metadata in enumerate(metadatas):
+                        groups[shard_key(metadata, shard_scheme)].append(i)
+                    targets = [(shard_collection(key), rows) for key, rows in groups.items()]
+                else:
+                    targets = [(collection, list(range(len(batch))))]
+                for target, rows in targets:
+                    batch_article_ids = [batch[i]["article_id"] for i in rows]
+                    uploader.submit(
+                        ids=[batch[i]["id"] for i in rows],
+                        embeddings=embeddings[rows],
+                        documents=[texts[i] for i in rows],
+                        metadatas=[metadatas[i] for i in rows],
+                        on_success=lambda ids=batch_article_ids: tracker.upserted(ids),
+                        collection=target
+                    )
+                stats.chunks += len(batch)
+                progress.update(len(batch))
+                report()
+                if time.monotonic() - last_save > 30:
+                    manifest.save()
+                    last_save = time.monotonic()
+        uploader.close()
+        delete_everywhere(stale_ids)
+        delete_moved()
+
+        if incremental:
+            for article_id in [a for a in manifest.articles if a not in seen_ids]:
+                delete_everywhere(chunk_ids(article_id, 0, manifest.chunk_count(article_id)))
+                manifest.remove(article_id)
+                stats.removed += 1
+    finally:
+        uploader.close()
+        # Persist progress even when interrupted: only fully stored articles are recorded
+        manifest.save()
+        if embedding_cache is not None:
+            embedding_cache.close()
+        if embedding_pool is not None:
+            embedding_pool.close()
+
+    report(done=True)
+    print(f"Indexed {stats.upserted}/{stats.chunks} chunks from {stats.articles} articles into ChromaDB collection '{collection_name}' in {stats.elapsed:.1f}s ({stats.chunks / max(stats.elapsed, 1e-9):.1f} chunks/s)")
+    if token_counts:
+        print(f"Chunk tokens: {summarize_token_counts(token_counts)} (text budget {budget})")
+    if incremental:
+        print(f"Skipped {stats.unchanged} unchanged articles, removed {stats.removed} deleted articles")
+    if embedding_cache is not None:
+        print(f"Embedding cache: {embedding_cache.hits} hits, {embedding_cache.misses} chunks embedded")
+    if stats.failed_batches:
+        print(f"WARNING: {stats.failed_batches} batches could not be upserted ({tracker.incomplete} articles will be retried on the next incremental run)")
+    return stats
+
+def _collection_pages(collection, page_size: int) -> Iterator[Dict[str, Any]]:
+    """Pages of a collection's chunks, with documents, metadata and embeddings"""
+    count = collection.count()
+    offset = 0
+    while offset < count:
+        page = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas", "embeddings"])
+        if not page["ids"]:
+            break
+        yield page
+        offset += len(page["ids"])
+
+def export_snapshot(client, collection, output_dir: str, model_name: str, manifest_path: Optional[str] = None,
+                    page_size: int = 1000, show_progress: bool = True) -> Dict[str, Any]:
+    """
+    Export a collection (IDs, texts, metadata, embeddings) to a columnar snapshot,
+    so it can be restored elsewhere without re-chunking or re-embedding. A sharded
+    collection is exported with the chunks of all its shards, and its scheme is recorded.
+
+    Args:
+        client: ChromaDB client holding the collection (and its shards)
+        collection: ChromaDB collection to export
+        output_dir: Snapshot directory
+        model_name: Embedding model the collection was indexed with (recorded in the snapshot)
+        manifest_path: Indexing manifest to include, so incremental runs can continue after a restore
+
+    Returns:
+        The snapshot description (snapshot.json)
+    """
+    shard_map = read_shard_map(collection)
+    if shard_map is not None:
+        sources = [client.get_collection(name, embedding_function=None) for name in shard_map[1].values()]
+    else:
+        sources = [collection]
+    count = sum(source.count() for source in sources)
+    start = time.perf_counter()
+    pages = (page for source in sources for page in _collection_pages(source, page_size))
+    first = next(pages, None)
+    if first is None:
+        raise ValueError(f"Collection '{collection.name}' is empty, nothing to export")
+    info = {"collection": collection.name, "embedding_model": embedding_model_id(model_name), "manifest": False,
+            "sharded_by": shard_map[0] if shard_map is not None else None}
+    writer = SnapshotWriter(output_dir, count, len(first["embeddings"][0]), info)
+    with tqdm(total=count, desc="Exporting chunks", unit="chunk", disable=not show_progress) as progress:
+        for page in itertools.chain([first], pages):
+            writer.write_batch(page["ids"], page["documents"], page["metadatas"], page["embeddings"])
+            progress.update(len(page["ids"]))
+    if manifest_path and os.path.exists(manifest_path):
+        shutil.copyfile(manifest_path, os.path.join(output_dir, MANIFEST_FILE))
+        writer.info["manifest"] = True
+    info = writer.close()
+    shards = f" ({len(sources)} shards)" if shard_map is not None else ""
+    print(f"Exported {info['count']} chunks ({info['dimension']}-d) from '{collection.name}'{shards} to {output_dir} in {time.perf_counter() - start:.1f}s")
+    return info
+
+def import_snapshot(snapshot_dir: str, client, collection, model_name: str, manifest_path: Optional[str] = None,
+                    batch_size: int = 1000, max_in_flight: int = 4, show_progress: bool = True) -> int:
+    """
+    Bulk-load a snapshot into a collection (upserts, so it can be re-run). No chunking or
+    embedding happens; restore time is bound by disk and ChromaDB write throughput.
+
+    A snapshot of a sharded collection is restored into the same layout: each chunk goes to
+    the shard of its metadata (shard_key), and the shard map is recorded in the target. A
+    target that is already sharded keeps its own scheme.
+
+    Args:
+        snapshot_dir: Directory written by export_snapshot
+        client: ChromaDB client holding the collection (shards are created in it)
+        collection: Target ChromaDB collection, on a server or in process (--chroma-path)
+        model_name: Embedding model queries will use (checked against the snapshot)
+        manifest_path: Where to restore the snapshot's indexing manifest, if it has one
+
+    Returns:
+        Number of chunks stored
+
+    Raises:
+        ValueError: If a sharded snapshot would be mixed with unsharded chunks of the target
+    """
+    reader = SnapshotReader(snapshot_dir)
+    if reader.info.get("embedding_model") != embedding_model_id(model_name):
+        print(f"WARNING: snapshot vectors come from {reader.info.get('embedding_model')}, but queries will be embedded with {embedding_model_id(model_name)}")
+    shard_map = read_shard_map(collection)
+    shard_scheme = shard_map[0] if shard_map is not None else reader.info.get("sharded_by")
+    if shard_scheme and shard_map is None and collection.count() > 0:
+        raise ValueError(f"Collection '{collection.name}' already holds unsharded chunks; import the sharded snapshot into a new version (--new-version)")
+    shard_names: Dict[str, str] = dict(shard_map[1]) if shard_map is not None else {}
+    shard_collections: Dict[str, Any] = {}
+
+    def shard_collection(key: str):
+        if key not in shard_collections:
+            name = shard_names.get(key) or shard_collection_name(collection.name, key)
+            shard_collections[key] = open_collection(client, name, None)
+            if key not in shard_names:
+                shard_names[key] = name
+                write_shard_map(collection, shard_scheme, shard_names)
+        return shard_collections[key]
+
+    if shard_scheme:
+        if shard_map is None:
+            write_shard_map(collection, shard_scheme, shard_names)
+        print(f"Sharded by {shard_scheme}")
+    start = time.perf_counter()
+    uploader = BoundedUploader(collection, max_in_flight=max_in_flight)
+    try:
+        with tqdm(total=reader.count, desc="Importing chunks", unit="chunk", disable=not show_progress) as progress:
+            for ids, documents, metadatas, embeddings in reader.iter_batches(batch_size):
+                if shard_scheme:
+                    groups = defaultdict(list)
+                    for i, metadata in enumerate(metadatas):
+                        groups[shard_key(metadata or {}, shard_scheme)].append(i)
+                    targets = [(shard_collection(key), rows) for key, rows in groups.items()]
+                else:
+                    targets = [(collection, list(range(len(ids))))]
+                for target, rows in targets:
+                    uploader.submit(ids=[ids[i] for i in rows], embeddings=embeddings[rows],
+                                    documents=[documents[i] for i in rows], metadatas=[metadatas[i] for i in rows],
+                                    collection=target)
+                progress.update(len(ids))
+    finally:
+        uploader.close()
+    if uploader.failed_batches:
+        raise RuntimeError(f"{uploader.failed_batches} batches could not be upserted; re-run the import")
+    if manifest_path and reader.info.get("manifest"):
+        # Only valid once every chunk it lists is stored
+        shutil.copyfile(os.path.join(snapshot_dir, MANIFEST_FILE), manifest_path)
+    elapsed = time.perf_counter() - start
+    shards = f" ({len(shard_names)} shards)" if shard_scheme else ""
+    print(f"Imported {uploader.upserted} chunks from {snapshot_dir} into '{collection.name}'{shards} in {elapsed:.1f}s ({uploader.upserted / max(elapsed, 1e-9):.1f} chunks/s)")
+    return uploader.upserted
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Index articles from a JSON file into ChromaDB")
@@ -183,9 +760,58 @@ if __name__ == "__main__":
     parser.add_argument("--chroma-host", default="localhost", help="ChromaDB host")
     parser.add_argument("--chroma-port", type=int, default=8000, help="ChromaDB port")
     parser.add_argument("--collection", default="iwac_articles", help="ChromaDB collection name")
-    parser.add_argument("--chunk-size", type=int, default=512, help="Chunk size in characters")
-    parser.add_argument("--overlap", type=int, default=100, help="Overlap size in characters (used for sentence context)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_TOKENS, help="Maximum tokens per chunk including special tokens (keep at or below the model's max_seq_length)")
+    parser.add_argument("--overlap", type=int, default=DEFAULT_OVERLAP_TOKENS, help="Tokens of trailing sentences repeated at the start of the next chunk")
+    parser.add_argument("--workers", type=int, default=None, help="Chunking worker processes (default: CPU count - 1, 0 = in-process)")
+    parser.add_argument("--batch-tokens", type=int, default=16384, help="Tokens per embedding batch (per embedding worker)")
+    parser.add_argument("--batch-size", type=int, default=256, help="Maximum chunks per embedding batch (per embedding worker)")
+    parser.add_argument("--embed-workers", type=int, default=int(os.getenv("EMBED_WORKERS", "0")), help="Embedding worker processes, each with its own model copy (0 = embed in the main process)")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="Maximum concurrent upsert requests to ChromaDB")
+    parser.add_argument("--incremental", action="store_true", help="Only index new/changed articles and delete removed ones (uses the manifest)")
+    parser.add_argument("--embedding-model", default=os.getenv("EMBEDDING_MODEL_NAME", DEFAULT_EMBEDDING_MODEL), help="Sentence-transformers embedding model")
+    parser.add_argument("--embedding-cache", default=os.getenv("EMBEDDING_CACHE_DIR"), help="Embedding cache directory (default: embedding_cache next to the input file)")
+    parser.add_argument("--no-embedding-cache", action="store_true", help="Embed every chunk without using the cache")
+    parser.add_argument("--manifest", default=None, help="Manifest path (default: index_manifest.<collection>.json next to the input file)")
+    parser.add_argument("--shard-by", choices=SHARD_SCHEMES, default=os.getenv("SHARD_BY") or None, help="Write one collection per decade or newspaper (new or empty collections; later runs keep the layout)")
+    parser.add_argument("--new-version", action="store_true", help="Build a new versioned collection (<collection>__v<date>) and switch the alias to it when done")
+    parser.add_argument("--no-switch", action="store_true", help="With --new-version, leave the alias on the current version")
+    parser.add_argument("--chroma-path", default=None, help="Use an embedded (in-process) ChromaDB stored in this directory instead of the server, also for --export-snapshot/--import-snapshot")
+    snapshot = parser.add_mutually_exclusive_group()
+    snapshot.add_argument("--export-snapshot", metavar="DIR", default=None, help="Export the collection to a Parquet + .npy snapshot instead of indexing")
+    snapshot.add_argument("--import-snapshot", metavar="DIR", default=None, help="Load a snapshot into the collection instead of indexing (no embedding)")
     
     args = parser.parse_args()
-    
-    index_articles(args.input, args.chroma_host, args.chroma_port, args.collection, args.chunk_size, args.overlap) 
\ No newline at end of file
+    embedding_cache_dir = None
+    if not args.no_embedding_cache:
+        embedding_cache_dir = args.embedding_cache or os.path.join(os.path.dirname(os.path.abspath(args.input)), "embedding_cache")
+    if args.chroma_path:
+        client = chromadb.PersistentClient(path=args.chroma_path)
+    else:
+        client = chromadb.HttpClient(host=args.chroma_host, port=args.chroma_port)
+    # --collection is an alias when versioned collections are used: write to its live version or a new one
+    if args.new_version and not args.export_snapshot:
+        target = new_version_name(client, args.collection)
+        print(f"Building new version '{target}' of '{args.collection}'")
+    else:
+        target = resolve_collection_name(client, args.collection)
+    manifest_path = args.manifest or default_manifest_path(args.input, target)
+    if args.export_snapshot:
+        export_snapshot(client, open_collection(client, target, None, create=False), args.export_snapshot,
+                        args.embedding_model, manifest_path=manifest_path)
+        sys.exit(0)
+    if args.import_snapshot:
+        import_snapshot(args.import_snapshot, client, open_collection(client, target, None), args.embedding_model,
+                        manifest_path=manifest_path, max_in_flight=args.max_in_flight)
+    else:
+        stats = index_articles(args.input, args.chroma_host, args.chroma_port, target, args.chunk_size, args.overlap,
+                               workers=args.workers, batch_tokens=args.batch_tokens, batch_size=args.batch_size, max_in_flight=args.max_in_flight,
+                               incremental=args.incremental, manifest_path=manifest_path, model_name=args.embedding_model,
+                               embedding_cache_dir=embedding_cache_dir, embed_workers=args.embed_workers, shard_by=args.shard_by,
+                               client=client)
+        if stats.failed_batches:
+            if args.new_version:
+                print(f"Not switching '{args.collection}' to the incomplete version '{target}'; re-run with --collection {target} --incremental, then switch with scripts/manage_collections.py", file=sys.stderr)
+            sys.exit(1)
+    if args.new_version and not args.no_switch:
+        previous = set_alias(client, args.collection, target)
+        print(f"Alias '{args.collection}' now points to '{target}' (rollback target: {previous or 'none'})")
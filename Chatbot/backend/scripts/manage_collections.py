@@ -0,0 +1,67 @@
+import os
+import sys
+import argparse
+
+import chromadb
+
+# Make app.* importable whether this file is run directly or imported
+BACKEND_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_ROOT not in sys.path:
+    sys.path.insert(0, BACKEND_ROOT)
+from app.collection_versions import get_alias, get_previous, list_versions, set_alias
+
+
+def show(client, alias: str):
+    live = get_alias(client, alias)
+    previous = get_previous(client, alias)
+    print(f"Alias '{alias}' -> {live or '(not set: the unversioned collection is used)'}")
+    for name in list_versions(client, alias):
+        marker = " (live)" if name == live else " (rollback)" if name == previous else ""
+        print(f"  {name}: {client.get_collection(name, embedding_function=None).count()} chunks{marker}")
+
+
+def prune(client, alias: str, keep: int):
+    """Delete old versions, keeping the newest `keep` plus the live and rollback ones"""
+    protected = {get_alias(client, alias), get_previous(client, alias)}
+    versions = list_versions(client, alias)
+    for name in versions[:max(0, len(versions) - keep)]:
+        if name in protected:
+            continue
+        client.delete_collection(name)
+        print(f"Deleted {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List, switch, roll back and prune versioned collections")
+    parser.add_argument("--chroma-host", default=os.getenv("CHROMADB_HOST", "localhost"), help="ChromaDB host")
+    parser.add_argument("--chroma-port", type=int, default=int(os.getenv("CHROMADB_PORT", "8000")), help="ChromaDB port")
+    parser.add_argument("--chroma-path", default=None, help="Use an embedded ChromaDB stored in this directory instead of the server")
+    parser.add_argument("--collection", default=os.getenv("COLLECTION_NAME", "iwac_articles"), help="Alias (the COLLECTION_NAME the API reads)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="Show the live version and all versions")
+    switch = commands.add_parser("switch", help="Point the alias at a collection")
+    switch.add_argument("target", help="Collection to make live (e.g. iwac_articles__v2025-10-16)")
+    commands.add_parser("rollback", help="Point the alias back at the previous collection")
+    prune_parser = commands.add_parser("prune", help="Delete old versions (never the live or rollback one)")
+    prune_parser.add_argument("--keep", type=int, default=2, help="Newest versions to keep")
+    args = parser.parse_args()
+
+    if args.chroma_path:
+        client = chromadb.PersistentClient(path=args.chroma_path)
+    else:
+        client = chromadb.HttpClient(host=args.chroma_host, port=args.chroma_port)
+
+    if args.command == "list":
+        show(client, args.collection)
+    elif args.command == "switch":
+        set_alias(client, args.collection, args.target)
+        show(client, args.collection)
+    elif args.command == "rollback":
+        previous = get_previous(client, args.collection)
+        if not previous:
+            print(f"ERROR: alias '{args.collection}' has no previous version", file=sys.stderr)
+            sys.exit(1)
+        set_alias(client, args.collection, previous)
+        show(client, args.collection)
+    elif args.command == "prune":
+        prune(client, args.collection, args.keep)
@@ -0,0 +1,70 @@
+import pytest
+
+from app.models.context_packer import ARTICLE_SEPARATOR, PASSAGE_SEPARATOR, ArticleCandidate, ContextPacker
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def sentences_of(article_id: str, content: str):
+    return [s.strip() + "." for s in content.split(".") if s.strip()]
+
+
+def article(article_id: str, sentences: int, score: float, words_per_sentence: int = 10, hit_spans=None) -> ArticleCandidate:
+    content = " ".join(" ".join(f"{article_id}s{i}w{j}" for j in range(words_per_sentence)) + "." for i in range(sentences))
+    return ArticleCandidate(article_id=article_id, title=f"Title {article_id}", content=content, score=score, hit_spans=hit_spans or [])
+
+
+def packer(max_tokens: int, **kwargs) -> ContextPacker:
+    return ContextPacker(count_tokens=count_words, max_tokens=max_tokens, get_sentences=sentences_of, **kwargs)
+
+
+def test_short_articles_are_packed_in_full_by_relevance():
+    packed = packer(1000).pack([article("a1", 3, score=1.0), article("a2", 3, score=2.0)])
+    assert packed.article_ids == ["a2", "a1"]
+    assert packed.excerpted_ids == [] and packed.skipped_ids == []
+    assert packed.text.startswith("Title: Title a2\n---\n")
+    assert ARTICLE_SEPARATOR + "Title: Title a1" in packed.text
+    assert packed.tokens == count_words(packed.text)
+    assert packed.tokens <= 1000
+
+
+def test_long_article_is_reduced_to_its_retrieved_passages():
+    long_article = article("a1", 40, score=1.0, hit_spans=[(5, 6), (30, 31)])
+    packed = packer(300, neighbour_sentences=1).pack([long_article])
+    assert packed.article_ids == ["a1"] and packed.excerpted_ids == ["a1"]
+    assert "Title: Title a1 (excerpts)" in packed.text
+    assert PASSAGE_SEPARATOR in packed.text
+    assert "a1s4w0" in packed.text and "a1s31w9" in packed.text
+    assert "a1s10w0" not in packed.text
+    assert packed.text.startswith("Title") and packed.text.endswith("[...]")
+
+
+def test_article_that_does_not_fit_is_skipped_and_packing_continues():
+    # Too long to include in full and without retrieved spans, so it cannot be excerpted
+    too_long = article("big", 20, score=3.0)
+    packed = packer(150).pack([too_long, article("a1", 2, score=2.0), article("a2", 2, score=1.0)])
+    assert packed.article_ids == ["a1", "a2"]
+    assert packed.skipped_ids == ["big"]
+
+
+def test_remaining_articles_are_skipped_once_the_budget_is_used_up():
+    candidates = [article(f"a{i}", 12, score=10 - i) for i in range(4)]
+    packed = packer(300, long_article_tokens=1000).pack(candidates)
+    assert packed.article_ids == ["a0", "a1"]
+    assert packed.skipped_ids == ["a2", "a3"]
+    assert packed.tokens <= 300
+
+
+def test_check_abandons_packing():
+    calls = []
+
+    def check():
+        calls.append(1)
+        if len(calls) > 2:
+            raise TimeoutError("deadline")
+
+    with pytest.raises(TimeoutError):
+        packer(1000, check=check).pack([article(f"a{i}", 2, score=i) for i in range(5)])
+    assert len(calls) == 3
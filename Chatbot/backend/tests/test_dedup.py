@@ -0,0 +1,63 @@
+from app.models.dedup import SimHashIndex, cluster_near_duplicates, hamming_distance, parse_simhash
+
+
+def flip(signature: int, *bits: int) -> int:
+    for bit in bits:
+        signature ^= 1 << bit
+    return signature
+
+
+def test_hamming_distance():
+    assert hamming_distance(0b1011, 0b1011) == 0
+    assert hamming_distance(0b1011, 0b0010) == 2
+
+
+def test_parse_simhash():
+    assert parse_simhash("ff") == 255
+    assert parse_simhash("") is None
+    assert parse_simhash(None) is None
+    assert parse_simhash("not hex") is None
+
+
+def test_index_finds_signatures_within_max_distance():
+    base = 0x0123456789ABCDEF
+    index = SimHashIndex(max_distance=3)
+    index.add("near", flip(base, 0, 17, 63))
+    index.add("far", flip(base, 0, 9, 18, 27, 36))
+    assert index.query(base) == ["near"]
+
+
+def test_index_returns_matches_in_insertion_order():
+    base = 0xFFFF0000FFFF0000
+    index = SimHashIndex(max_distance=2)
+    for key, bit in (("b", 5), ("a", 40), ("c", 63)):
+        index.add(key, flip(base, bit))
+    assert index.query(base) == ["b", "a", "c"]
+
+
+def test_index_with_zero_distance_only_matches_exact_signatures():
+    index = SimHashIndex(max_distance=0)
+    index.add("same", 42)
+    index.add("other", flip(42, 1))
+    assert index.query(42) == ["same"]
+
+
+def test_cluster_keeps_best_ranked_article_as_representative():
+    base = 0x00FF00FF00FF00FF
+    signatures = {"a1": flip(base, 3), "a2": base, "a3": 0xFEDCBA9876543210, "a4": flip(base, 50)}
+    clusters = cluster_near_duplicates(["a1", "a2", "a3", "a4"], signatures, max_distance=3)
+    assert clusters == {"a1": ["a2", "a4"], "a3": []}
+
+
+def test_cluster_never_groups_articles_without_signature():
+    clusters = cluster_near_duplicates(["a1", "a2", "a3"], {"a1": 7, "a2": None}, max_distance=3)
+    assert clusters == {"a1": [], "a2": [], "a3": []}
+
+
+def test_cluster_joins_the_cluster_of_the_best_ranked_match():
+    # a3 is close to both a1 and a2, which are too far apart to be clustered together
+    a1 = 0
+    a2 = flip(0, 0, 1, 2, 3)
+    a3 = flip(0, 0, 1)
+    clusters = cluster_near_duplicates(["a1", "a2", "a3"], {"a1": a1, "a2": a2, "a3": a3}, max_distance=2)
+    assert clusters == {"a1": ["a3"], "a2": []}
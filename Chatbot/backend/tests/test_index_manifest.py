@@ -0,0 +1,70 @@
+import json
+
+from scripts.index_manifest import ArticleTracker, IndexManifest, article_hash, chunk_ids
+
+PARAMS = {"model": "mpnet", "chunk_size": 128, "overlap": 32}
+
+
+def test_article_hash_ignores_key_order():
+    assert article_hash({"id": "a1", "content": "x"}) == article_hash({"content": "x", "id": "a1"})
+    assert article_hash({"id": "a1", "content": "x"}) != article_hash({"id": "a1", "content": "y"})
+
+
+def test_chunk_ids():
+    assert chunk_ids("a1", 1, 3) == ["a1_chunk_1", "a1_chunk_2"]
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = IndexManifest.load(path, PARAMS)
+    assert manifest.articles == {} and not manifest.params_changed
+    manifest.record("a1", "h1", 3)
+    manifest.record("a2", "h2", 0)
+    manifest.remove("a2")
+    manifest.save()
+
+    loaded = IndexManifest.load(path, PARAMS)
+    assert loaded.is_current("a1", "h1")
+    assert not loaded.is_current("a1", "other")
+    assert not loaded.is_current("a2", "h2")
+    assert loaded.chunk_count("a1") == 3 and loaded.chunk_count("a2") == 0
+    assert not loaded.params_changed
+
+
+def test_save_writes_only_when_changed(tmp_path):
+    path = tmp_path / "manifest.json"
+    manifest = IndexManifest.load(str(path), PARAMS)
+    manifest.save()
+    assert not path.exists()
+    manifest.save(force=True)
+    assert json.loads(path.read_text())["articles"] == {}
+    assert [p.name for p in tmp_path.iterdir()] == ["manifest.json"]
+
+
+def test_changed_params_invalidate_hashes_but_keep_chunk_counts(tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = IndexManifest.load(path, PARAMS)
+    manifest.record("a1", "h1", 4)
+    manifest.save()
+
+    loaded = IndexManifest.load(path, dict(PARAMS, chunk_size=256))
+    assert loaded.params_changed
+    assert not loaded.is_current("a1", "h1")
+    assert loaded.chunk_count("a1") == 4
+
+
+def test_tracker_records_an_article_once_all_its_chunks_are_upserted(tmp_path):
+    manifest = IndexManifest(str(tmp_path / "manifest.json"), PARAMS)
+    tracker = ArticleTracker(manifest)
+    tracker.expect("a1", "h1", 3)
+    tracker.expect("a2", "h2", 1)
+    tracker.expect("empty", "h3", 0)
+    assert manifest.is_current("empty", "h3")
+    assert tracker.incomplete == 2
+
+    tracker.upserted(["a1", "a2", "unknown"])
+    assert manifest.is_current("a2", "h2")
+    assert not manifest.is_current("a1", "h1")
+    tracker.upserted(["a1", "a1"])
+    assert manifest.is_current("a1", "h1") and manifest.chunk_count("a1") == 3
+    assert tracker.incomplete == 0
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from scripts.index_to_chroma import iter_json_array
+
+
+@pytest.fixture
+def write(tmp_path):
+    def write(text: str) -> str:
+        path = tmp_path / "articles.json"
+        path.write_text(text, encoding="utf-8")
+        return str(path)
+    return write
+
+
+def test_streams_every_object(write):
+    articles = [{"id": f"a{i}", "title": "Télé", "content": "x" * i, "tags": ["a", {"b": [1, 2]}]} for i in range(50)]
+    path = write(json.dumps(articles, ensure_ascii=False, indent=2))
+    assert list(iter_json_array(path)) == articles
+
+
+def test_objects_cut_at_buffer_boundaries_are_decoded(write):
+    articles = [{"id": f"a{i}", "content": "é" * (i * 7)} for i in range(30)]
+    path = write(json.dumps(articles, ensure_ascii=False))
+    for buffer_size in (1, 3, 16, 100):
+        assert list(iter_json_array(path, buffer_size=buffer_size)) == articles
+
+
+def test_whitespace_byte_order_mark_and_empty_array(write):
+    assert list(iter_json_array(write("﻿ \n [ \n ] \n"))) == []
+    assert list(iter_json_array(write('[{"id": 1} ,\n {"id": 2}]'), buffer_size=2)) == [{"id": 1}, {"id": 2}]
+
+
+def test_rejects_non_array(write):
+    with pytest.raises(ValueError, match="does not contain a JSON array"):
+        list(iter_json_array(write('{"id": 1}')))
+
+
+def test_rejects_truncated_file(write):
+    with pytest.raises(ValueError):
+        list(iter_json_array(write('[{"id": 1}, {"id": 2}'), buffer_size=4))
+    with pytest.raises(ValueError, match="Unexpected end of file"):
+        list(iter_json_array(write('[{"id": 1},')))
@@ -0,0 +1,99 @@
+import asyncio
+import time
+
+from app.jobs import CANCELLED, DONE, QUEUED, RUNNING, JobManager, JobStore
+
+
+def test_claim_marks_a_queued_job_running_once(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.create("j1", {"query": "q"}, "host:1")
+    assert store.claim("j1", "host:1", 1)
+    assert not store.claim("j1", "host:1", 2)
+    job = store.get("j1")
+    assert job["status"] == RUNNING and job["attempts"] == 1 and job["owner"] == "host:1"
+
+
+def test_claim_fails_for_another_owner_or_a_cancelled_job(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.create("j1", {"query": "q"}, "host:1")
+    assert not store.claim("j1", "host:2", 1)
+    store.create("j2", {"query": "q"}, "host:1")
+    assert store.transition("j2", QUEUED, status=CANCELLED)
+    assert not store.claim("j2", "host:1", 1)
+
+
+def test_only_one_of_two_workers_on_one_database_runs_a_job(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    first, second = JobStore(path), JobStore(path)
+    now = time.time()
+    first.create("j1", {"query": "q"}, "host:1")
+    assert first.claim("j1", "host:1", 1)
+
+    # The lease is fresh: the other worker must not take the running job over
+    assert second.take_over_stale("host:2", now, stale_before=now - 30) == []
+    assert not second.claim("j1", "host:2", 2)
+
+    # The first worker stops renewing its lease (it died): the second takes the job over once
+    taken = second.take_over_stale("host:2", now + 60, stale_before=now + 30)
+    assert taken == [{"id": "j1", "status": RUNNING, "attempts": 1}]
+    assert first.take_over_stale("host:1", now + 60, stale_before=now + 30) == []
+    assert second.claim("j1", "host:2", 2)
+
+    # The first worker's late result is dropped, the owner's is kept
+    assert not first.transition("j1", RUNNING, owner="host:1", status=DONE)
+    assert second.transition("j1", RUNNING, owner="host:2", status=DONE)
+    assert first.get("j1")["status"] == DONE and first.get("j1")["owner"] == "host:2"
+
+
+def test_heartbeat_renews_leases_and_reports_requested_cancellations(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    store.create("j1", {"query": "q"}, "host:1")
+    store.claim("j1", "host:1", 1)
+    assert store.heartbeat("host:1", time.time() + 100) == []
+    assert store.take_over_stale("host:2", time.time(), stale_before=time.time() + 50) == []
+
+    assert store.transition("j1", RUNNING, cancel_requested=1)
+    assert store.heartbeat("host:1", time.time()) == ["j1"]
+    store.release("host:1")
+    assert [job["id"] for job in store.take_over_stale("host:2", time.time(), stale_before=time.time() - 1)] == ["j1"]
+
+
+def test_job_managers_sharing_a_store_do_not_run_a_job_twice(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "jobs.sqlite3")
+        started = []
+        release = asyncio.Event()
+
+        async def runner(request, deadline):
+            started.append(request["query"])
+            await release.wait()
+            return {"answer": "ok"}
+
+        first, second = JobManager(db_path=path, heartbeat=0.05), JobManager(db_path=path, heartbeat=0.05)
+        first.owner, second.owner = "host:1", "host:2"
+        first.runner = second.runner = runner
+        await first.start()
+        job = await first.submit({"query": "q1"})
+        while not started:
+            await asyncio.sleep(0.01)
+        # A second worker starting (e.g. another uvicorn worker) leaves the running job alone
+        await second.start()
+        await asyncio.sleep(0.5)
+        assert started == ["q1"]
+        assert (await second.get(job["id"]))["owner"] == "host:1"
+
+        # Cancelling through the worker that does not run the job is routed to its owner
+        cancelled = await second.cancel(job["id"])
+        assert cancelled["status"] == CANCELLED
+
+        other = await first.submit({"query": "q2"})
+        while len(started) < 2:
+            await asyncio.sleep(0.01)
+        release.set()
+        while (await first.get(other["id"]))["status"] != DONE:
+            await asyncio.sleep(0.01)
+        assert started == ["q1", "q2"]
+        await first.stop()
+        await second.stop()
+
+    asyncio.run(scenario())
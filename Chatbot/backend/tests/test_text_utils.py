@@ -0,0 +1,48 @@
+import nltk
+import pytest
+
+from app.models.dedup import hamming_distance
+from app.text_utils import compute_simhash, split_sentences
+
+STORY = ("Le conseil supérieur des imams a réuni ses membres à Abidjan pour préparer le mois de ramadan. "
+         "Les responsables ont appelé les fidèles au calme et à la solidarité avec les plus démunis. "
+         "La commission nationale annoncera le début du jeûne après l'observation du croissant lunaire.")
+
+
+def test_compute_simhash_is_deterministic_and_64_bits():
+    signature = compute_simhash(STORY)
+    assert signature == compute_simhash(STORY)
+    assert 0 <= signature < 1 << 64
+
+
+def test_compute_simhash_ignores_case_and_punctuation():
+    assert compute_simhash(STORY) == compute_simhash(STORY.upper().replace(".", " ! "))
+
+
+def test_compute_simhash_of_a_reprint_is_close():
+    reprint = STORY.replace("Abidjan", "Bouaké")
+    unrelated = ("Le ministre de l'économie a présenté le budget de l'État devant les députés. "
+                 "Les recettes fiscales progressent grâce aux exportations de cacao et de pétrole brut.")
+    assert hamming_distance(compute_simhash(STORY), compute_simhash(reprint)) <= 12
+    assert hamming_distance(compute_simhash(STORY), compute_simhash(unrelated)) > 12
+
+
+def test_compute_simhash_of_short_text_is_none():
+    assert compute_simhash("deux mots") is None
+    assert compute_simhash("trois mots ici") is not None
+    assert compute_simhash("quatre mots ici aussi", shingle_size=5) is None
+
+
+def _has_punkt() -> bool:
+    try:
+        nltk.sent_tokenize("Une phrase. Une autre.", language="french")
+    except LookupError:
+        return False
+    return True
+
+
+@pytest.mark.skipif(not _has_punkt(), reason="NLTK punkt data not installed (see ensure_nltk_data)")
+def test_split_sentences():
+    assert split_sentences("") == []
+    assert split_sentences("Première phrase.\\nDeuxième phrase ici. Troisième !") == [
+        "Première phrase.", "Deuxième phrase ici.", "Troisième !"]